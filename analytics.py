@@ -0,0 +1,288 @@
+"""
+分时段绩效分析
+
+stats 只给出整段回测的指标，夏普比率又是由分钟收益率年化得到的，看不出策略在不同时期是否稳定。
+本模块从净值和成交的列数组计算按月、按周、按日以及滚动窗口的收益率、最大回撤、夏普比率、交易次数、胜率和 S1 贡献：
+- 先按本地日期把逐K线数据用 np.add/minimum/maximum.reduceat 归约为每日摘要（日末净值、日内高低点、日内最大回撤、
+  收益率一阶/二阶矩），成交按卖出时间用 searchsorted/bincount 归入各日；
+- 周、月等时段由若干整日组成，在每日摘要上再做一次分段归约；滚动窗口用累加和之差及 sliding_window_view 计算；
+- 时段内最大回撤可由每日摘要精确合成：某日的回撤 = min(日内回撤, 当日最低净值/此前峰值 - 1)；
+- 全程不构造逐K线的 datetime 对象，也不使用 pandas groupby，百万级K线的分解在毫秒级完成，可在参数扫描中逐组计算。
+
+净值时间戳为 int64 纳秒（带时区数据为UTC），tz 指定划分自然日所用的时区（与下载器数据的 Asia/Shanghai 一致）。
+"""
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from features import NS_PER_DAY, to_datetime_index
+
+# 与 calculate_stats 一致：按1分钟K线年化夏普比率
+BARS_PER_YEAR = 365 * 24 * 60
+
+PERIOD_COLUMNS = ['period_start', 'bars', 'return', 'max_drawdown', 'sharpe_ratio', 'trades', 'winning_trades',
+                  'win_rate', 'profit', 's1_trades', 's1_profit', 's1_contribution']
+
+
+def _segment_starts(keys):
+    """非递减键数组中每段的起始下标"""
+    return np.concatenate([[0], np.flatnonzero(keys[1:] != keys[:-1]) + 1]).astype(np.int64)
+
+
+def _segmented_cummax(values, starts):
+    """
+    分段累计最大值（每段重新开始）。给每段加上递增的偏移量，使后一段的所有值都大于前面各段，
+    一次 np.maximum.accumulate 即可；偏移带来的舍入误差约为 1e-13（相对值）。
+    """
+    lengths = np.diff(np.append(starts, len(values)))
+    offset = np.repeat(np.arange(len(starts), dtype=np.float64) * (values.max() - values.min() + 1.0), lengths)
+    out = np.add(values, offset)
+    np.maximum.accumulate(out, out=out)
+    out -= offset
+    return out
+
+
+def day_segments(time_ns, tz=None):
+    """
+    按本地自然日切分递增的时间戳，返回 (每个有数据的自然日首根K线下标, 自然日编号)。
+    只对首尾两个时间戳和各日零点做时区换算，不逐K线转换。
+    """
+    if tz is None:
+        first_day, last_day = time_ns[0] // NS_PER_DAY, time_ns[-1] // NS_PER_DAY
+        day_numbers = np.arange(first_day, last_day + 1, dtype=np.int64)
+        midnights = day_numbers * NS_PER_DAY
+    else:
+        ends = pd.DatetimeIndex(time_ns[[0, -1]]).tz_localize('UTC').tz_convert(tz).normalize()
+        local_midnights = pd.date_range(ends[0], ends[-1], freq='D')
+        day_numbers = local_midnights.tz_localize(None).asi8 // NS_PER_DAY
+        midnights = local_midnights.asi8
+    starts = np.searchsorted(time_ns, midnights, side='left')
+    starts[0] = 0
+    # 去掉没有K线的自然日
+    keep = np.append(starts[1:] > starts[:-1], starts[-1] < len(time_ns))
+    return starts[keep].astype(np.int64), day_numbers[keep]
+
+
+class PeriodAnalytics:
+    """
+    由净值曲线和成交明细构造，每日摘要只计算一次，之后可多次调用：
+    - daily() / weekly() / monthly(): 自然日、周（周一开始）、自然月分解
+    - rolling(window_days, step_days): 滚动窗口分解
+    每个方法返回 DataFrame，每行一个时段，列见 PERIOD_COLUMNS；period_start 为时段内首个有数据的自然日（本地时间零点）。
+    """
+
+    def __init__(self, time_ns, equity, trade_exit_ns=None, trade_profit=None, trade_s1=None, tz='Asia/Shanghai',
+                 bars_per_year=BARS_PER_YEAR):
+        """
+        - time_ns / equity: 净值时间戳（int64 纳秒，递增）与净值
+        - trade_exit_ns / trade_profit / trade_s1: 每笔卖出的时间、盈亏和是否为 S1 调整
+        - tz: 划分自然日的时区；时间戳本身为本地时间（不带时区的数据）时传 None
+        """
+        time_ns = np.asarray(time_ns, dtype=np.int64)
+        equity = np.asarray(equity, dtype=np.float64)
+        if len(equity) == 0:
+            raise ValueError("净值序列为空")
+        self.tz = tz
+        self.bars_per_year = bars_per_year
+        self.initial_equity = equity[0]
+
+        # 按本地日期切分：只生成每个自然日零点的时间戳（按时区换算，含夏令时），再 searchsorted 定位各日首根K线
+        starts, self.day_numbers = day_segments(time_ns, tz)
+
+        # 逐K线收益率（首根为0，与 calculate_stats 一致）
+        returns = np.zeros_like(equity)
+        returns[1:] = equity[1:] / equity[:-1] - 1
+        drawdown = _segmented_cummax(equity, starts)
+        np.divide(equity, drawdown, out=drawdown)
+        drawdown -= 1
+
+        ends = np.append(starts[1:], len(equity))
+        self.day_bars = ends - starts
+        self.day_close = equity[ends - 1]
+        self.day_high = np.maximum.reduceat(equity, starts)
+        self.day_low = np.minimum.reduceat(equity, starts)
+        self.day_intraday_dd = np.minimum(np.minimum.reduceat(drawdown, starts), 0.0)
+        self.day_sum_r = np.add.reduceat(returns, starts)
+        self.day_sum_r2 = np.add.reduceat(returns * returns, starts)
+
+        # 成交按卖出时间归入各日
+        n_days = len(starts)
+        if trade_exit_ns is not None and len(trade_exit_ns):
+            trade_day = np.searchsorted(time_ns[starts], np.asarray(trade_exit_ns, dtype=np.int64), side='right') - 1
+            trade_day = np.clip(trade_day, 0, n_days - 1)
+            profit = np.asarray(trade_profit, dtype=np.float64)
+            s1 = np.zeros(len(profit), dtype=bool) if trade_s1 is None else pd.Series(trade_s1).eq(True).to_numpy()
+            self.day_trades = np.bincount(trade_day, minlength=n_days)
+            self.day_wins = np.bincount(trade_day, weights=profit > 0, minlength=n_days)
+            self.day_profit = np.bincount(trade_day, weights=profit, minlength=n_days)
+            self.day_s1_trades = np.bincount(trade_day, weights=s1, minlength=n_days)
+            self.day_s1_profit = np.bincount(trade_day, weights=np.where(s1, profit, 0.0), minlength=n_days)
+        else:
+            self.day_trades = np.zeros(n_days, dtype=np.int64)
+            self.day_wins = self.day_profit = self.day_s1_trades = self.day_s1_profit = np.zeros(n_days)
+
+    @classmethod
+    def from_results(cls, results_df, trades_df=None, tz=None, bars_per_year=BARS_PER_YEAR):
+        """由 backtest_ 返回的 results_df / trades_df 构造；tz 默认取时间列自带的时区"""
+        times = to_datetime_index(pd.Index(results_df['datetime']))
+        tz = tz or (str(times.tz) if times.tz is not None else None)
+        kwargs = {}
+        if trades_df is not None and len(trades_df):
+            kwargs = {
+                'trade_exit_ns': to_datetime_index(pd.Index(trades_df['exit_datetime'])).asi8,
+                'trade_profit': trades_df['profit'].to_numpy(dtype=np.float64),
+                'trade_s1': trades_df['s1'].to_numpy() if 's1' in trades_df else None,
+            }
+        return cls(times.asi8, results_df['balance'].to_numpy(dtype=np.float64), tz=tz, bars_per_year=bars_per_year,
+                   **kwargs)
+
+    @classmethod
+    def from_store(cls, store, run_id, tz=None, bars_per_year=BARS_PER_YEAR):
+        """
+        由 results_store.ResultsStore 中保存的净值/成交列构造（列文件为内存映射，不拷贝）；
+        与 from_results 一致，tz 默认取该次回测数据的时区（写入结果库时记录）
+        """
+        tz = tz or store.get_run(run_id)['tz']
+        time_ns, equity = store.load_equity(run_id)
+        if time_ns is None:
+            raise KeyError(f"{run_id} 没有保存净值曲线")
+        ledger = store.load_ledger(run_id)
+        return cls(time_ns, equity, ledger.get('exit_time'), ledger.get('profit'), ledger.get('s1'), tz=tz,
+                   bars_per_year=bars_per_year)
+
+    def _period_labels(self, first_days):
+        labels = pd.DatetimeIndex(first_days.astype('datetime64[D]'))
+        return labels.tz_localize(self.tz) if self.tz is not None else labels
+
+    def _sharpe(self, sum_r, sum_r2, bars):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = sum_r / bars
+            std = np.sqrt(np.maximum(sum_r2 - bars * mean * mean, 0.0) / (bars - 1))
+            return np.where((bars > 1) & (std > 0), mean / std * np.sqrt(self.bars_per_year), 0.0)
+
+    def _frame(self, first_days, bars, period_return, max_drawdown, sum_r, sum_r2, trades, wins, profit, s1_trades,
+               s1_profit, start_equity):
+        trades = trades.astype(np.int64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            win_rate = np.where(trades > 0, wins / trades, 0.0)
+        return pd.DataFrame({
+            'period_start': self._period_labels(first_days),
+            'bars': bars,
+            'return': period_return,
+            'max_drawdown': max_drawdown,
+            'sharpe_ratio': self._sharpe(sum_r, sum_r2, bars),
+            'trades': trades,
+            'winning_trades': wins.astype(np.int64),
+            'win_rate': win_rate,
+            'profit': profit,
+            's1_trades': s1_trades.astype(np.int64),
+            's1_profit': s1_profit,
+            's1_contribution': s1_profit / start_equity,
+        }, columns=PERIOD_COLUMNS)
+
+    def _previous_close(self):
+        """每日开始前的净值（前一日日末净值，首日为首根K线净值）"""
+        return np.concatenate([[self.initial_equity], self.day_close[:-1]])
+
+    def by_days(self, period_keys):
+        """按每日所属时段编号（非递减）分段归约，daily/weekly/monthly 的公共实现"""
+        starts = _segment_starts(period_keys)
+        ends = np.append(starts[1:], len(period_keys))
+        prev_close = self._previous_close()
+        start_equity = prev_close[starts]
+
+        # 时段内最大回撤：每日 min(日内回撤, 日内最低 / 时段内此前峰值 - 1)，首日只有日内回撤
+        peak_before = np.empty_like(self.day_high)
+        peak_before[0] = self.day_high[0]
+        peak_before[1:] = _segmented_cummax(self.day_high, starts)[:-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            candidate = np.minimum(self.day_intraday_dd, self.day_low / peak_before - 1)
+        candidate[starts] = self.day_intraday_dd[starts]
+
+        return self._frame(
+            first_days=self.day_numbers[starts],
+            bars=np.add.reduceat(self.day_bars, starts),
+            period_return=self.day_close[ends - 1] / start_equity - 1,
+            max_drawdown=np.minimum(np.minimum.reduceat(candidate, starts), 0.0),
+            sum_r=np.add.reduceat(self.day_sum_r, starts),
+            sum_r2=np.add.reduceat(self.day_sum_r2, starts),
+            trades=np.add.reduceat(self.day_trades, starts),
+            wins=np.add.reduceat(self.day_wins, starts),
+            profit=np.add.reduceat(self.day_profit, starts),
+            s1_trades=np.add.reduceat(self.day_s1_trades, starts),
+            s1_profit=np.add.reduceat(self.day_s1_profit, starts),
+            start_equity=start_equity,
+        )
+
+    def daily(self):
+        return self.by_days(self.day_numbers)
+
+    def weekly(self):
+        # 1970-01-01 为周四，(日编号 + 3) // 7 得到以周一开始的周编号
+        return self.by_days((self.day_numbers + 3) // 7)
+
+    def monthly(self):
+        return self.by_days(self.day_numbers.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64))
+
+    def rolling(self, window_days=30, step_days=1):
+        """
+        滚动窗口分解：窗口由连续 window_days 个有数据的自然日组成，每 step_days 日滚动一次，
+        period_start 为窗口首日
+        """
+        n_days = len(self.day_numbers)
+        if window_days > n_days:
+            return pd.DataFrame(columns=PERIOD_COLUMNS)
+        first = np.arange(0, n_days - window_days + 1, step_days)
+        last = first + window_days - 1
+
+        def window_sum(values):
+            csum = np.concatenate([[0.0], np.cumsum(values, dtype=np.float64)])
+            return csum[last + 1] - csum[first]
+
+        start_equity = self._previous_close()[first]
+        # 窗口内每日此前峰值：对 (窗口数 x 窗口天数) 的视图沿窗口方向累计最大值
+        highs = sliding_window_view(self.day_high, window_days)[first]
+        lows = sliding_window_view(self.day_low, window_days)[first]
+        intraday = sliding_window_view(self.day_intraday_dd, window_days)[first]
+        peak_before = np.maximum.accumulate(highs, axis=1)[:, :-1]
+        candidate = np.minimum(intraday[:, 1:], lows[:, 1:] / peak_before - 1)
+        max_drawdown = np.minimum(np.minimum(intraday[:, 0], candidate.min(axis=1, initial=0.0)), 0.0)
+
+        return self._frame(
+            first_days=self.day_numbers[first],
+            bars=window_sum(self.day_bars).astype(np.int64),
+            period_return=self.day_close[last] / start_equity - 1,
+            max_drawdown=max_drawdown,
+            sum_r=window_sum(self.day_sum_r),
+            sum_r2=window_sum(self.day_sum_r2),
+            trades=window_sum(self.day_trades),
+            wins=window_sum(self.day_wins),
+            profit=window_sum(self.day_profit),
+            s1_trades=window_sum(self.day_s1_trades),
+            s1_profit=window_sum(self.day_s1_profit),
+            start_equity=start_equity,
+        )
+
+
+if __name__ == "__main__":
+    import time
+
+    from backtest import backtest_, read_pkl_data
+
+    pkl_file = "BNBUSDT_BINANCE_2025-01-01_00_00_00_2025-05-19_23_59_59.pkl"
+    results_df, trades_df, stats = backtest_(read_pkl_data(pkl_file), show_progress=False)
+
+    t0 = time.perf_counter()
+    analytics = PeriodAnalytics.from_results(results_df, trades_df)
+    monthly = analytics.monthly()
+    weekly = analytics.weekly()
+    rolling = analytics.rolling(window_days=30, step_days=1)
+    elapsed = time.perf_counter() - t0
+
+    pd.set_option('display.width', 200)
+    print("\n按月分解:")
+    print(monthly.to_string(index=False, float_format=lambda x: f"{x:.4f}"))
+    print(f"\n按周分解: {len(weekly)} 周，收益为正的周占比 {(weekly['return'] > 0).mean():.2%}")
+    print(f"30日滚动夏普比率: 最低 {rolling['sharpe_ratio'].min():.2f}，中位数 {rolling['sharpe_ratio'].median():.2f}")
+    print(f"分析耗时: {elapsed * 1000:.1f} 毫秒")
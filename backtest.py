@@ -1,16 +1,22 @@
 import pandas as pd
 import numpy as np
 import logging
-from tqdm import tqdm
-from datetime import datetime
-from config import TradingConfig, FLIP_THRESHOLD, MIN_TRADE_AMOUNT, MIN_POSITION_PERCENT, MAX_POSITION_PERCENT, INITIAL_BASE_PRICE, VOLATILITY_WINDOW, INITIAL_PRINCIPAL
-from backtest_visualization import plot_backtest_results_period
-
-logging.basicConfig(
-    level=logging.INFO,  # 设置日志级别为INFO
-    format='%(asctime)s %(levelname)s: %(message)s',
-    handlers=[logging.StreamHandler()]
-)
+import time
+from config import TradingConfig, FLIP_THRESHOLD, MIN_TRADE_AMOUNT, INITIAL_BASE_PRICE, VOLATILITY_WINDOW, INITIAL_PRINCIPAL
+from features import compute_features, dataset_hash, NS_PER_DAY
+from grid_core import GridState, RISK_STOPS, grid_adjust_seconds, step
+
+def setup_logging(level=logging.INFO):
+    """脚本入口调用：作为库导入时不修改日志配置，由调用方决定"""
+    logging.basicConfig(
+        level=level,  # 设置日志级别为INFO
+        format='%(asctime)s %(levelname)s: %(message)s',
+        handlers=[logging.StreamHandler()],
+        force=True  # config.py 导入时的 logging.warning 可能已创建默认配置
+    )
+
+# 回测引擎版本：策略逻辑或统计口径变化时递增，结果库据此区分不同版本的回测结果
+ENGINE_VERSION = '2.1'
 
 def read_pkl_data(pkl_file):
     """
@@ -18,9 +24,57 @@ def read_pkl_data(pkl_file):
     """
     return pd.read_pickle(pkl_file)
 
+
+def resolve_params(overrides=None):
+    """
+    合并 config.py 中的默认策略参数与调参时传入的覆盖参数（键名与 config 中一致）。
+    FLIP_THRESHOLD 可以传入函数，也可以传入数值 r，表示翻转阈值为网格值的 r 倍
+    （config 默认的 lambda 等价于 r=0.2）。数值形式便于参数扫描和跨进程传递。
+    """
+    params = {
+        'GRID_PARAMS': TradingConfig.GRID_PARAMS,
+        'DYNAMIC_INTERVAL_PARAMS': TradingConfig.DYNAMIC_INTERVAL_PARAMS,
+        'FLIP_THRESHOLD': FLIP_THRESHOLD,
+        'RISK_FACTOR': TradingConfig.RISK_FACTOR,
+        'MAX_POSITION_RATIO': TradingConfig.MAX_POSITION_RATIO,
+        'MIN_POSITION_RATIO': TradingConfig.MIN_POSITION_RATIO,
+        'BASE_AMOUNT': TradingConfig.BASE_AMOUNT,
+        'MIN_TRADE_AMOUNT': MIN_TRADE_AMOUNT,
+        'INITIAL_BASE_PRICE': INITIAL_BASE_PRICE,
+        'VOLATILITY_WINDOW': VOLATILITY_WINDOW,
+        'RESET_INTERVAL_SECONDS': getattr(TradingConfig, 'RESET_INTERVAL_SECONDS', round(1*24*60*60)),  # 默认一天重置一次
+        # 获取 S1 参数（若配置中未设置则默认50%卖、70%买）
+        'S1_SELL_TARGET_PCT': getattr(TradingConfig, 'S1_SELL_TARGET_PCT', 0.50),
+        'S1_BUY_TARGET_PCT': getattr(TradingConfig, 'S1_BUY_TARGET_PCT', 0.70),
+        # 风控阈值（stop_on_risk=True 时生效）
+        'MAX_DRAWDOWN': TradingConfig.RISK_PARAMS['max_drawdown'],
+        'DAILY_LOSS_LIMIT': TradingConfig.RISK_PARAMS['daily_loss_limit'],
+    }
+    if overrides:
+        params.update(overrides)
+    flip = params['FLIP_THRESHOLD']
+    if not callable(flip):
+        params['FLIP_THRESHOLD'] = lambda grid_size, ratio=float(flip): grid_size * ratio / 100
+    return params
+
+
+def params_to_json(params):
+    """
+    把策略参数（resolve_params 的结果或覆盖项）转换为可 JSON 序列化的字典，用于结果库等持久化场景：
+    FLIP_THRESHOLD 函数换算为等价的数值倍数 r（翻转阈值 = 网格值 x r / 100），resolve_params 可据此还原；
+    不是网格值线性函数的 FLIP_THRESHOLD 无法用数值表示，直接报错。
+    """
+    params = dict(params or {})
+    flip = params.get('FLIP_THRESHOLD')
+    if callable(flip):
+        ratio = float(f"{flip(1.0) * 100:.12g}")
+        if any(not np.isclose(flip(g), g * ratio / 100, rtol=1e-9, atol=0) for g in (0.5, 2.0, 10.0)):
+            raise ValueError("FLIP_THRESHOLD 不是网格值的线性函数，无法保存为数值倍数")
+        params['FLIP_THRESHOLD'] = ratio
+    return params
+
 # 使用 trader 中的交易金额计算逻辑
-def calculate_trade_amount(total_assets, side, order_price, trades, volatility):
-    import numpy as np
+def calculate_trade_amount(total_assets, side, order_price, trades, volatility, params=None):
     # 根据波动率计算调整因子：波动越大，下单金额越小
     volatility_factor = 1 / (1 + volatility * 10)
     # 计算历史交易的胜率与盈亏比，若无历史交易则默认取中性值
@@ -44,47 +98,99 @@ def calculate_trade_amount(total_assets, side, order_price, trades, volatility):
     else:
         percentile_factor = 1 + price_percentile * 0.5
     # 使用配置中的风险参数进行计算
-    risk_factor = TradingConfig.RISK_FACTOR
-    max_position_ratio = TradingConfig.MAX_POSITION_RATIO
-    base_amount = TradingConfig.BASE_AMOUNT
-    min_trade_amount_val = MIN_TRADE_AMOUNT
+    if params is None:
+        params = resolve_params()
+    risk_factor = params['RISK_FACTOR']
+    max_position_ratio = params['MAX_POSITION_RATIO']
+    base_amount = params['BASE_AMOUNT']
+    min_trade_amount_val = params['MIN_TRADE_AMOUNT']
     risk_adjusted_amount = min(total_assets * risk_factor * volatility_factor * kelly_f * percentile_factor, total_assets * max_position_ratio)
     amount_usdt = max(min(risk_adjusted_amount, base_amount), min_trade_amount_val)
     return amount_usdt
 
 #定义计算动态间隔秒数的函数
-def calculate_dynamic_interval(volatility):
-    params = TradingConfig.DYNAMIC_INTERVAL_PARAMS
-    interval_rules = params['volatility_to_interval_hours']
-    default_interval_hours = params.get('default_interval_hours', 1.0)
-    matched_interval_hours = default_interval_hours
-    for rule in interval_rules:
-        low, high = rule['range']
-        if low <= volatility < high:
-            matched_interval_hours = rule['interval_hours']
-            break
-    interval_seconds = matched_interval_hours * 3600
-    min_interval_seconds = 5 * 60  # 最小间隔5分钟
-    return max(interval_seconds, min_interval_seconds)
+def calculate_dynamic_interval(volatility, params=None):
+    if params is None:
+        params = resolve_params()
+    return float(grid_adjust_seconds(volatility, params))
 
-def backtest_(df, initial_balance=INITIAL_PRINCIPAL):
+def calculate_stats(equity, time_ns, trade_profits, initial_balance):
     """
-    模拟网格交易策略回测，融入 config.py 中定义的交易参数和风控逻辑：
-    
+    根据净值序列、对应的 int64 纳秒时间戳和每笔成交盈亏计算绩效指标
+    """
+    equity = np.asarray(equity, dtype=np.float64)
+    trade_profits = np.asarray(trade_profits, dtype=np.float64)
+    total_trades = len(trade_profits)
+    winning_trades = int(np.count_nonzero(trade_profits > 0))
+    win_rate = winning_trades / total_trades if total_trades > 0 else 0.0
+    final_balance = equity[-1]
+    profit = final_balance - initial_balance
+
+    # 1. 年化收益率
+    total_days = int((time_ns[-1] - time_ns[0]) // NS_PER_DAY)
+    total_years = total_days / 365.0 if total_days > 0 else 1
+    annual_return = (equity[-1] / equity[0]) ** (1 / total_years) - 1 if total_years > 0 else 0
+
+    # 2. 最大回撤
+    cummax = np.maximum.accumulate(equity)
+    max_drawdown = ((equity - cummax) / cummax).min()
+
+    # 3. 夏普比率（分钟收益率，假设无风险利率为0）
+    returns = np.zeros_like(equity)
+    returns[1:] = equity[1:] / equity[:-1] - 1
+    returns_std = returns.std(ddof=1) if len(returns) > 1 else 0
+    sharpe_ratio = returns.mean() / returns_std * np.sqrt(365*24*60) if returns_std > 0 else 0  # 假设1分钟K线
+
+    # 4. 盈亏比
+    win_profits = trade_profits[trade_profits > 0]
+    loss_profits = trade_profits[trade_profits < 0]
+    avg_win = win_profits.mean() if len(win_profits) else 0
+    avg_loss = np.abs(loss_profits).mean() if len(loss_profits) else 1
+    profit_loss_ratio = avg_win / avg_loss if avg_loss != 0 else 0
+
+    return {
+        'total_trades': total_trades,
+        'winning_trades': winning_trades,
+        'win_rate': win_rate,
+        'final_balance': final_balance,
+        'profit': profit,
+        'annual_return': annual_return,
+        'max_drawdown': max_drawdown,
+        'sharpe_ratio': sharpe_ratio,
+        'profit_loss_ratio': profit_loss_ratio
+    }
+
+def backtest_(df, initial_balance=INITIAL_PRINCIPAL, params=None, start=0, end=None, features=None, show_progress=True,
+              stop_on_risk=False):
+    """
+    模拟网格交易策略回测，融入 config.py 中定义的交易参数和风控逻辑。
+    逐K线的决策（下述 1-6）由 grid_core.step 完成，模拟盘 GridStrategy 与蒙特卡洛批量回测调用的是同一个函数：
+
+    0. 输入：
+       - 传入 df 时先调用 features.compute_features 计算价格、时间戳、对数收益率、日编号等特征；
+         若已传入 features（例如参数扫描、walk-forward 时复用），则 df 可以为 None。
+       - start/end 为回测窗口在特征数组中的下标范围 [start, end)，按下标切片，不复制 DataFrame；
+         窗口之前的历史数据仍可用于计算波动率。
+       - 滚动波动率和定时重置基准价的K线下标取自 features（见 features.load_features 的持久化缓存），
+         缺失时按需计算一次并缓存在 features 中，供后续回测复用。
+       - params 为覆盖 config 默认值的策略参数（见 resolve_params）。
+       - stop_on_risk=True 时执行 RISK_PARAMS 风控：净值相对历史最高的回撤跌破 MAX_DRAWDOWN，
+         或当日净值相对当日开盘跌破 DAILY_LOSS_LIMIT 时立即终止回测，stats['risk_stop'] 记录触发原因。
+
     1. 初始化：
        - 若配置中指定 INITIAL_BASE_PRICE（非0），则采用其作为基准价，否则用第一根K线收盘价。
        - 当前网格值取自 TradingConfig.GRID_PARAMS['initial']（单位为百分比），转换为小数后作为 grid_pct。
-    
+
     2. 买入信号（空仓状态）：
        - 当价格跌破下边界（current_base_price*(1 - grid_pct)）时启动买入监控，记录最低价。
        - 当价格从最低价反弹达到最低价 + (current_base_price*grid_pct)*FLIP_THRESHOLD(当前网格值)时，
          动态计算下单金额（基于当前总资产和配置的 POSITION_SCALE_FACTOR 等）后执行买入操作。
-    
+
     3. 卖出信号（持仓状态）：
        - 当价格上穿上边界（current_base_price*(1 + grid_pct)）时启动卖出监控，记录期间最高价。
        - 当价格从最高点回落超过 (current_base_price*grid_pct)*FLIP_THRESHOLD(当前网格值)时卖出持仓，
          并使用卖出价更新基准价。
-    
+
     4. 动态网格调整：
        - 卖出成交后，若历史数据足够（至少 VOLATILITY_WINDOW 小时对应的分钟数），
          计算最近波动率 = (窗口内最高价 - 最低价)/current_base_price。
@@ -94,347 +200,95 @@ def backtest_(df, initial_balance=INITIAL_PRINCIPAL):
          最终更新 grid_pct（= new_grid_value/100）。
 
     5. 风险管理检查：
-       - 计算当前仓位比例（持仓价值/总资产），如果低于MIN_POSITION_PERCENT或高于MAX_POSITION_PERCENT，则记录日志（类似于risk_manager中的警告）。
-    
+       - stop_on_risk=True 时按账户净值检查回撤和日内亏损（见上文）。
+
     6. S1策略逻辑：
        - 利用最近一天（例如1440个数据点，如果假设1分钟一根K线）计算当天的最高价和最低价，
          然后根据配置中定义的S1目标（S1_SELL_TARGET_PCT和S1_BUY_TARGET_PCT，默认分别为50%和70%）判断：
        - 如果处于持仓状态且当前价格突破当天最高且仓位比例超过S1_SELL_TARGET_PCT，则按超出部分卖出一定比例以降低仓位；
        - 如果价格低于当天最低且仓位比例低于S1_BUY_TARGET_PCT，则尝试买入补仓。
-    
+
     7. 每个时点记录账户组合净值（现金余额+持仓估值）以及成交记录，最终输出统计数据。
     """
-    results = []
-    trades = []
-    
-    df = df.sort_index()  # 确保按时间顺序
-    prices = df['close_price'].values
-    #使用history_kline_downloader.py生成的数据时，时间是df['open_time']
-    if df.index[0]==0:
-        times=df['open_time']
-    else:
-        #使用自带的示例数据时df.index就是时间索引
-        times = df.index
+    if features is None:
+        features = compute_features(df)
+    params = resolve_params(params)
+    if end is None:
+        end = len(features)
+
+    times = features.times
+    time_ns = features.time_ns
+    prices = features.prices
+    n_bars = end - start
+    equity = np.empty(n_bars, dtype=np.float64)
 
     # 初始化基准价：若配置中指定 INITIAL_BASE_PRICE（非0），则采用其作为基准价，否则用第一根K线收盘价。
-    current_base_price = INITIAL_BASE_PRICE if INITIAL_BASE_PRICE > 0 else df.iloc[0]['close_price']
-    # 当前网格值取自配置（单位百分比），转换为小数
-    current_grid_value = TradingConfig.GRID_PARAMS['initial']  # 例如 2.0 表示2%
-    current_grid_pct = current_grid_value / 100.0
-    
-    # 记录上一次网格调整的时间，初始取第一根K线的时间
-    last_grid_adjust_time = times[0]
-    # 新增：定期重置基准价的逻辑
-    reset_interval_seconds = TradingConfig.RESET_INTERVAL_SECONDS if hasattr(TradingConfig, 'RESET_INTERVAL_SECONDS') else round(1*24*60*60)#86400  # 默认一天重置一次
-    #如果times[0]不是Timestamp类型
-    if isinstance(times[0], pd.Timestamp) == False:
-        last_reset_time_dt = datetime.strptime(times[0], "%Y-%m-%d %H:%M:%S")
-    else:
-        last_reset_time_dt = times[0]
-
-    # 状态标识：'flat'为空仓，'long'为持仓状态
-    state = 'flat'
-    buy_monitoring = False   # 买入监控状态
-    buy_min_price = None     # 监控期间最低价
-    sell_monitoring = False  # 卖出监控状态
-    sell_max_price = None    # 监控期间最高价
-    open_position = None     # 当前持仓信息
-    trade_count = 0
-    current_balance = initial_balance
-    max_portfolio_value = initial_balance  # 新增：记录账户净值历史最高值
-    last_trade_time = None   # 新增：记录上一笔交易的时间
-
-    # 对于波动率计算，将 VOLATILITY_WINDOW (单位小时) 换算为对应的分钟数（假设1分钟一根K线）
-    bars_for_vol = int(VOLATILITY_WINDOW * 60)
-
-    # 初始化 S1 策略相关变量（采用昨日日线数据）：
-    last_day = None              # 上一交易日日期
-    curr_day_high = None         # 当天最高价
-    curr_day_low = None          # 当天最低价
-    s1_daily_high = None         # 昨日最高价（S1参考）
-    s1_daily_low = None          # 昨日最低价（S1参考）
-    # 获取 S1 参数（若配置中未设置则默认50%卖、70%买）
-    S1_SELL_TARGET_PCT = getattr(TradingConfig, 'S1_SELL_TARGET_PCT', 0.50)
-    S1_BUY_TARGET_PCT = getattr(TradingConfig, 'S1_BUY_TARGET_PCT', 0.70)
-
-    for i, current_time in enumerate(tqdm(times, desc="回测进度")):
-        price = prices[i]
-        # 更新当天最高和最低价格，用于 S1 策略参考
-        # current_time 是字符串，先转为 datetime 对象
-        if isinstance(current_time, pd.Timestamp) == False:
-            current_time_dt = datetime.strptime(current_time, "%Y-%m-%d %H:%M:%S")
-        else:
-            current_time_dt = current_time
-
-        # 新增：每隔固定时间间隔重置基准价
-        if (current_time_dt - last_reset_time_dt).total_seconds() >= reset_interval_seconds:
-            current_base_price = price  # 用当前价格重置基准价
-            #current_base_price =INITIAL_BASE_PRICE
-            last_reset_time_dt = current_time_dt
-            #logging.info(f"定时重置基准价: 在 {current_time} 重置为 {price:.2f}")
-        
-        current_date = current_time_dt.date()
-        if last_day is None:
-            last_day = current_date
-            curr_day_high = price
-            curr_day_low = price
-        elif current_date == last_day:
-            curr_day_high = max(curr_day_high, price)
-            curr_day_low = min(curr_day_low, price)
-        else:
-            # 跨日：将上一交易日的最高/最低作为 S1 参考
-            s1_daily_high = curr_day_high
-            s1_daily_low = curr_day_low
-            last_day = current_date
-            curr_day_high = price
-            curr_day_low = price
-
-        # 持仓按当前价格估值
-        position_value = open_position['units'] * price if (state == 'long' and open_position) else 0.0
-        portfolio_value = current_balance + position_value
-        results.append({
-            'datetime': current_time,
-            'balance': portfolio_value
-        })
-        max_portfolio_value = max(max_portfolio_value, portfolio_value)  # 更新账户净值历史最高值
-
-        # 空仓状态监控买入信号
-        if state == 'flat':
-            next_buy_level = current_base_price * (1 - current_grid_pct)
-            if not buy_monitoring and price <= next_buy_level:
-                buy_monitoring = True
-                buy_min_price = price
-            if buy_monitoring:
-                # 更新监控期间最低价
-                buy_min_price = min(buy_min_price, price)
-                # 依据当前基准价和网格计算差额及翻转阈值
-                grid_step_val = current_base_price * current_grid_pct
-                threshold = grid_step_val * FLIP_THRESHOLD(current_grid_value)
-                if price >= buy_min_price + threshold:
-                    # 使用新的交易金额计算函数；若无足够波动率样本，则设 volatility=0
-                    vol_for_trade = 0
-                    if i >= bars_for_vol:
-                        window_prices = prices[i - bars_for_vol + 1: i+1]
-                        returns = np.diff(np.log(window_prices))
-                        vol_for_trade = np.std(returns) * np.sqrt(1440 * 365)
-                    trade_amount = calculate_trade_amount(portfolio_value, 'buy', price, trades, vol_for_trade)
-                    if current_balance >= trade_amount:
-                        units = trade_amount / price
-                        open_position = {
-                            'buy_time': current_time,
-                            'buy_price': price,
-                            'units': units
-                        }
-                        current_balance -= trade_amount  # 扣除买入金额
-                        state = 'long'
-                        buy_monitoring = False  # 重置买入监控
-                        last_trade_time = current_time   # 更新交易时间
-
-        # 持仓状态监控卖出信号
-        elif state == 'long' and open_position:
-            upper_band = current_base_price * (1 + current_grid_pct)
-            if not sell_monitoring and price >= upper_band:
-                sell_monitoring = True
-                sell_max_price = price
-            if sell_monitoring:
-                sell_max_price = max(sell_max_price, price)
-                grid_step_val = current_base_price * current_grid_pct
-                threshold = grid_step_val * FLIP_THRESHOLD(current_grid_value)
-                if price <= sell_max_price - threshold:
-                    exit_price = price
-                    profit_trade = open_position['units'] * (exit_price - open_position['buy_price'])
-                    current_balance += open_position['units'] * exit_price
-                    trades.append({
-                        'entry_datetime': open_position['buy_time'],
-                        'exit_datetime': current_time,
-                        'entry_price': open_position['buy_price'],
-                        'exit_price': exit_price,
-                        'profit': profit_trade
-                    })
-                    # 卖出后，用成交价更新基准价
-                    current_base_price = exit_price
-                    trade_count += 1
-                    state = 'flat'
-                    sell_monitoring = False
-                    open_position = None
-                    last_trade_time = current_time   # 更新交易时间
-                    
-                    # 动态网格调整
-                    if i >= bars_for_vol:
-                        window_prices = prices[i - bars_for_vol + 1: i+1]
-                        returns = np.diff(np.log(window_prices))
-                        volatility = np.std(returns) * np.sqrt(1440 * 365)
-                        dynamic_interval = calculate_dynamic_interval(volatility)
-                        if isinstance(current_time, pd.Timestamp) == False:
-                            current_time_dt = datetime.strptime(current_time, "%Y-%m-%d %H:%M:%S")
-                            last_grid_adjust_time_dt = datetime.strptime(last_grid_adjust_time, "%Y-%m-%d %H:%M:%S")
-                        else:
-                            current_time_dt = current_time
-                            last_grid_adjust_time_dt = last_grid_adjust_time
-                        time_since_last_adjust = (current_time_dt - last_grid_adjust_time_dt).total_seconds()
-                        if time_since_last_adjust >= dynamic_interval:
-                            # 根据波动率区间获取基础网格
-                            base_grid = None
-                            for range_config in TradingConfig.GRID_PARAMS['volatility_threshold']['ranges']:
-                                low, high = range_config['range']
-                                if low <= volatility < high:
-                                    base_grid = range_config['grid']
-                                    break
-                            # 匹配不到则用初始网格
-                            if base_grid is None:
-                                base_grid = TradingConfig.GRID_PARAMS['initial']
-                            # 删除趋势调整，直接用base_grid
-                            new_grid_value = base_grid
-                            # 限定在[min, max]
-                            new_grid_value = max(min(new_grid_value, TradingConfig.GRID_PARAMS['max']), TradingConfig.GRID_PARAMS['min'])
-                            # 日志输出
-                            logging.info(f"调整网格大小 | 波动率: {volatility:.2%} | 原网格: {current_grid_value:.2f}% | 新网格: {new_grid_value:.2f}%")
-                            # 更新
-                            current_grid_value = new_grid_value
-                            current_grid_pct = current_grid_value / 100.0
-                            last_grid_adjust_time = current_time
-                    
-                    # 卖出后重置状态
-                    state = 'flat'
-                    sell_monitoring = False
-                    open_position = None
-
-        # 风险管理检查：计算当前仓位比例
-        position_value = open_position['units'] * price if (state == 'long' and open_position) else 0.0
-        portfolio_value = current_balance + position_value
-        position_ratio = position_value / portfolio_value if portfolio_value > 0 else 0.0
-
-        if position_ratio < MIN_POSITION_PERCENT:
-            pass
-            # 可在此记录低仓位警告
-        if position_ratio > MAX_POSITION_PERCENT:
-            pass
-            # 可在此记录仓位过高警告
-
-        # S1策略逻辑：使用昨日日线的高低作为参考进行仓位调整
-        if s1_daily_high is not None and s1_daily_low is not None:
-            # S1卖出调整：若持仓且当前价突破昨日最高且仓位比例超过S1_SELL_TARGET_PCT，则卖出多余部分
-            # 仅在持仓且当前tick未发生其他交易，
-            # 且持仓的建仓时间早于当前tick时，触发卖出调整
-            if state == 'long' and open_position and (last_trade_time != current_time) \
-                and price > s1_daily_high and position_ratio > S1_SELL_TARGET_PCT:
-                desired_value = portfolio_value * S1_SELL_TARGET_PCT
-                excess_value = position_value - desired_value
-                if excess_value >= MIN_TRADE_AMOUNT:
-                    sell_units = excess_value / price
-                    profit_trade = sell_units * (price - open_position['buy_price'])
-                    current_balance += sell_units * price
-                    original_buy_time = open_position['buy_time']  # 记录原始买入时间用于交易记录
-                    open_position['units'] -= sell_units
-                    trades.append({
-                        'entry_datetime': original_buy_time,
-                        'exit_datetime': current_time,
-                        'entry_price': open_position['buy_price'],
-                        'exit_price': price,
-                        'profit': profit_trade,
-                        's1': True
-                    })
-                    # 保持原始buy_time（这样下一次平仓时记录的持仓周期仍然准确）
-                    if open_position['units'] < 1e-8:
-                        open_position = None
-                        state = 'flat'
-                    trade_count += 1
-                    last_trade_time = current_time   # 更新交易时间
-                    logging.info(f"S1卖出调整：卖出 {sell_units:.4f} 单位，剩余仓位 {open_position['units'] if open_position else 0:.4f}")
-
-
-            # S1买入调整：当价格低于昨日最低且仓位比例低于S1_BUY_TARGET_PCT时，补仓
-            if (last_trade_time != current_time) and price < s1_daily_low and position_ratio < S1_BUY_TARGET_PCT:
-                desired_value = portfolio_value * S1_BUY_TARGET_PCT
-                shortage_value = desired_value - position_value
-                if shortage_value >= MIN_TRADE_AMOUNT and current_balance >= shortage_value:
-                    buy_units = shortage_value / price
-                    if state == 'flat':
-                        open_position = {
-                            'buy_time': current_time,
-                            'buy_price': price,
-                            'units': buy_units
-                        }
-                        state = 'long'
-                    else:
-                        # 如果已有仓位，则只有当持仓的buy_time不等于当前tick时，才进行补仓
-                        if open_position['buy_time'] != current_time:
-                            total_units = open_position['units'] + buy_units
-                            open_position['buy_price'] = (open_position['buy_price'] * open_position['units'] + price * buy_units) / total_units
-                            open_position['units'] = total_units
-                        else:
-                            # 若当前tick刚开仓，则跳过S1买入调整，避免生成记录
-                            buy_units = 0
-                    current_balance -= shortage_value
-                    trade_count += 1
-                    # 不记录S1买入调整的交易记录，避免产生入场与出场时间完全一致的记录
-                    last_trade_time = current_time   # 更新交易时间
-                    if buy_units:
-                        logging.info(f"S1买入调整：买入 {buy_units:.4f} 单位，新仓位 {open_position['units']:.4f}")
-                    else:
-                        logging.info("跳过S1买入调整，因当前tick刚开仓")
-                    last_trade_time = current_time   # 更新交易时间
-                    logging.info(f"S1买入调整：买入 {buy_units:.4f} 单位，新仓位 {open_position['units']:.4f}")
-
-    total_trades = len(trades)
-    winning_trades = sum(1 for trade in trades if trade['profit'] > 0)
-    win_rate = winning_trades / total_trades if total_trades > 0 else 0.0
-    final_balance = portfolio_value
-    profit = final_balance - initial_balance
-    
-    #stats = {
-    #    'total_trades': total_trades,
-    #    'winning_trades': winning_trades,
-    #    'win_rate': win_rate,
-    #    'final_balance': final_balance,
-    #    'profit': profit
-    #}
-    
-    results_df = pd.DataFrame(results)
-    trades_df = pd.DataFrame(trades)
+    # 网格值、动态网格调整时间等其余状态见 grid_core.GridState
+    base_price = params['INITIAL_BASE_PRICE'] if params['INITIAL_BASE_PRICE'] > 0 else prices[start]
+    state = GridState(initial_balance, base_price, int(time_ns[start]), params)
+
+    # 定期重置基准价（重置点只取决于时间戳，预先算好下标）
+    is_reset = np.zeros(n_bars, dtype=bool)
+    is_reset[features.get_reset_points(params['RESET_INTERVAL_SECONDS'], start, end) - start] = True
+    # 跨日标记，用于 S1 的昨日高低点和日内亏损风控（首根K线视为新的一天）
+    day_ids = features.day_ids[start:end]
+    new_day = np.ones(n_bars, dtype=bool)
+    new_day[1:] = day_ids[1:] != day_ids[:-1]
+    # 对于波动率计算，将 VOLATILITY_WINDOW (单位小时) 换算为对应的分钟数（假设1分钟一根K线）；
+    # K线有缺口时按时间取窗口，样本不足（历史不满窗口时长）处为 NaN
+    rolling_vol = features.get_volatility(int(params['VOLATILITY_WINDOW'] * 60))
+
+    # 逐K线调用 grid_core.step；输入先转为 Python 标量，比逐个读取 numpy 元素快
+    bars = zip(range(start, end), time_ns[start:end].tolist(), prices[start:end].tolist(),
+               rolling_vol[start:end].tolist(), new_day.tolist(), is_reset.tolist())
+    if show_progress:
+        from tqdm import tqdm  # 仅显示进度条时导入，参数扫描的工作进程不需要
+        bars = tqdm(bars, total=n_bars, desc="回测进度")
+    risk_stop = None
+    for i, t, price, volatility, is_new_day, reset in bars:
+        portfolio_value, risk = step(state, i, t, price, volatility, is_new_day, reset, stop_on_risk=stop_on_risk)
+        equity[i - start] = portfolio_value
+        if risk:
+            # 风控：回撤或日内亏损超限则终止本次回测
+            risk_stop = RISK_STOPS[risk]
+            end = i + 1
+            equity = equity[:end - start]
+            break
+    final_balance = state.portfolio_value(price)
 
-    # 计算绩效指标
-    # 1. 年化收益率
-    results_df['balance'] = results_df['balance'].astype(float)
-    total_days = (pd.to_datetime(results_df['datetime'].iloc[-1]) - pd.to_datetime(results_df['datetime'].iloc[0])).days
-    total_years = total_days / 365.0 if total_days > 0 else 1
-    annual_return = (results_df['balance'].iloc[-1] / results_df['balance'].iloc[0]) ** (1 / total_years) - 1 if total_years > 0 else 0
+    # 只在最后按下标取出时间标签，避免逐K线构造字典
+    results_df = pd.DataFrame({'datetime': times[start:end], 'balance': equity})
+    trades_df = pd.DataFrame(state.trades, columns=['entry_i', 'exit_i', 'entry_price', 'exit_price', 'profit', 's1'])
+    trades_df.insert(0, 'exit_datetime', times[trades_df['exit_i'].to_numpy(dtype=np.int64)])
+    trades_df.insert(0, 'entry_datetime', times[trades_df['entry_i'].to_numpy(dtype=np.int64)])
+    trades_df = trades_df.drop(columns=['entry_i', 'exit_i'])
 
-    # 2. 最大回撤
-    cummax = results_df['balance'].cummax()
-    drawdown = (results_df['balance'] - cummax) / cummax
-    max_drawdown = drawdown.min()
+    stats = calculate_stats(equity, time_ns[start:end], trades_df['profit'].to_numpy(), initial_balance)
+    stats['final_balance'] = final_balance
+    stats['profit'] = final_balance - initial_balance
+    stats['risk_stop'] = risk_stop
 
-    # 3. 夏普比率（日收益率，假设无风险利率为0）
     results_df['returns'] = results_df['balance'].pct_change().fillna(0)
-    sharpe_ratio = results_df['returns'].mean() / results_df['returns'].std() * np.sqrt(365*24*60) if results_df['returns'].std() > 0 else 0  # 假设1分钟K线
-
-    # 4. 盈亏比
-    win_profits = trades_df[trades_df['profit'] > 0]['profit']
-    loss_profits = trades_df[trades_df['profit'] < 0]['profit']
-    avg_win = win_profits.mean() if not win_profits.empty else 0
-    avg_loss = loss_profits.abs().mean() if not loss_profits.empty else 1
-    profit_loss_ratio = avg_win / avg_loss if avg_loss != 0 else 0
-
-    stats = {
-        'total_trades': total_trades,
-        'winning_trades': winning_trades,
-        'win_rate': win_rate,
-        'final_balance': final_balance,
-        'profit': profit,
-        'annual_return': annual_return,
-        'max_drawdown': max_drawdown,
-        'sharpe_ratio': sharpe_ratio,
-        'profit_loss_ratio': profit_loss_ratio
-    }
 
     return results_df, trades_df, stats
 
 if __name__ == "__main__":
-    pkl_file = "BNBUSDT_BINANCE_2025-01-01_00_00_00_2025-05-19_23_59_59.pkl"
+    import argparse
+
+    parser = argparse.ArgumentParser(description="网格策略回测")
+    parser.add_argument('data', nargs='?', default="BNBUSDT_BINANCE_2025-01-01_00_00_00_2025-05-19_23_59_59.pkl",
+                        help="K线数据文件（pkl）")
+    parser.add_argument('--no-plot', action='store_true', help="不绘制资金曲线（无图形界面环境）")
+    args = parser.parse_args()
+    setup_logging()
+
+    pkl_file = args.data
     df = read_pkl_data(pkl_file)
+    features = compute_features(df)
 
-    results_df, trades_df, stats = backtest_(df)
+    started = time.perf_counter()
+    results_df, trades_df, stats = backtest_(df, features=features)
+    elapsed = time.perf_counter() - started
 
     print("\n策略统计:")
     print(f"总交易次数: {stats['total_trades']}")
@@ -449,6 +303,16 @@ if __name__ == "__main__":
 
     # 保存交易记录
     trades_df.to_csv('trades_results.csv')
+    # 写入结果库，便于与参数扫描结果一起查询
+    from results_store import ResultsStore
+    store = ResultsStore('backtest_results')
+    # 保存实际生效的完整参数（FLIP_THRESHOLD 函数由结果库换算为数值倍数）
+    run_id = store.add_run(resolve_params(), stats, dataset_hash(features), results_df, trades_df, elapsed,
+                           start=0, end=len(features), initial_balance=INITIAL_PRINCIPAL)
+    print(f"结果已写入 backtest_results，run_id: {run_id}")
+
+    if args.no_plot:
+        raise SystemExit(0)
 
     # 将 'datetime' 转换为 datetime 类型，并设置为索引
     results_df['datetime'] = pd.to_datetime(results_df['datetime'])
@@ -456,4 +320,5 @@ if __name__ == "__main__":
     results_df.set_index('datetime', inplace=True)
     trades_df.set_index('datetime', inplace=True)
     
+    from backtest_visualization import plot_backtest_results_period
     plot_backtest_results_period(results_df, trades_df, '4h')  # 每4小时一个点
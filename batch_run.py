@@ -0,0 +1,167 @@
+"""
+批量回测命令行（无图形界面）
+
+按清单（JSON）对多个数据集 x 多组参数逐一回测，结果写入结果库（results_store.ResultsStore）并导出汇总 CSV：
+
+    python batch_run.py manifest.json --workers 8
+    python batch_run.py manifest.json --timing      # 额外报告 导入 -> 数据就绪 -> 第一根K线 的启动耗时
+
+清单格式：
+    {
+        "output": "batch_results",                       # 结果库目录，默认 batch_results
+        "initial_balance": 1000,                         # 默认取 config.INITIAL_PRINCIPAL
+        "datasets": ["BNBUSDT_xxx.pkl", {"path": "ETHUSDT.compact", "name": "ETHUSDT", "start": 0, "end": 100000}],
+        "params": [{}, {"FLIP_THRESHOLD": 0.1}],          # 参数组列表（参数名与 config.py 一致）
+        "param_grid": {"RISK_FACTOR": [0.05, 0.1]},       # 可选，展开后追加到 params
+        "save_curves": false                             # 是否保存净值/成交列文件
+    }
+
+数据集可以是 pkl 文件（通过 features.load_features 使用持久化特征缓存）或 compact_dataset 保存的目录。
+"""
+
+import time
+
+_PROCESS_STARTED = time.perf_counter()  # 启动计时起点：导入 numpy/pandas 等模块之前
+
+import argparse
+import json
+import logging
+import os
+
+import pandas as pd
+
+from backtest import backtest_, resolve_params, setup_logging
+from config import INITIAL_PRINCIPAL
+from features import dataset_hash, load_features
+from results_store import ResultsStore, INDEXED_METRICS
+from walk_forward import expand_param_grid
+from worker_pool import process_pool
+
+_IMPORTED = time.perf_counter()
+
+# 工作进程内按路径缓存已加载的特征（内存映射，跨任务复用）
+_features_cache = {}
+
+
+def open_dataset(path):
+    """加载数据集特征：compact_dataset 目录直接解码，pkl 文件走特征缓存"""
+    if path not in _features_cache:
+        if os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json')):
+            from compact_dataset import CompactKlines
+            features = CompactKlines.open(path).to_features()
+            features.data_hash = dataset_hash(features)
+        else:
+            defaults = resolve_params()
+            features = load_features(path, volatility_bars=[int(defaults['VOLATILITY_WINDOW'] * 60)],
+                                     reset_intervals=[defaults['RESET_INTERVAL_SECONDS']])
+        _features_cache[path] = features
+    return _features_cache[path]
+
+
+def load_manifest(path):
+    """读取清单并展开为任务列表 [(数据集, 参数), ...]，数据集统一为 {'path', 'name', 'start', 'end'}"""
+    with open(path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    datasets = []
+    for entry in manifest['datasets']:
+        entry = {'path': entry} if isinstance(entry, str) else dict(entry)
+        entry['path'] = os.path.join(base_dir, entry['path'])
+        entry.setdefault('name', os.path.basename(entry['path']))
+        entry.setdefault('start', 0)
+        entry.setdefault('end', None)
+        datasets.append(entry)
+    param_sets = list(manifest.get('params', []))
+    if manifest.get('param_grid'):
+        param_sets += expand_param_grid(manifest['param_grid'])
+    if not param_sets:
+        param_sets = [{}]
+    tasks = [(dataset, params) for dataset in datasets for params in param_sets]
+    return manifest, tasks
+
+
+def run_task(task):
+    """执行单个回测任务，返回 (数据集, 参数, 数据集哈希, 结束下标, stats, 耗时, results_df, trades_df)"""
+    dataset, params, initial_balance, save_curves = task
+    features = open_dataset(dataset['path'])
+    end = len(features) if dataset['end'] is None else dataset['end']
+    started = time.perf_counter()
+    results_df, trades_df, stats = backtest_(None, initial_balance, params=params, start=dataset['start'],
+                                             end=end, features=features, show_progress=False)
+    elapsed = time.perf_counter() - started
+    if not save_curves:
+        results_df = trades_df = None
+    return dataset, params, features.data_hash, end, stats, elapsed, results_df, trades_df
+
+
+def measure_startup(dataset):
+    """测量从进程启动到处理完第一根K线的耗时（毫秒），分为 导入、数据就绪、第一根K线 三段"""
+    features = open_dataset(dataset['path'])
+    data_ready = time.perf_counter()
+    backtest_(None, 1.0, start=dataset['start'], end=dataset['start'] + 1, features=features, show_progress=False)
+    first_bar = time.perf_counter()
+    return {
+        'import_ms': (_IMPORTED - _PROCESS_STARTED) * 1000,
+        'data_ready_ms': (data_ready - _PROCESS_STARTED) * 1000,
+        'first_bar_ms': (first_bar - _PROCESS_STARTED) * 1000,
+    }
+
+
+def run_batch(manifest_path, workers=1, output=None, timing=False):
+    """执行清单中的全部任务，返回汇总 DataFrame（每个任务一行）"""
+    manifest, tasks = load_manifest(manifest_path)
+    output = output or manifest.get('output', 'batch_results')
+    initial_balance = manifest.get('initial_balance', INITIAL_PRINCIPAL)
+    save_curves = manifest.get('save_curves', False)
+
+    if timing:
+        startup = measure_startup(tasks[0][0])
+        logging.info(f"启动耗时：导入 {startup['import_ms']:.0f} ms，数据就绪 {startup['data_ready_ms']:.0f} ms，"
+                     f"第一根K线 {startup['first_bar_ms']:.0f} ms")
+
+    payloads = [(dataset, params, initial_balance, save_curves) for dataset, params in tasks]
+    logging.info(f"批量回测：{len(tasks)} 个任务，{workers} 个进程")
+    started = time.perf_counter()
+    if workers > 1:
+        # .env 已在本进程加载到环境变量中，工作进程无需再读取：Linux 下以 fork 启动时直接继承已导入的 config，
+        # spawn 启动（macOS/Windows）时重新导入 config 会看到该变量；只在进程池存续期间设置，不改动调用方的环境
+        with process_pool(max_workers=workers, env={'GRID_SKIP_DOTENV': '1'}) as pool:
+            outputs = list(pool.map(run_task, payloads))
+    else:
+        outputs = [run_task(payload) for payload in payloads]
+    elapsed = time.perf_counter() - started
+
+    store = ResultsStore(output)
+    rows = []
+    for dataset, params, data_hash, end, stats, run_elapsed, results_df, trades_df in outputs:
+        run_id = store.add_run(params, stats, data_hash, results_df, trades_df, run_elapsed, commit=False,
+                               start=dataset['start'], end=end, initial_balance=initial_balance)
+        row = {'run_id': run_id, 'dataset': dataset['name'], 'start': dataset['start'], 'end': end,
+               'params': json.dumps(params, sort_keys=True), 'elapsed': run_elapsed}
+        row.update({m: stats.get(m) for m in INDEXED_METRICS})
+        rows.append(row)
+    store.commit()
+    store.close()
+
+    summary = pd.DataFrame(rows)
+    summary.to_csv(os.path.join(output, 'summary.csv'), index=False)
+    logging.info(f"批量回测完成：耗时 {elapsed:.1f} 秒，结果已写入 {output}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量回测（无图形界面）")
+    parser.add_argument('manifest', help="清单文件（JSON）")
+    parser.add_argument('--workers', type=int, default=1, help="并行进程数")
+    parser.add_argument('--output', help="结果库目录（覆盖清单中的 output）")
+    parser.add_argument('--timing', action='store_true', help="报告导入到第一根K线的启动耗时")
+    args = parser.parse_args()
+    setup_logging()
+
+    summary = run_batch(args.manifest, workers=args.workers, output=args.output, timing=args.timing)
+    columns = ['dataset', 'params', 'total_trades', 'annual_return', 'max_drawdown', 'sharpe_ratio', 'final_balance']
+    print(summary[columns].to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+紧凑K线数据集
+
+下载器保存的 DataFrame 有12列（含字符串形式的 close_time/quote_volume/ignore 等和带时区的 open_time），
+而回测只需要收盘价（可选最高/最低价）和时间。CompactKlines 只保留这些列并压缩存储：
+- 时间：int64 纳秒时间戳做差分编码，差分按最大公约数缩放后用 int32 保存；
+  所有差分相同（K线无缺口）时只记录起点和步长，不保存数组；
+- 价格：默认按最小价格精度（小数位数）转换为 int32 整数保存，解码后与原始 float64 完全一致；
+  也可选择 float32（有精度损失）或保持 float64；
+- 保存为目录（meta.json + 每列一个 .npy），打开时只读元数据，各列在首次访问时才内存映射加载；
+- 时间戳完整性索引与 pkl 数据一样保存在目录旁的 <目录名>.integrity.json（kline_integrity.load_integrity）。
+
+features.compute_features 直接接受 CompactKlines，因此 backtest_、组合回测等入口都可以直接传入。
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from features import BacktestFeatures, compute_day_ids, normalize_klines, times_from_ns
+from kline_integrity import KlineIntegrity, integrity_path, load_integrity
+
+PRICE_COLUMNS = ('close_price', 'high_price', 'low_price')
+PRICE_MODES = ('auto', 'scaled', 'float32', 'float64')
+# 自动检测价格精度时尝试的最大小数位数
+MAX_DECIMALS = 8
+
+
+def encode_times(time_ns):
+    """差分编码时间戳，返回 (元数据, 差分数组或 None)；K线间隔恒定时差分数组为 None"""
+    time_ns = np.asarray(time_ns, dtype=np.int64)
+    meta = {'start_ns': int(time_ns[0]) if len(time_ns) else 0}
+    deltas = np.diff(time_ns)
+    if len(deltas) == 0 or (deltas == deltas[0]).all():
+        meta['step_ns'] = int(deltas[0]) if len(deltas) else 0
+        return meta, None
+    unit = int(np.gcd.reduce(deltas)) or 1
+    scaled = deltas // unit
+    dtype = np.int32 if np.abs(scaled).max() <= np.iinfo(np.int32).max else np.int64
+    meta['unit_ns'] = unit
+    return meta, scaled.astype(dtype)
+
+
+def decode_times(meta, deltas, n):
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    if deltas is None:
+        return meta['start_ns'] + np.arange(n, dtype=np.int64) * meta['step_ns']
+    time_ns = np.empty(n, dtype=np.int64)
+    time_ns[0] = meta['start_ns']
+    np.cumsum(deltas.astype(np.int64) * meta['unit_ns'], out=time_ns[1:])
+    time_ns[1:] += meta['start_ns']
+    return time_ns
+
+
+def detect_decimals(values, max_decimals=MAX_DECIMALS):
+    """返回能无损表示全部价格的最小小数位数（整数值除以 10^d 后与原值逐位相等），找不到返回 None"""
+    for decimals in range(max_decimals + 1):
+        scaled = np.rint(values * 10.0 ** decimals)
+        if np.abs(scaled).max(initial=0) > np.iinfo(np.int32).max:
+            return None
+        if np.array_equal(scaled / 10.0 ** decimals, values):
+            return decimals
+    return None
+
+
+def encode_prices(values, price_mode='auto', decimals=None):
+    """
+    编码价格列，返回 (元数据, 数组)：
+    - auto: 能无损转为 int32 定点数时用 scaled，否则保持 float64
+    - scaled: int32 定点数；decimals 为 None 时自动检测（无法无损表示时报错），指定时按该精度四舍五入
+    - float32 / float64: 直接转换
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if price_mode not in PRICE_MODES:
+        raise ValueError(f"不支持的价格存储方式: {price_mode}，可选 {PRICE_MODES}")
+    if price_mode in ('auto', 'scaled'):
+        if decimals is None:
+            decimals = detect_decimals(values)
+            if decimals is None and price_mode == 'scaled':
+                raise ValueError(f"价格无法用 {MAX_DECIMALS} 位以内小数的 int32 无损表示，请指定 decimals 或改用 float32")
+        if decimals is not None:
+            return {'encoding': 'scaled', 'decimals': decimals}, np.rint(values * 10.0 ** decimals).astype(np.int32)
+        price_mode = 'float64'
+    return {'encoding': price_mode}, values.astype(price_mode)
+
+
+def decode_prices(meta, raw):
+    if meta['encoding'] == 'scaled':
+        return raw / 10.0 ** meta['decimals']
+    return np.asarray(raw, dtype=np.float64)
+
+
+class CompactKlines:
+    """
+    紧凑存储的单个代币K线数据。
+
+    - from_dataframe(df): 从下载器 DataFrame 或示例数据构造
+    - save(directory) / open(directory): 按列保存，打开时各列延迟加载（内存映射）
+    - time_ns / times / column(name): 按需解码为 int64 时间戳、时间标签和 float64 价格
+    - to_features(): 转为回测使用的 BacktestFeatures
+    """
+
+    def __init__(self, n, tz, time_meta, column_meta, arrays=None, directory=None, integrity=None):
+        self.n = n
+        self.tz = tz
+        self.time_meta = time_meta
+        self.column_meta = column_meta
+        self.directory = directory
+        self._arrays = dict(arrays or {})
+        self._integrity = integrity
+
+    @classmethod
+    def from_dataframe(cls, df, price_mode='auto', decimals=None, columns=PRICE_COLUMNS):
+        """
+        columns 中不存在于 df 的列会被跳过（示例数据只有 close_price）。
+        与 compute_features 一样先按时间排序、去重（保留最后一条），保存的K线与直接回测 df 时一致。
+        """
+        df, _, dt_index, integrity = normalize_klines(df)
+        time_meta, deltas = encode_times(dt_index.asi8)
+        arrays = {} if deltas is None else {'time_deltas': deltas}
+        column_meta = {}
+        for name in columns:
+            if name in df.columns:
+                column_meta[name], arrays[name] = encode_prices(df[name].to_numpy(dtype=np.float64), price_mode, decimals)
+        if 'close_price' not in column_meta:
+            raise ValueError("数据中缺少 close_price 列")
+        tz = str(dt_index.tz) if dt_index.tz is not None else None
+        return cls(len(dt_index), tz, time_meta, column_meta, arrays, integrity=integrity)
+
+    @classmethod
+    def open(cls, directory):
+        """只读取元数据，各列在首次访问时才从 .npy 文件内存映射加载"""
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        return cls(meta['n'], meta['tz'], meta['time'], meta['columns'], directory=directory)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        names = list(self.column_meta) + (['time_deltas'] if 'step_ns' not in self.time_meta else [])
+        for name in names:
+            np.save(os.path.join(directory, f'{name}.npy'), np.ascontiguousarray(self._raw(name)))
+        meta = {'n': self.n, 'tz': self.tz, 'time': self.time_meta, 'columns': self.column_meta}
+        tmp_path = os.path.join(directory, f'.meta.{os.getpid()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(directory, 'meta.json'))
+        self.integrity.save(integrity_path(directory))
+
+    def __len__(self):
+        return self.n
+
+    def _raw(self, name):
+        if name not in self._arrays:
+            if self.directory is None:
+                raise KeyError(name)
+            self._arrays[name] = np.load(os.path.join(self.directory, f'{name}.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    @property
+    def columns(self):
+        return list(self.column_meta)
+
+    @property
+    def constant_step(self):
+        """K线间隔恒定（无缺口）时返回步长纳秒数，否则返回 None"""
+        return self.time_meta.get('step_ns')
+
+    @property
+    def nbytes(self):
+        """当前已加载的编码数据占用的字节数"""
+        return sum(arr.nbytes for arr in self._arrays.values())
+
+    @property
+    def time_ns(self):
+        deltas = None if self.constant_step is not None else self._raw('time_deltas')
+        return decode_times(self.time_meta, deltas, self.n)
+
+    @property
+    def times(self):
+        return times_from_ns(self.time_ns, self.tz)
+
+    @property
+    def integrity(self):
+        """时间戳完整性索引（kline_integrity.KlineIntegrity）：已保存的数据集读取目录旁的索引文件，否则首次访问时构建"""
+        if self._integrity is None:
+            if self.directory is not None:
+                self._integrity = load_integrity(self.directory, self.time_ns)
+            else:
+                self._integrity = KlineIntegrity.build(self.time_ns)
+        return self._integrity
+
+    def column(self, name):
+        """解码为 float64 的价格列"""
+        if name not in self.column_meta:
+            raise KeyError(name)
+        return decode_prices(self.column_meta[name], self._raw(name))
+
+    def to_features(self):
+        time_ns = self.time_ns
+        times = times_from_ns(time_ns, self.tz)
+        prices = self.column('close_price')
+        return BacktestFeatures(
+            times=times,
+            time_ns=time_ns,
+            prices=prices,
+            log_returns=np.diff(np.log(prices)),
+            day_ids=compute_day_ids(times),
+            integrity=self.integrity,
+        )
+
+
+if __name__ == "__main__":
+    import time
+
+    from backtest import backtest_
+
+    pkl_file = "BNBUSDT_BINANCE_2025-01-01_00_00_00_2025-05-19_23_59_59.pkl"
+    df = pd.read_pickle(pkl_file)
+    compact = CompactKlines.from_dataframe(df)
+    compact.save(pkl_file + '.compact')
+    compact = CompactKlines.open(pkl_file + '.compact')
+
+    df_bytes = df.memory_usage(deep=True).sum()
+    _ = compact.column('close_price')
+    print(f"DataFrame: {df_bytes / 1e6:.1f} MB，紧凑格式: {compact.nbytes / 1e6:.1f} MB（{df_bytes / max(compact.nbytes, 1):.1f} 倍）")
+    print(f"时间间隔恒定: {compact.constant_step is not None}，价格编码: {compact.column_meta}")
+
+    t0 = time.perf_counter()
+    _, _, stats_df = backtest_(df, show_progress=False)
+    _, _, stats_compact = backtest_(compact, show_progress=False)
+    print(f"回测结果一致: {stats_df == stats_compact}（{time.perf_counter() - t0:.1f} 秒）")
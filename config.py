@@ -1,8 +1,15 @@
 import os
-from dotenv import load_dotenv
 import logging
 
-load_dotenv()
+# 从 .env 读取环境变量；设置 GRID_SKIP_DOTENV=1（或 true）可跳过（批量回测/工作进程中环境变量已就绪时减少启动开销），
+# 0、false 等其他取值仍会读取；未安装 python-dotenv 时只使用已有的环境变量
+if os.getenv('GRID_SKIP_DOTENV', '').strip().lower() not in ('1', 'true'):
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        pass
+    else:
+        load_dotenv()
 
 SYMBOL = 'BNB/USDT'
 INITIAL_GRID = 2.0
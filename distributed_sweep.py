@@ -0,0 +1,471 @@
+"""
+分布式参数扫描：可插拔工作队列 + 多节点 worker
+
+- 每个任务由 数据切片 id（数据集内容哈希 + 下标区间）、参数组合、初始资金和引擎版本确定，任务 id 为它们的内容哈希，
+  重复发布同一任务不会产生重复计算，重复上报结果也只保留第一份（幂等）；
+- 队列后端可插拔：
+  * SQLiteQueue：本地文件队列，同一台机器或共享文件系统上的多个进程直接使用；
+  * QueueBroker + TcpQueue：简单的 TCP 中转服务（JSON 行协议），其他节点的 worker 通过网络拉取任务；
+- worker 领取任务时获得一个租约，超时未上报（进程崩溃、节点失联）的任务会被重新分配，最多重试 max_attempts 次。
+
+命令行：
+    python distributed_sweep.py broker --db sweep.db --host 127.0.0.1 --port 8765
+    python distributed_sweep.py worker --queue tcp://127.0.0.1:8765
+    python distributed_sweep.py worker --queue sweep.db
+    python distributed_sweep.py publish --queue tcp://127.0.0.1:8765 --data BNBUSDT.pkl --grid grid.json
+    python distributed_sweep.py collect --queue tcp://127.0.0.1:8765 --data BNBUSDT.pkl --grid grid.json --output sweep.csv
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from backtest import ENGINE_VERSION, resolve_params
+from config import INITIAL_PRINCIPAL
+from features import dataset_hash, load_features
+from walk_forward import expand_param_grid
+from worker_pool import backtest_window
+
+
+def to_jsonable(value):
+    """把 stats 中的 numpy 标量/数组转换为可 JSON 序列化的 Python 对象"""
+    if isinstance(value, dict):
+        return {k: to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def make_task_id(slice_id, params, initial_balance=None, engine_version=ENGINE_VERSION):
+    """
+    任务 id = 数据切片 id、参数组合、初始资金与引擎版本的内容哈希（与 results_store.make_run_id 一致），
+    同一网格以不同初始资金重新发布时得到新的任务，而不是复用其他资金的结果
+    """
+    payload = json.dumps({'dataset': slice_id, 'params': params,
+                          'initial_balance': None if initial_balance is None else float(initial_balance),
+                          'engine': engine_version}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def check_params(params):
+    """
+    任务参数要原样传到其他节点，必须能 JSON 序列化；
+    函数等对象（如 config 中 FLIP_THRESHOLD 的 lambda）会被转成字符串而失去含义，直接拒绝
+    """
+    try:
+        json.dumps(params, sort_keys=True)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"参数无法 JSON 序列化，不能作为分布式任务发布：{params}（{e}）；"
+                         f"FLIP_THRESHOLD 请传入数值倍数而不是函数") from None
+
+
+def make_tasks(dataset_path, param_grid, start=0, end=None, initial_balance=INITIAL_PRINCIPAL, features=None):
+    """
+    为一个数据文件和参数网格生成任务列表。
+    dataset_path 需要在所有 worker 节点上可访问（共享存储或相同路径的副本），worker 会校验数据哈希。
+    """
+    if features is None:
+        features = load_features(dataset_path)
+    if end is None:
+        end = len(features)
+    data_id = getattr(features, 'data_hash', None) or dataset_hash(features)
+    slice_id = f"{data_id}:{start}:{end}"
+    candidates = expand_param_grid(param_grid) if isinstance(param_grid, dict) else list(param_grid)
+    for params in candidates:
+        check_params(params)
+    return [{
+        'task_id': make_task_id(slice_id, params, initial_balance),
+        'dataset_path': dataset_path,
+        'dataset_id': data_id,
+        'start': start,
+        'end': end,
+        'params': params,
+        'initial_balance': initial_balance,
+    } for params in candidates]
+
+
+class SQLiteQueue:
+    """
+    基于 SQLite 的本地任务队列。
+    tasks 表记录任务状态（pending / running / done / failed）、领取次数和租约到期时间；
+    results 表以 task_id 为主键保存结果，重复上报自动忽略。
+    """
+
+    def __init__(self, path, lease_seconds=600, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_until REAL NOT NULL DEFAULT 0,
+                worker TEXT,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, lease_until);
+            CREATE TABLE IF NOT EXISTS results (
+                task_id TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                worker TEXT,
+                finished_at REAL NOT NULL
+            );
+        """)
+
+    def publish(self, tasks):
+        """发布任务，已存在的任务 id 直接跳过，返回新增任务数"""
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany("INSERT OR IGNORE INTO tasks (task_id, payload) VALUES (?, ?)",
+                                   [(t['task_id'], json.dumps(t)) for t in tasks])
+            self._conn.execute("COMMIT")
+            return self._conn.total_changes - before
+
+    def claim(self, worker_id):
+        """领取一个待处理或租约已过期的任务，没有任务时返回 None"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 租约过期且已用完重试次数的任务标记为失败
+                self._conn.execute("UPDATE tasks SET status = 'failed', error = 'lease expired' "
+                                   "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                                   (now, self.max_attempts))
+                row = self._conn.execute(
+                    "SELECT task_id, payload FROM tasks "
+                    "WHERE status = 'pending' OR (status = 'running' AND lease_until < ?) LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    return None
+                self._conn.execute("UPDATE tasks SET status = 'running', attempts = attempts + 1, lease_until = ?, worker = ? "
+                                   "WHERE task_id = ?", (now + self.lease_seconds, worker_id, row[0]))
+                return json.loads(row[1])
+            finally:
+                self._conn.execute("COMMIT")
+
+    def complete(self, task_id, result, worker_id=None):
+        """上报结果（幂等：同一任务只保留第一份结果）"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("INSERT OR IGNORE INTO results (task_id, result, worker, finished_at) VALUES (?, ?, ?, ?)",
+                               (task_id, json.dumps(to_jsonable(result)), worker_id, time.time()))
+            self._conn.execute("UPDATE tasks SET status = 'done' WHERE task_id = ?", (task_id,))
+            self._conn.execute("COMMIT")
+
+    def fail(self, task_id, error, worker_id=None):
+        """任务执行出错：未达到重试上限则放回队列，否则标记为失败"""
+        with self._lock:
+            self._conn.execute("UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                               "error = ?, lease_until = 0 WHERE task_id = ? AND status = 'running'",
+                               (self.max_attempts, str(error), task_id))
+
+    def counts(self, task_ids=None):
+        """各状态的任务数量；指定 task_ids 时只统计这些任务"""
+        with self._lock:
+            if task_ids is None:
+                return dict(self._conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+            rows = self._conn.execute("SELECT task_id, status FROM tasks").fetchall()
+        counts = {}
+        wanted = set(task_ids)
+        for tid, status in rows:
+            if tid in wanted:
+                counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def results(self, task_ids=None):
+        """读取结果 {task_id: result}"""
+        with self._lock:
+            rows = self._conn.execute("SELECT task_id, result FROM results").fetchall()
+        wanted = set(task_ids) if task_ids is not None else None
+        return {tid: json.loads(r) for tid, r in rows if wanted is None or tid in wanted}
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        queue = self.server.queue
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                op = request['op']
+                if op == 'publish':
+                    response = {'ok': True, 'value': queue.publish(request['tasks'])}
+                elif op == 'claim':
+                    response = {'ok': True, 'value': queue.claim(request['worker_id'])}
+                elif op == 'complete':
+                    queue.complete(request['task_id'], request['result'], request.get('worker_id'))
+                    response = {'ok': True, 'value': None}
+                elif op == 'fail':
+                    queue.fail(request['task_id'], request['error'], request.get('worker_id'))
+                    response = {'ok': True, 'value': None}
+                elif op == 'counts':
+                    response = {'ok': True, 'value': queue.counts(request.get('task_ids'))}
+                elif op == 'results':
+                    response = {'ok': True, 'value': queue.results(request.get('task_ids'))}
+                else:
+                    response = {'ok': False, 'error': f"未知操作: {op}"}
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class QueueBroker(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    TCP 队列中转服务：把任意本地队列（通常是 SQLiteQueue）暴露给其他节点，
+    协议为每行一个 JSON 请求/响应。测试时可绑定 127.0.0.1 并用 port=0 自动分配端口。
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, queue, host='127.0.0.1', port=8765):
+        self.queue = queue
+        super().__init__((host, port), _BrokerHandler)
+
+    @property
+    def address(self):
+        host, port = self.server_address[:2]
+        return f"tcp://{host}:{port}"
+
+    def start(self):
+        """在后台线程中运行服务，返回线程对象"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class TcpQueue:
+    """QueueBroker 的客户端，接口与 SQLiteQueue 相同"""
+
+    def __init__(self, host='127.0.0.1', port=8765, timeout=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._file = self._sock.makefile('rwb')
+
+    def _request(self, **request):
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._file.write((json.dumps(request) + '\n').encode('utf-8'))
+                    self._file.flush()
+                    line = self._file.readline()
+                    if not line:
+                        raise ConnectionError("broker 连接已关闭")
+                    break
+                except OSError:
+                    # 连接断开后重连一次
+                    self.close()
+                    if attempt:
+                        raise
+        response = json.loads(line)
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response['value']
+
+    def publish(self, tasks):
+        return self._request(op='publish', tasks=tasks)
+
+    def claim(self, worker_id):
+        return self._request(op='claim', worker_id=worker_id)
+
+    def complete(self, task_id, result, worker_id=None):
+        self._request(op='complete', task_id=task_id, result=to_jsonable(result), worker_id=worker_id)
+
+    def fail(self, task_id, error, worker_id=None):
+        self._request(op='fail', task_id=task_id, error=str(error), worker_id=worker_id)
+
+    def counts(self, task_ids=None):
+        return self._request(op='counts', task_ids=task_ids)
+
+    def results(self, task_ids=None):
+        return self._request(op='results', task_ids=task_ids)
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock = None
+                self._file = None
+
+
+def open_queue(spec, **kwargs):
+    """按地址打开队列：'tcp://host:port' 连接 broker，其他视为 SQLite 文件路径"""
+    if spec.startswith('tcp://'):
+        host, port = spec[len('tcp://'):].rsplit(':', 1)
+        return TcpQueue(host, int(port))
+    return SQLiteQueue(spec, **kwargs)
+
+
+def run_task(task, features_cache):
+    """
+    执行单个回测任务，特征取自数据文件旁的持久化缓存，并在 worker 内存中复用；
+    每个任务按自己的参数确保所需的波动率窗口和重置间隔已写入缓存（不同任务的参数可以不同）
+    """
+    path = task['dataset_path']
+    params = resolve_params(task['params'])
+    bars = int(params['VOLATILITY_WINDOW'] * 60)
+    reset = params['RESET_INTERVAL_SECONDS']
+    features = features_cache.get(path)
+    if features is None or f'volatility_{bars}' not in features.extras or f'reset_{reset}' not in features.extras:
+        loaded = load_features(path, [bars], [reset])
+        if features is None or features.data_hash != loaded.data_hash:
+            features = features_cache[path] = loaded
+        else:
+            features.extras.update(loaded.extras)
+    if features.data_hash != task['dataset_id']:
+        raise ValueError(f"数据文件 {path} 的内容与任务中的数据集 id 不一致")
+    started = time.perf_counter()
+    stats, _, _ = backtest_window(features, task['start'], task['end'], task['params'], task['initial_balance'])
+    tz = str(features.times.tz) if getattr(features.times, 'tz', None) is not None else None
+    return {'params': task['params'], 'dataset_id': task['dataset_id'], 'start': task['start'], 'end': task['end'],
+            'initial_balance': task['initial_balance'], 'tz': tz, 'stats': stats, 'elapsed': time.perf_counter() - started}
+
+
+def run_worker(queue, worker_id=None, max_tasks=None, idle_timeout=None, poll_interval=1.0):
+    """
+    worker 主循环：不断领取任务、执行回测并上报结果。
+    idle_timeout 秒内没有领到任务时退出（None 表示一直等待），返回完成的任务数。
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    features_cache = {}
+    done = 0
+    idle_since = time.monotonic()
+    while max_tasks is None or done < max_tasks:
+        task = queue.claim(worker_id)
+        if task is None:
+            if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                break
+            time.sleep(poll_interval)
+            continue
+        try:
+            result = run_task(task, features_cache)
+        except Exception as e:
+            logging.exception(f"任务 {task['task_id']} 执行失败")
+            queue.fail(task['task_id'], e, worker_id)
+        else:
+            queue.complete(task['task_id'], result, worker_id)
+            done += 1
+        idle_since = time.monotonic()
+    logging.info(f"worker {worker_id} 退出，共完成 {done} 个任务")
+    return done
+
+
+def wait_for_results(queue, task_ids, poll_interval=1.0, timeout=None):
+    """等待指定任务全部完成（或失败），返回 {task_id: result}；队列中其他扫描的任务不影响判断"""
+    started = time.monotonic()
+    task_ids = list(task_ids)
+    while True:
+        results = queue.results(task_ids)
+        counts = queue.counts(task_ids)
+        if len(results) + counts.get('failed', 0) >= len(task_ids):
+            return results
+        if timeout is not None and time.monotonic() - started >= timeout:
+            raise TimeoutError(f"等待超时：已完成 {len(results)}/{len(task_ids)}")
+        time.sleep(poll_interval)
+
+
+def load_grid(spec):
+    """参数网格：JSON 文件路径或 JSON 字符串，内容为 {参数名: [候选值]} 或参数字典列表"""
+    if os.path.exists(spec):
+        with open(spec, encoding='utf-8') as f:
+            return json.load(f)
+    return json.loads(spec)
+
+
+def results_frame(results):
+    """把 {task_id: result} 展开为每个任务一行的 DataFrame（参数列 + 标量指标列）"""
+    rows = []
+    for task_id, result in results.items():
+        row = {'task_id': task_id}
+        row.update(result['params'])
+        row.update({k: v for k, v in result['stats'].items() if not isinstance(v, (dict, list))})
+        row['elapsed'] = result.get('elapsed')
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser(description="分布式参数扫描")
+    sub = parser.add_subparsers(dest='command', required=True)
+    broker_parser = sub.add_parser('broker', help="启动 TCP 队列服务")
+    broker_parser.add_argument('--db', default='sweep.db')
+    broker_parser.add_argument('--host', default='127.0.0.1')
+    broker_parser.add_argument('--port', type=int, default=8765)
+    broker_parser.add_argument('--lease', type=float, default=600, help="任务租约秒数，超时未完成则重新分配")
+    worker_parser = sub.add_parser('worker', help="启动 worker")
+    worker_parser.add_argument('--queue', required=True, help="tcp://host:port 或 SQLite 文件路径")
+    worker_parser.add_argument('--idle-timeout', type=float, default=None)
+    publish_parser = sub.add_parser('publish', help="为数据文件和参数网格发布任务")
+    collect_parser = sub.add_parser('collect', help="等待同一组任务完成并汇总结果")
+    for task_parser in (publish_parser, collect_parser):
+        task_parser.add_argument('--queue', required=True, help="tcp://host:port 或 SQLite 文件路径")
+        task_parser.add_argument('--data', required=True, help="数据文件路径（所有 worker 节点上路径相同）")
+        task_parser.add_argument('--grid', required=True, help="参数网格 JSON 文件或 JSON 字符串")
+        task_parser.add_argument('--start', type=int, default=0, help="回测起始下标")
+        task_parser.add_argument('--end', type=int, default=None, help="回测结束下标（不含）")
+        task_parser.add_argument('--initial-balance', type=float, default=INITIAL_PRINCIPAL)
+    collect_parser.add_argument('--timeout', type=float, default=None, help="最长等待秒数")
+    collect_parser.add_argument('--output', help="结果 CSV 路径")
+    collect_parser.add_argument('--store', help="同时写入结果库目录（见 results_store.py）")
+    args = parser.parse_args()
+
+    if args.command == 'broker':
+        broker = QueueBroker(SQLiteQueue(args.db, lease_seconds=args.lease), args.host, args.port)
+        logging.info(f"队列服务已启动: {broker.address}")
+        broker.serve_forever()
+    elif args.command == 'worker':
+        run_worker(open_queue(args.queue), idle_timeout=args.idle_timeout)
+    else:
+        # publish 与 collect 用相同的参数重新生成任务，任务 id 由内容决定，两边一致
+        queue = open_queue(args.queue)
+        tasks = make_tasks(args.data, load_grid(args.grid), args.start, args.end, args.initial_balance)
+        task_ids = [t['task_id'] for t in tasks]
+        if args.command == 'publish':
+            added = queue.publish(tasks)
+            logging.info(f"已发布 {added} 个新任务（共 {len(tasks)} 个，其余已在队列中）")
+            return
+        results = wait_for_results(queue, task_ids, timeout=args.timeout)
+        failed = queue.counts(task_ids).get('failed', 0)
+        logging.info(f"已完成 {len(results)}/{len(tasks)} 个任务，失败 {failed} 个")
+        if args.store:
+            from results_store import ResultsStore
+            store = ResultsStore(args.store)
+            store.add_sweep_results(results)
+            store.close()
+        summary = results_frame(results)
+        if args.output:
+            summary.to_csv(args.output, index=False)
+        print(summary.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from kline_integrity import KlineIntegrity, load_integrity, repair_klines
+
+NS_PER_SECOND = 1_000_000_000
+NS_PER_DAY = 86400 * NS_PER_SECOND
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class BacktestFeatures:
+    """
+    回测输入的预计算特征，与策略参数无关，可在多次回测/多个窗口之间复用：
+    - times:       原始时间标签（用于输出结果和成交记录）
+    - time_ns:     int64 纳秒时间戳（带时区数据为UTC时间，用于计算时间间隔）
+    - prices:      收盘价 float64 数组
+    - log_returns: 对数收益率，log_returns[k] = log(prices[k+1]) - log(prices[k])
+    - day_ids:     按本地日期划分的自然日编号（用于 S1 昨日高低点）
+    - extras:      与窗口参数相关的派生特征（滚动波动率、基准价重置点），按需计算并缓存，
+                   键名如 'volatility_1440'、'reset_86400'
+    - integrity:   时间戳的完整性索引（kline_integrity.KlineIntegrity），首次访问时构建
+    """
+
+    def __init__(self, times, time_ns, prices, log_returns, day_ids, extras=None, integrity=None):
+        self.times = times
+        self.time_ns = time_ns
+        self.prices = prices
+        self.log_returns = log_returns
+        self.day_ids = day_ids
+        self.extras = extras if extras is not None else {}
+        self._integrity = integrity
+
+    def __len__(self):
+        return len(self.prices)
+
+    @property
+    def integrity(self):
+        if self._integrity is None:
+            self._integrity = KlineIntegrity.build(self.time_ns)
+        return self._integrity
+
+    def get_volatility(self, bars_for_vol):
+        """
+        第 i 根K线的滚动年化波动率（样本不足处为 NaN），同一窗口只计算一次。
+        K线有缺口时按时间取窗口（rolling_volatility_by_time），无缺口时两者结果相同。
+        """
+        key = f'volatility_{bars_for_vol}'
+        if key not in self.extras:
+            integrity = self.integrity
+            if len(integrity.gaps):
+                self.extras[key] = rolling_volatility_by_time(self.time_ns, self.log_returns, bars_for_vol, integrity.step_ns)
+            else:
+                self.extras[key] = rolling_volatility(self.log_returns, bars_for_vol)
+        return self.extras[key]
+
+    def get_reset_points(self, reset_interval_seconds, start=0, end=None):
+        """
+        回测窗口 [start, end) 内定时重置基准价的K线下标。
+        重置只取决于时间戳：从窗口首根K线起，每当距上次重置满 reset_interval_seconds 即重置一次。
+        从下标 0 开始的重置点会被缓存，其他起点按需计算。
+        """
+        end = len(self) if end is None else end
+        if start == 0:
+            key = f'reset_{reset_interval_seconds}'
+            if key not in self.extras:
+                self.extras[key] = compute_reset_points(self.time_ns, reset_interval_seconds, 0, len(self))
+            points = self.extras[key]
+            return points[:np.searchsorted(points, end)]
+        return compute_reset_points(self.time_ns, reset_interval_seconds, start, end)
+
+
+def extract_times(df):
+    """
+    取出 DataFrame 的时间标签：
+    使用 history_kline_downloader.py 生成的数据时，时间是 df['open_time']；
+    使用自带的示例数据时 df.index 就是时间索引
+    """
+    if df.index[0] == 0 and 'open_time' in df.columns:
+        return pd.Index(df['open_time'])
+    return df.index
+
+
+def to_datetime_index(times):
+    """将时间标签（Timestamp 或 '%Y-%m-%d %H:%M:%S' 字符串）转为 DatetimeIndex"""
+    if isinstance(times, pd.DatetimeIndex):
+        return times
+    if len(times) and isinstance(times[0], str):
+        return pd.DatetimeIndex(pd.to_datetime(times, format=TIME_FORMAT))
+    return pd.DatetimeIndex(times)
+
+
+def compute_day_ids(dt_index):
+    """按本地日期（带时区时取当地时间）计算自然日编号"""
+    if dt_index.tz is not None:
+        dt_index = dt_index.tz_localize(None)
+    return dt_index.asi8 // NS_PER_DAY
+
+
+def normalize_klines(df):
+    """
+    按时间排序、去重（重复时间戳保留最后一条）K线，返回 (df, 时间标签, DatetimeIndex, KlineIntegrity)。
+    compute_features 和 compact_dataset.CompactKlines.from_dataframe 共用，保证两条路径得到相同的K线。
+    """
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()  # 确保按时间顺序
+    times = extract_times(df)
+    dt_index = to_datetime_index(times)
+    integrity = KlineIntegrity.build(dt_index.asi8)
+    if not integrity.is_sorted:
+        logging.warning(f"K线时间戳有重复或倒序，已排序去重: {integrity.summary()}")
+        df = repair_klines(df)
+        times = extract_times(df)
+        dt_index = to_datetime_index(times)
+        integrity = KlineIntegrity.build(dt_index.asi8)
+    return df, times, dt_index, integrity
+
+
+def compute_features(df):
+    """
+    从 K 线 DataFrame 计算回测所需的全部特征，只做一次即可供任意参数、任意窗口的回测使用；
+    也接受 compact_dataset.CompactKlines（由其自行解码）。
+    时间戳有重复或倒序时按时间排序并去重（保留最后一条）后再计算（见 normalize_klines）。
+    """
+    if hasattr(df, 'to_features'):
+        return df.to_features()
+    df, times, dt_index, integrity = normalize_klines(df)
+    prices = np.ascontiguousarray(df['close_price'].to_numpy(dtype=np.float64))
+    log_returns = np.diff(np.log(prices))
+    return BacktestFeatures(
+        times=times,
+        time_ns=dt_index.asi8,
+        prices=prices,
+        log_returns=log_returns,
+        day_ids=compute_day_ids(dt_index),
+        integrity=integrity,
+    )
+
+
+def compute_reset_points(time_ns, reset_interval_seconds, start, end):
+    """计算 [start, end) 内的基准价重置下标（时间戳需递增），每次重置用 searchsorted 跳到下一个重置点"""
+    interval_ns = int(reset_interval_seconds * NS_PER_SECOND)
+    points = []
+    last = start
+    while True:
+        nxt = int(np.searchsorted(time_ns, time_ns[last] + interval_ns, side='left'))
+        nxt = max(nxt, last + 1)
+        if nxt >= end:
+            break
+        points.append(nxt)
+        last = nxt
+    return np.array(points, dtype=np.int64)
+
+
+def rolling_volatility(log_returns, bars_for_vol):
+    """
+    与 backtest_ 中逐笔计算一致的滚动年化波动率：第 i 根K线使用 log_returns[i-bars_for_vol+1:i]
+    （即最近 bars_for_vol 个价格）的标准差 * sqrt(1440*365)。
+    支持一维（单个代币）或二维（K线 x 代币）输入，按第 0 维滚动；返回长度为 K线数，样本不足处为 NaN。
+    用累加和一次性计算，避免逐窗口求标准差。
+    """
+    log_returns = np.asarray(log_returns, dtype=np.float64)
+    n_bars = log_returns.shape[0] + 1
+    window = bars_for_vol - 1
+    out = np.full((n_bars,) + log_returns.shape[1:], np.nan)
+    if window <= 0 or n_bars <= bars_for_vol:
+        return out
+    zero = np.zeros((1,) + log_returns.shape[1:])
+    csum = np.concatenate([zero, np.cumsum(log_returns, axis=0)])
+    csum_sq = np.concatenate([zero, np.cumsum(log_returns * log_returns, axis=0)])
+    # 第 i 根K线的窗口为 log_returns[i-window:i]
+    win_sum = csum[window:] - csum[:n_bars - window]
+    win_sum_sq = csum_sq[window:] - csum_sq[:n_bars - window]
+    mean = win_sum / window
+    var = np.maximum(win_sum_sq / window - mean * mean, 0.0)
+    out[bars_for_vol:] = np.sqrt(var[1:]) * np.sqrt(1440 * 365)
+    return out
+
+
+def rolling_volatility_by_time(time_ns, log_returns, bars_for_vol, step_ns):
+    """
+    按时间取窗口的滚动年化波动率，用于有缺口的K线：第 i 根K线使用时间落在 (bars_for_vol-1) 个周期内的收益率，
+    窗口起点用 searchsorted 得到；跨缺口的收益率按实际经过的周期数计入方差（方差 = 平方和/周期数 - 均值^2），
+    样本是否足够也按时间判断（距首根K线至少 bars_for_vol 个周期）。
+    K线连续时与 rolling_volatility 结果相同。时间戳需递增。
+    """
+    time_ns = np.asarray(time_ns, dtype=np.int64)
+    log_returns = np.asarray(log_returns, dtype=np.float64)
+    n_bars = len(time_ns)
+    out = np.full(n_bars, np.nan)
+    if bars_for_vol <= 1 or step_ns <= 0 or n_bars < 2:
+        return out
+    csum = np.concatenate([[0.0], np.cumsum(log_returns)])
+    csum_sq = np.concatenate([[0.0], np.cumsum(log_returns * log_returns)])
+    idx = np.arange(n_bars)
+    starts = np.searchsorted(time_ns, time_ns - (bars_for_vol - 1) * step_ns, side='left')
+    periods = (time_ns - time_ns[starts]) / step_ns
+    valid = (time_ns - time_ns[0] >= bars_for_vol * step_ns) & (periods > 0)
+    idx, starts, periods = idx[valid], starts[valid], periods[valid]
+    mean = (csum[idx] - csum[starts]) / periods
+    var = np.maximum((csum_sq[idx] - csum_sq[starts]) / periods - mean * mean, 0.0)
+    out[idx] = np.sqrt(var) * np.sqrt(1440 * 365)
+    return out
+
+
+def dataset_hash(features):
+    """按时间戳和收盘价内容计算数据集哈希，数据任何变动都会得到不同的 id"""
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(features.time_ns, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(features.prices, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+FEATURE_CACHE_VERSION = 2
+_BASE_ARRAYS = ('time_ns', 'prices', 'log_returns', 'day_ids')
+
+
+def _cache_dir(data_path):
+    return data_path + '.features'
+
+
+def _tmp_suffix():
+    """临时文件名后缀：进程号 + 随机串，同一进程内的多个线程也不会冲突"""
+    return f'{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp'
+
+
+def _save_array(directory, name, arr):
+    """先写临时文件再改名，避免其他进程读到写了一半的文件"""
+    tmp_path = os.path.join(directory, f'.{name}.{_tmp_suffix()}.npy')
+    np.save(tmp_path, np.ascontiguousarray(arr))
+    os.replace(tmp_path, os.path.join(directory, f'{name}.npy'))
+
+
+def _load_array(directory, name):
+    return np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+
+
+def times_from_ns(time_ns, tz):
+    """由 int64 纳秒时间戳重建时间标签：tz 不为空时时间戳按 UTC 解释并转换到该时区"""
+    times = pd.DatetimeIndex(np.asarray(time_ns))
+    if tz:
+        times = times.tz_localize('UTC').tz_convert(tz)
+    return times
+
+
+def load_features(data_path, volatility_bars=(), reset_intervals=(), read_data=pd.read_pickle, cleanup=False):
+    """
+    读取K线数据文件对应的特征，结果以内存映射的 .npy 文件缓存在数据文件旁的 <文件名>.features/<数据哈希>/ 目录：
+    - 数据文件大小和修改时间未变时直接映射缓存，不读取原始数据；
+    - 数据文件变动后重新读取并计算哈希，内容未变则继续使用旧缓存，内容变化则重新计算；
+    - 哈希目录先写到临时目录再整体改名，多个进程同时加载同一文件时看到的缓存目录总是完整的；
+    - cleanup=True 时删除其他哈希的旧缓存和遗留的临时目录（可能仍被其他进程映射，只在没有其他进程使用该缓存时开启）；
+    - volatility_bars / reset_intervals 指定需要预先算好的滚动波动率窗口（K线数）和基准价重置间隔（秒），
+      缺失的会计算后写入缓存；回测中用到其他窗口时仍会按需计算（仅缓存在内存中）。
+    - 时间戳完整性索引读取数据文件旁的 <文件名>.integrity.json（kline_integrity.load_integrity，与下载器写入的是同一个文件），
+      不存在或与数据不符时重新构建并保存。
+    原始时间标签以 DatetimeIndex 重建（时间字符串会还原为同一时刻的 Timestamp）。
+    """
+    cache_root = _cache_dir(data_path)
+    os.makedirs(cache_root, exist_ok=True)
+    source_path = os.path.join(cache_root, 'source.json')
+    stat = os.stat(data_path)
+    source = {}
+    if os.path.exists(source_path):
+        with open(source_path, encoding='utf-8') as f:
+            source = json.load(f)
+
+    if (source.get('version') == FEATURE_CACHE_VERSION and source.get('size') == stat.st_size
+            and source.get('mtime_ns') == stat.st_mtime_ns
+            and os.path.isdir(os.path.join(cache_root, source.get('data_hash', '')))):
+        data_hash = source['data_hash']
+        tz = source.get('tz')
+    else:
+        features = compute_features(read_data(data_path))
+        data_hash = dataset_hash(features)
+        tz = str(features.times.tz) if getattr(features.times, 'tz', None) is not None else None
+        directory = os.path.join(cache_root, data_hash)
+        if not os.path.isdir(directory):
+            tmp_dir = os.path.join(cache_root, f'.{data_hash}.{_tmp_suffix()}')
+            os.makedirs(tmp_dir)
+            for name in _BASE_ARRAYS:
+                _save_array(tmp_dir, name, getattr(features, name))
+            try:
+                os.replace(tmp_dir, directory)
+            except OSError:
+                # 其他进程已先写好同一份缓存
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_path = source_path + f'.{_tmp_suffix()}'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': FEATURE_CACHE_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                       'data_hash': data_hash, 'tz': tz}, f)
+        os.replace(tmp_path, source_path)
+
+    if cleanup:
+        for name in os.listdir(cache_root):
+            if name != data_hash and os.path.isdir(os.path.join(cache_root, name)):
+                shutil.rmtree(os.path.join(cache_root, name), ignore_errors=True)
+
+    directory = os.path.join(cache_root, data_hash)
+    arrays = {name: _load_array(directory, name) for name in _BASE_ARRAYS}
+    integrity = load_integrity(data_path, arrays['time_ns'])
+    features = BacktestFeatures(times=times_from_ns(arrays['time_ns'], tz), integrity=integrity, **arrays)
+    features.data_hash = data_hash
+
+    # 派生特征：缺失则计算并写入缓存，已有的直接内存映射
+    wanted = [f'volatility_{bars}' for bars in volatility_bars] + [f'reset_{seconds}' for seconds in reset_intervals]
+    for key in wanted:
+        path = os.path.join(directory, f'{key}.npy')
+        if os.path.exists(path):
+            features.extras[key] = np.load(path, mmap_mode='r')
+            continue
+        kind, value = key.split('_', 1)
+        arr = features.get_volatility(int(value)) if kind == 'volatility' else features.get_reset_points(float(value) if '.' in value else int(value))
+        _save_array(directory, key, arr)
+        features.extras[key] = _load_array(directory, key)
+    return features
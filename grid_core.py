@@ -0,0 +1,349 @@
+"""
+网格策略的公共计算
+
+- 仓位与网格规则（凯利仓位、波动率→网格大小、波动率→调整间隔）以向量化形式实现一次，
+  传入标量时返回 0 维数组，可当作普通浮点数使用；portfolio_backtest 按代币直接调用；
+- step 是单根K线的完整决策（定时重置基准价、日线高低点、买入/卖出监控、翻转阈值、动态网格、S1、风控），
+  backtest_、grid_strategy.GridStrategy（逐根行情驱动）和 monte_carlo.batch_backtest（按路径批量）都调用它，
+  策略逻辑只有这一份。状态存放在 GridState 中：单路径时各字段是 Python 标量，批量时是按路径排列的数组。
+"""
+
+import logging
+import math
+import operator
+
+import numpy as np
+
+from features import NS_PER_SECOND
+
+MIN_GRID_ADJUST_SECONDS = 5 * 60  # 动态网格最小调整间隔5分钟
+
+
+def match_ranges(values, rules, key, default):
+    """按 [low, high) 区间表查找，向量化匹配（区间表只有几行），未命中取 default"""
+    values = np.asarray(values, dtype=np.float64)
+    out = np.full(values.shape, default, dtype=np.float64)
+    matched = np.zeros(values.shape, dtype=bool)
+    for rule in rules:
+        low, high = rule['range']
+        hit = ~matched & (values >= low) & (values < high)
+        out[hit] = rule[key]
+        matched |= hit
+    return out
+
+
+def trade_amounts(total_assets, volatility, n_trades, n_wins, sum_win, n_losses, sum_loss, params):
+    """
+    backtest.calculate_trade_amount 的向量化版本（买入方向）：
+    按各自的历史成交（笔数、盈利笔数与盈利总额、亏损笔数与亏损总额）计算凯利仓位
+    """
+    n_trades, n_wins, sum_win, n_losses, sum_loss = (np.asarray(x, dtype=np.float64)
+                                                     for x in (n_trades, n_wins, sum_win, n_losses, sum_loss))
+    volatility_factor = 1 / (1 + volatility * 10)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        win_rate = np.where(n_trades > 0, n_wins / n_trades, 0.5)
+        avg_win = np.where(n_wins > 0, sum_win / n_wins, 0.0)
+        avg_loss = np.where(n_losses > 0, sum_loss / n_losses, 1.0)
+        payoff_ratio = np.where((n_trades > 0) & (avg_loss != 0), avg_win / avg_loss, 1.0)
+        kelly_f = (win_rate * payoff_ratio - (1 - win_rate)) / payoff_ratio
+    kelly_f = np.clip(np.nan_to_num(kelly_f, nan=0.0, neginf=0.0), 0.0, 0.3)
+    percentile_factor = 1 + (1 - 0.5) * 0.5  # 中性价格分位
+    risk_adjusted_amount = np.minimum(total_assets * params['RISK_FACTOR'] * volatility_factor * kelly_f * percentile_factor,
+                                      total_assets * params['MAX_POSITION_RATIO'])
+    return np.maximum(np.minimum(risk_adjusted_amount, params['BASE_AMOUNT']), params['MIN_TRADE_AMOUNT'])
+
+
+def grid_adjust_seconds(volatility, params):
+    """backtest.calculate_dynamic_interval 的向量化版本：两次动态网格调整之间的最小间隔（秒）"""
+    interval_params = params['DYNAMIC_INTERVAL_PARAMS']
+    hours = match_ranges(volatility, interval_params['volatility_to_interval_hours'], 'interval_hours',
+                         interval_params.get('default_interval_hours', 1.0))
+    return np.maximum(hours * 3600, MIN_GRID_ADJUST_SECONDS)
+
+
+def volatility_grid(volatility, params):
+    """按波动率区间表确定网格大小（%），并限制在 [min, max] 之内"""
+    grid_params = params['GRID_PARAMS']
+    grid = match_ranges(volatility, grid_params['volatility_threshold']['ranges'], 'grid', grid_params['initial'])
+    return np.clip(grid, grid_params['min'], grid_params['max'])
+
+
+# step 返回的风控代码：0 表示未触发，其余为 RISK_STOPS 中的下标
+RISK_STOPS = (None, 'max_drawdown', 'daily_loss_limit')
+
+
+class _ScalarOps:
+    """单路径：状态为 Python 标量，掩码就是 bool"""
+    where = staticmethod(lambda cond, a, b: a if cond else b)
+    maximum = staticmethod(max)
+    minimum = staticmethod(min)
+    not_ = staticmethod(operator.not_)
+    isnan = staticmethod(math.isnan)
+    any = staticmethod(bool)
+    all = staticmethod(bool)
+    value = staticmethod(float)
+    ratio = staticmethod(lambda a, b: a / b if b > 0 else 0.0)
+
+
+class _ArrayOps:
+    """批量：状态为按路径排列的数组，掩码为 bool 数组"""
+    where = staticmethod(np.where)
+    maximum = staticmethod(np.maximum)
+    minimum = staticmethod(np.minimum)
+    not_ = staticmethod(np.logical_not)
+    isnan = staticmethod(np.isnan)
+    any = staticmethod(np.ndarray.any)
+    all = staticmethod(np.ndarray.all)
+    value = staticmethod(np.asarray)
+
+    @staticmethod
+    def ratio(a, b):
+        return np.divide(a, b, out=np.zeros(np.shape(b)), where=b > 0)
+
+
+class GridState:
+    """
+    step 的策略状态。
+
+    - n_lanes=None：单路径，各字段为 Python 标量，trades 记录每笔卖出（含 S1 卖出），供 backtest_ 和 GridStrategy 使用；
+    - n_lanes=N：N 条独立资金的路径，各字段为长度 N 的数组，只累计成交统计，不记录明细。
+    - execute(side, units, price, reason)：单路径可选的下单回调，返回实际成交 (units, price, 成交金额)，
+      返回 None 表示未成交；不传时按收盘价全部成交。
+    - base_price 为初始基准价，t0_ns 为首根K线时间（动态网格调整间隔的起点）。
+    """
+
+    def __init__(self, initial_balance, base_price, t0_ns, params, n_lanes=None, execute=None):
+        self.params = params
+        if n_lanes is None:
+            self.ops = _ScalarOps
+            full = lambda value, dtype=float: dtype(value)
+            self.base_price = float(base_price)
+            self.trades = []
+        else:
+            self.ops = _ArrayOps
+            full = lambda value, dtype=np.float64: np.full(n_lanes, value, dtype=dtype)
+            self.base_price = np.array(np.broadcast_to(base_price, n_lanes), dtype=np.float64)
+            self.trades = None
+        self.execute = execute
+        self.grid_value = full(params['GRID_PARAMS']['initial'])
+        self.last_grid_adjust_ns = full(t0_ns, int if n_lanes is None else np.int64)
+        self.balance = full(initial_balance)
+        self.long = full(False, bool)
+        self.units = full(0.0)
+        self.buy_price = full(0.0)
+        self.buy_i = full(-1, int if n_lanes is None else np.int64)
+        self.buy_time_ns = full(0, int if n_lanes is None else np.int64)
+        self.buy_monitoring = full(False, bool)
+        self.buy_min_price = full(0.0)
+        self.sell_monitoring = full(False, bool)
+        self.sell_max_price = full(0.0)
+        self.last_trade_i = full(-1, int if n_lanes is None else np.int64)
+        # 当天与昨日（S1 参考）的最高/最低价，days 为已开始的自然日数
+        self.days = 0
+        self.curr_day_high = full(np.nan)
+        self.curr_day_low = full(np.nan)
+        self.s1_daily_high = full(np.nan)
+        self.s1_daily_low = full(np.nan)
+        # 账户净值历史最高值与当日开盘净值（风控）
+        self.max_value = full(initial_balance)
+        self.day_open_value = full(initial_balance)
+        # 历史成交统计（凯利仓位），S1 卖出也计入
+        self.n_trades = full(0.0)
+        self.n_wins = full(0.0)
+        self.sum_win = full(0.0)
+        self.n_losses = full(0.0)
+        self.sum_loss = full(0.0)
+
+    def portfolio_value(self, price):
+        return self.balance + self.units * price
+
+
+def _fill(state, side, mask, units, price, quote, reason):
+    """按下单意图成交：无回调时按收盘价全部成交，有回调时以回调返回的实际成交为准"""
+    if state.execute is None:
+        return mask, units, price, quote
+    fill = state.execute(side, units, price, reason)
+    if fill is None:
+        return False, units, price, quote
+    return (True,) + tuple(fill)
+
+
+def _record_sells(state, mask, units, exit_price, i, t_ns, s1=False):
+    """卖出的盈亏计入成交统计；单路径时追加成交记录"""
+    ops = state.ops
+    profit = units * (exit_price - state.buy_price)
+    win = mask & (profit > 0)
+    loss = mask & (profit < 0)
+    state.n_trades = state.n_trades + mask
+    state.n_wins = state.n_wins + win
+    state.sum_win = state.sum_win + ops.where(win, profit, 0.0)
+    state.n_losses = state.n_losses + loss
+    state.sum_loss = state.sum_loss - ops.where(loss, profit, 0.0)
+    if state.trades is not None:
+        trade = {'entry_i': state.buy_i, 'exit_i': i, 'entry_time_ns': state.buy_time_ns, 'exit_time_ns': t_ns,
+                 'entry_price': state.buy_price, 'exit_price': exit_price, 'profit': profit}
+        if s1:
+            trade['s1'] = True
+        state.trades.append(trade)
+
+
+def step(state, i, t_ns, price, volatility, new_day, reset, allow_buy=True, allow_sell=True, stop_on_risk=False):
+    """
+    处理一根K线，返回 (交易前的组合净值, 风控代码)。
+
+    - i / t_ns / price: K线下标、时间戳（int 纳秒）和收盘价（批量时为按路径排列的数组）
+    - volatility: 本根K线的滚动年化波动率，样本不足时为 NaN
+    - new_day: 是否为新自然日的第一根K线（首根K线必须为 True）；reset: 是否定时重置基准价
+    - allow_buy / allow_sell: 是否允许开仓/卖出（风控暂停、冷却期），同时约束网格与 S1 交易
+    - stop_on_risk: 计算风控代码（见 RISK_STOPS），触发的路径本根K线不再交易
+
+    所有路径共用同一时间轴，new_day / reset 为标量。状态数组只整体替换、不原地修改，
+    因此可以直接引用价格矩阵的行而不会改写它。
+    """
+    s = state
+    ops = s.ops
+    params = s.params
+
+    # 每隔固定时间间隔重置基准价
+    if reset:
+        s.base_price = price
+
+    # 更新当天最高和最低价格，跨日时把上一交易日的高低点作为 S1 参考
+    if new_day:
+        s.days += 1
+        s.s1_daily_high, s.s1_daily_low = s.curr_day_high, s.curr_day_low
+        s.curr_day_high = s.curr_day_low = price
+    else:
+        s.curr_day_high = ops.maximum(s.curr_day_high, price)
+        s.curr_day_low = ops.minimum(s.curr_day_low, price)
+
+    # 持仓按当前价格估值
+    portfolio_value = s.balance + s.units * price
+    s.max_value = ops.maximum(s.max_value, portfolio_value)
+    if new_day:
+        s.day_open_value = portfolio_value
+
+    risk = 0
+    if stop_on_risk:
+        # 风控：回撤或日内亏损超限
+        risk = ops.where(portfolio_value / s.max_value - 1 < params['MAX_DRAWDOWN'], 1,
+                         ops.where(portfolio_value / s.day_open_value - 1 < params['DAILY_LOSS_LIMIT'], 2, 0))
+        stopped = risk != 0
+        if ops.all(stopped):
+            return portfolio_value, risk
+        allow_buy = allow_buy & ops.not_(stopped)
+        allow_sell = allow_sell & ops.not_(stopped)
+
+    grid_pct = s.grid_value / 100.0
+    held = s.long
+    flat = ops.not_(held)
+
+    # 空仓路径监控买入信号：跌破下边界开始监控，从最低价反弹超过翻转阈值时买入
+    start_buy = flat & ops.not_(s.buy_monitoring) & (price <= s.base_price * (1 - grid_pct))
+    if ops.any(start_buy):
+        s.buy_min_price = ops.where(start_buy, price, s.buy_min_price)
+        s.buy_monitoring = s.buy_monitoring | start_buy
+    watching = flat & s.buy_monitoring
+    if ops.any(watching):
+        s.buy_min_price = ops.where(watching, ops.minimum(s.buy_min_price, price), s.buy_min_price)
+        threshold = s.base_price * grid_pct * params['FLIP_THRESHOLD'](s.grid_value)
+        buy = watching & (price >= s.buy_min_price + threshold) & allow_buy
+        if ops.any(buy):
+            # 若无足够波动率样本，则按波动率0计算下单金额
+            vol = ops.where(ops.isnan(volatility), 0.0, volatility)
+            amount = ops.value(trade_amounts(portfolio_value, vol, s.n_trades, s.n_wins, s.sum_win, s.n_losses,
+                                             s.sum_loss, params))
+            buy = buy & (s.balance >= amount)
+            if ops.any(buy):
+                buy, units, fill_price, quote = _fill(s, 'buy', buy, amount / price, price, amount, 'grid')
+                if ops.any(buy):
+                    s.units = ops.where(buy, units, s.units)
+                    s.buy_price = ops.where(buy, fill_price, s.buy_price)
+                    s.buy_i = ops.where(buy, i, s.buy_i)
+                    s.buy_time_ns = ops.where(buy, t_ns, s.buy_time_ns)
+                    s.balance = ops.where(buy, s.balance - quote, s.balance)
+                    s.long = s.long | buy
+                    s.buy_monitoring = s.buy_monitoring & ops.not_(buy)
+                    s.last_trade_i = ops.where(buy, i, s.last_trade_i)
+
+    # 持仓路径监控卖出信号：上穿上边界开始监控，从最高价回落超过翻转阈值时卖出，卖出价作为新的基准价
+    start_sell = held & ops.not_(s.sell_monitoring) & (price >= s.base_price * (1 + grid_pct))
+    if ops.any(start_sell):
+        s.sell_max_price = ops.where(start_sell, price, s.sell_max_price)
+        s.sell_monitoring = s.sell_monitoring | start_sell
+    watching = held & s.sell_monitoring
+    if ops.any(watching):
+        s.sell_max_price = ops.where(watching, ops.maximum(s.sell_max_price, price), s.sell_max_price)
+        threshold = s.base_price * grid_pct * params['FLIP_THRESHOLD'](s.grid_value)
+        sell = watching & (price <= s.sell_max_price - threshold) & allow_sell
+        if ops.any(sell):
+            sell, units, exit_price, quote = _fill(s, 'sell', sell, s.units, price, s.units * price, 'grid')
+            if ops.any(sell):
+                _record_sells(s, sell, units, exit_price, i, t_ns)
+                s.balance = ops.where(sell, s.balance + quote, s.balance)
+                s.base_price = ops.where(sell, exit_price, s.base_price)
+                s.units = ops.where(sell, 0.0, s.units)
+                s.long = s.long & ops.not_(sell)
+                s.sell_monitoring = s.sell_monitoring & ops.not_(sell)
+                s.last_trade_i = ops.where(sell, i, s.last_trade_i)
+
+                # 动态网格调整：按波动率区间确定网格大小，受动态时间间隔限制
+                adjust = sell & ops.not_(ops.isnan(volatility))
+                if ops.any(adjust):
+                    adjust = adjust & ((t_ns - s.last_grid_adjust_ns) / NS_PER_SECOND
+                                       >= grid_adjust_seconds(volatility, params))
+                    if ops.any(adjust):
+                        new_grid_value = ops.value(volatility_grid(volatility, params))
+                        if s.trades is not None:
+                            logging.info(f"调整网格大小 | 波动率: {volatility:.2%} | 原网格: {s.grid_value:.2f}% | "
+                                         f"新网格: {new_grid_value:.2f}%")
+                        s.grid_value = ops.where(adjust, new_grid_value, s.grid_value)
+                        s.last_grid_adjust_ns = ops.where(adjust, t_ns, s.last_grid_adjust_ns)
+
+    # S1策略逻辑：价格突破昨日最高/跌破昨日最低时，把仓位比例调整到目标值（本根K线已有交易的路径跳过）
+    if s.days >= 2 and ops.any((price > s.s1_daily_high) | (price < s.s1_daily_low)):
+        position_value = s.units * price
+        value = s.balance + position_value
+        position_ratio = ops.ratio(position_value, value)
+        min_trade_amount = params['MIN_TRADE_AMOUNT']
+        s1_sell_pct = params['S1_SELL_TARGET_PCT']
+        s1_buy_pct = params['S1_BUY_TARGET_PCT']
+
+        excess_value = position_value - value * s1_sell_pct
+        s1_sell = (s.long & (s.last_trade_i != i) & (price > s.s1_daily_high) & (position_ratio > s1_sell_pct)
+                   & (excess_value >= min_trade_amount) & allow_sell)
+        if ops.any(s1_sell):
+            sell_units = excess_value / price
+            s1_sell, units, exit_price, quote = _fill(s, 'sell', s1_sell, sell_units, price, sell_units * price, 's1')
+            if ops.any(s1_sell):
+                _record_sells(s, s1_sell, units, exit_price, i, t_ns, s1=True)
+                s.balance = ops.where(s1_sell, s.balance + quote, s.balance)
+                remaining = ops.where(s1_sell, s.units - units, s.units)
+                emptied = s1_sell & (remaining < 1e-8)
+                s.units = ops.where(emptied, 0.0, remaining)
+                s.long = s.long & ops.not_(emptied)
+                s.last_trade_i = ops.where(s1_sell, i, s.last_trade_i)
+                if s.trades is not None:
+                    logging.info(f"S1卖出调整：卖出 {units:.4f} 单位，剩余仓位 {s.units:.4f}")
+
+        shortage_value = value * s1_buy_pct - position_value
+        s1_buy = ((s.last_trade_i != i) & (price < s.s1_daily_low) & (position_ratio < s1_buy_pct)
+                  & (shortage_value >= min_trade_amount) & (s.balance >= shortage_value) & allow_buy)
+        if ops.any(s1_buy):
+            s1_buy, units, fill_price, quote = _fill(s, 'buy', s1_buy, shortage_value / price, price, shortage_value, 's1')
+            if ops.any(s1_buy):
+                # 空仓路径直接建仓，持仓路径按数量加权更新持仓均价
+                opening = s1_buy & ops.not_(s.long)
+                total_units = s.units + units
+                averaged = ops.ratio(s.buy_price * s.units + fill_price * units, total_units)
+                s.buy_price = ops.where(opening, fill_price, ops.where(s1_buy, averaged, s.buy_price))
+                s.buy_i = ops.where(opening, i, s.buy_i)
+                s.buy_time_ns = ops.where(opening, t_ns, s.buy_time_ns)
+                s.units = ops.where(s1_buy, total_units, s.units)
+                s.long = s.long | s1_buy
+                s.balance = ops.where(s1_buy, s.balance - quote, s.balance)
+                s.last_trade_i = ops.where(s1_buy, i, s.last_trade_i)
+                if s.trades is not None:
+                    logging.info(f"S1买入调整：买入 {units:.4f} 单位，新仓位 {s.units:.4f}")
+
+    return portfolio_value, risk
@@ -0,0 +1,175 @@
+"""
+增量式网格策略状态机
+
+每次只处理一根新K线，不依赖整段历史数组，供实盘/模拟盘在行情流上逐根驱动。
+逐K线的决策调用与 backtest_ 相同的 grid_core.step，本模块只负责把行情流转换为 step 的输入：
+- 滚动波动率：按时间取窗口，用收益率队列的累加和增量计算（与 features.rolling_volatility_by_time 一致）；
+- 定时重置基准价：距上次重置满 RESET_INTERVAL_SECONDS 即重置（与 features.compute_reset_points 一致）；
+- 自然日：按 tz 时区的本地日期切分（与 features.compute_day_ids 一致），用于 S1 日线高低点和日内亏损风控。
+
+下单通过 execute(side, units, price, reason) 回调完成：返回实际成交 (units, price, 成交金额)，返回 None 表示未成交；
+买入扣除、卖出收回的现金以成交金额为准（含手续费）。默认按K线收盘价立即全部成交，与回测一致；
+模拟盘中由 paper_trading.SimulatedExchange 提供。
+"""
+
+import math
+from collections import deque
+
+import pandas as pd
+
+from backtest import resolve_params
+from config import INITIAL_PRINCIPAL
+from features import NS_PER_SECOND, NS_PER_DAY
+from grid_core import GridState, step
+
+# 下载器保存的K线时间为 Asia/Shanghai，实盘默认按北京时间切分自然日
+DEFAULT_TZ = 'Asia/Shanghai'
+
+
+def _fill_immediately(side, units, price, reason):
+    return units, price, units * price
+
+
+class GridStrategy:
+    def __init__(self, initial_balance=INITIAL_PRINCIPAL, params=None, execute=None, tz=DEFAULT_TZ,
+                 cooldown_seconds=0, bar_seconds=60):
+        """
+        - params: 覆盖 config 默认值的策略参数（见 backtest.resolve_params）
+        - execute: 下单回调，默认立即成交
+        - tz: 划分自然日的时区；K线时间戳本身为本地时间（不带时区的数据）时传 None
+        - cooldown_seconds: 两笔交易之间的最短间隔（实盘可传 config.COOLDOWN），默认0与回测一致
+        - bar_seconds: K线周期，用于按时间计算波动率窗口
+        """
+        self.params = resolve_params(params)
+        self.execute = execute or _fill_immediately
+        self.tz = tz
+        self.cooldown_ns = int(cooldown_seconds * NS_PER_SECOND)
+        self.initial_balance = initial_balance
+        self.reset_interval_ns = int(self.params['RESET_INTERVAL_SECONDS'] * NS_PER_SECOND)
+        self.bars_for_vol = int(self.params['VOLATILITY_WINDOW'] * 60)
+        self.bar_ns = int(bar_seconds * NS_PER_SECOND)
+        # 波动率窗口内的 (收益率起点K线时间, 对数收益率) 及其累加和
+        self._returns = deque()
+        self._sum = 0.0
+        self._sum_sq = 0.0
+        # 当前自然日的编号及其 [起, 止) UTC 纳秒时间
+        self._day = None
+        self._day_start_ns = None
+        self._day_end_ns = None
+
+        self.grid = GridState(initial_balance, math.nan, 0, self.params, execute=self._execute)
+        self.i = -1                    # 已处理的K线序号
+        self.first_time_ns = None
+        self.last_price = None
+        self.last_time_ns = None
+        self.last_reset_ns = None
+        self.last_trade_ns = None
+        self.halted = False            # 风控触发后暂停开新仓
+        self._fills = []
+
+    @property
+    def trades(self):
+        return self.grid.trades
+
+    @property
+    def current_balance(self):
+        return self.grid.balance
+
+    @property
+    def position_value(self):
+        return self.grid.units * self.last_price if self.last_price is not None else 0.0
+
+    @property
+    def portfolio_value(self):
+        return self.current_balance + self.position_value
+
+    def _execute(self, side, units, price, reason):
+        fill = self.execute(side, units, price, reason)
+        if fill is not None:
+            self._fills.append((side, fill[0], fill[1], reason))
+        return fill
+
+    def _add_return(self, prev_t_ns, t_ns, log_return):
+        """收益率入队，并移出起点早于波动率窗口（bars_for_vol-1 个周期）的收益率"""
+        self._returns.append((prev_t_ns, log_return))
+        self._sum += log_return
+        self._sum_sq += log_return * log_return
+        window_start = t_ns - (self.bars_for_vol - 1) * self.bar_ns
+        while self._returns and self._returns[0][0] < window_start:
+            _, old = self._returns.popleft()
+            self._sum -= old
+            self._sum_sq -= old * old
+
+    def _volatility(self, t_ns):
+        """滚动年化波动率：距首根K线不足 bars_for_vol 个周期时为 NaN"""
+        if self.bars_for_vol <= 1 or not self._returns or t_ns - self.first_time_ns < self.bars_for_vol * self.bar_ns:
+            return math.nan
+        periods = (t_ns - self._returns[0][0]) / self.bar_ns
+        mean = self._sum / periods
+        return math.sqrt(max(self._sum_sq / periods - mean * mean, 0.0)) * math.sqrt(1440 * 365)
+
+    def _is_new_day(self, t_ns):
+        """t_ns 是否落在新的自然日，日界按 tz 时区的本地零点计算并缓存"""
+        if self._day_start_ns is not None and self._day_start_ns <= t_ns < self._day_end_ns:
+            return False
+        if self.tz is None:
+            day = t_ns // NS_PER_DAY
+            self._day_start_ns, self._day_end_ns = day * NS_PER_DAY, (day + 1) * NS_PER_DAY
+        else:
+            local = pd.Timestamp(t_ns, tz='UTC').tz_convert(self.tz)
+            day = local.tz_localize(None).value // NS_PER_DAY
+            self._day_start_ns = local.normalize().value
+            self._day_end_ns = pd.Timestamp((day + 1) * NS_PER_DAY).tz_localize(self.tz).value
+        is_new = day != self._day
+        self._day = day
+        return is_new
+
+    def _in_cooldown(self, t_ns):
+        return self.cooldown_ns > 0 and self.last_trade_ns is not None and t_ns - self.last_trade_ns < self.cooldown_ns
+
+    def on_bar(self, t_ns, price):
+        """处理一根新K线（t_ns 为 UTC 纳秒时间戳，price 为收盘价），返回本根K线内的成交列表"""
+        self.i += 1
+        i = self.i
+        grid = self.grid
+        reset = False
+        if i == 0:
+            initial_base_price = self.params['INITIAL_BASE_PRICE']
+            grid.base_price = float(initial_base_price if initial_base_price > 0 else price)
+            grid.last_grid_adjust_ns = t_ns
+            self.first_time_ns = self.last_reset_ns = t_ns
+        else:
+            self._add_return(self.last_time_ns, t_ns, math.log(price) - math.log(self.last_price))
+            # 每隔固定时间间隔重置基准价
+            if t_ns - self.last_reset_ns >= self.reset_interval_ns:
+                reset = True
+                self.last_reset_ns = t_ns
+        self.last_price = price
+        self.last_time_ns = t_ns
+
+        self._fills = []
+        in_cooldown = self._in_cooldown(t_ns)
+        step(grid, i, t_ns, price, self._volatility(t_ns), self._is_new_day(t_ns), reset,
+             allow_buy=not self.halted and not in_cooldown, allow_sell=not in_cooldown)
+        if self._fills:
+            self.last_trade_ns = t_ns
+        return self._fills
+
+    def risk_check(self):
+        """
+        按 config.RISK_PARAMS 检查回撤、日内亏损和仓位比例，返回触发的风控项列表；
+        回撤超过 MAX_DRAWDOWN 或当日净值相对开盘跌破 DAILY_LOSS_LIMIT 时暂停开新仓（halted），
+        恢复到阈值以内（或进入新的一天）后自动解除。
+        """
+        grid = self.grid
+        portfolio_value = self.portfolio_value
+        alerts = []
+        if grid.max_value > 0 and portfolio_value / grid.max_value - 1 < self.params['MAX_DRAWDOWN']:
+            alerts.append('max_drawdown')
+        if grid.day_open_value > 0 and portfolio_value / grid.day_open_value - 1 < self.params['DAILY_LOSS_LIMIT']:
+            alerts.append('daily_loss_limit')
+        position_ratio = self.position_value / portfolio_value if portfolio_value > 0 else 0.0
+        if position_ratio > self.params['MAX_POSITION_RATIO']:
+            alerts.append('position_limit')
+        self.halted = 'max_drawdown' in alerts or 'daily_loss_limit' in alerts
+        return alerts
@@ -8,7 +8,8 @@
 1. 使用 binance-futures-connector 库调用接口下载数据。
 2. 日期范围、代币（symbol）、周期（interval）等参数均通过 tkinter 界面输入。
 3. 下载时使用循环调用接口（参考 query_history 逻辑）获取多天数据，并通过进度条显示下载进度。
-4. 下载完成后自动保存数据到当前目录，支持 CSV 或 PKL 格式。
+4. 下载完成后用 kline_integrity 检查缺口，只补下载缺失的时间段（请求出错留下的空洞），并去掉重复K线。
+5. 下载完成后自动保存数据到当前目录，支持 CSV 或 PKL 格式；完整性索引保存在数据文件旁的 .integrity.json。
 """
 
 import tkinter as tk
@@ -18,10 +19,16 @@ import pandas as pd
 from datetime import datetime, timedelta
 import time
 import os
+import numpy as np
 
 # 导入 binance-futures-connector 库
 from binance.um_futures import UMFutures
 
+from kline_integrity import KlineIntegrity, integrity_path
+
+# 补下载缺口的最大轮数
+MAX_REPAIR_ROUNDS = 3
+
 class KlineDownloaderApp:
     def __init__(self, master):
         self.master = master
@@ -173,33 +180,30 @@ class KlineDownloaderApp:
         # 启动后台线程执行下载任务，避免界面卡顿
         threading.Thread(target=self.download_klines, args=(symbol, interval, start_dt, end_dt, save_format)).start()
 
-    def download_klines(self, symbol, interval, start_dt, end_dt, save_format):
+    def fetch_klines(self, symbol, interval, start_ms, end_ms, total_duration=None):
         """
-        循环下载历史数据：
+        循环下载 [start_ms, end_ms] 内的K线：
         - 以 startTime 为入口，循环调用接口，每次下载一片段数据；
-        - 根据返回数据更新当前下载进度，当不足 limit 条数据时认为已下载完
-        - 最后将所有数据转为 DataFrame 并调用保存函数
+        - 当不足 limit 条数据时认为已下载完；请求出错时停止，已下载的数据照常返回（缺口由补下载处理）
+        - total_duration 不为空时按其更新进度条
         """
-        all_data = []
+        rows = []
         # 每次请求数据数量，根据需要可调整（适配大周期时建议减小该值）
-        limit = 900  
-        current_start = start_dt
-        start_timestamp = start_dt.timestamp()
-        end_timestamp = end_dt.timestamp()
-        total_duration = end_timestamp - start_timestamp
+        limit = 900
+        current_start = start_ms
         # 根据周期字符串获取时间差
-        interval_delta = self.get_interval_delta(interval)
-        
+        interval_ms = int(self.get_interval_delta(interval).total_seconds() * 1000)
+
         batch_count = 0
 
-        while current_start < end_dt:
+        while current_start <= end_ms:
             batch_count += 1
             params = {
                 "symbol": symbol,
                 "interval": interval,
                 "limit": limit,
-                "startTime": int(current_start.timestamp() * 1000),
-                "endTime": int(end_dt.timestamp() * 1000)
+                "startTime": current_start,
+                "endTime": end_ms
             }
             try:
                 self.add_log(f"正在下载第 {batch_count} 批数据...")
@@ -207,42 +211,84 @@ class KlineDownloaderApp:
                 time.sleep(0.25)
                 self.add_log(f"成功获取 {len(klines)} 条K线数据")
             except Exception as e:
-                error_msg = f"请求错误：{str(e)}"
-                self.add_log(error_msg)
-                self.show_error(error_msg)
+                self.add_log(f"请求错误：{str(e)}")
                 break
 
             if not klines:
                 self.add_log("未获取到数据，下载完成")
                 break
 
-            all_data.extend(klines)
+            rows.extend(klines)
             # 取本次返回数据的最后一条，更新下载起始时间（加一个周期间隔，避免重复）
-            last_time = int(klines[-1][0]) / 1000  # 转换为秒
-            current_start = datetime.fromtimestamp(last_time) + interval_delta
-            
+            last_time = int(klines[-1][0])
+            current_start = last_time + interval_ms
+
             # 计算当前下载的时间范围
-            current_time_str = datetime.fromtimestamp(last_time).strftime("%Y-%m-%d %H:%M:%S")
+            current_time_str = datetime.fromtimestamp(last_time / 1000).strftime("%Y-%m-%d %H:%M:%S")
             self.add_log(f"当前下载至: {current_time_str}")
 
             # 计算进度百分比
-            progress_percent = ((last_time - start_timestamp) / total_duration) * 100
-            progress_percent = min(100, progress_percent)
-            self.update_progress(progress_percent)
+            if total_duration:
+                progress_percent = ((last_time - start_ms) / total_duration) * 100
+                progress_percent = min(100, progress_percent)
+                self.update_progress(progress_percent)
 
             # 如果返回数据少于 limit，则认为数据已全部下载完毕
             if len(klines) < limit:
                 self.add_log("数据下载完成")
                 break
+        return rows
+
+    def download_klines(self, symbol, interval, start_dt, end_dt, save_format):
+        """
+        下载历史数据：
+        - 先整段下载（fetch_klines），请求出错时保留已下载部分；
+        - 再用完整性索引找出缺口（含首尾缺失），只补下载这些时间段，最多 MAX_REPAIR_ROUNDS 轮；
+        - 最后去重排序、转为 DataFrame 并调用保存函数
+        """
+        start_ms = int(start_dt.timestamp() * 1000)
+        end_ms = int(end_dt.timestamp() * 1000)
+        step_ms = int(self.get_interval_delta(interval).total_seconds() * 1000)
+        step_ns = step_ms * 1_000_000
+        # 期望的K线开盘时间范围 [start, expected_end)，尚未收盘的K线不计为缺失
+        expected_end_ns = (min(end_ms, int(time.time() * 1000) - step_ms) + 1) * 1_000_000
+
+        all_data = self.fetch_klines(symbol, interval, start_ms, end_ms, total_duration=end_ms - start_ms)
+        integrity = self.check_integrity(all_data, step_ns)
+        missing = integrity.missing_ranges(start_ms * 1_000_000, expected_end_ns)
+        for repair_round in range(1, MAX_REPAIR_ROUNDS + 1):
+            if not missing:
+                break
+            missing_bars = sum((hi_ns - lo_ns + step_ns - 1) // step_ns for lo_ns, hi_ns in missing)
+            self.add_log(f"第 {repair_round} 轮补下载：{len(missing)} 段缺失，共 {missing_bars} 根K线")
+            fetched = 0
+            for lo_ns, hi_ns in missing:
+                rows = self.fetch_klines(symbol, interval, lo_ns // 1_000_000, (hi_ns - 1) // 1_000_000)
+                all_data.extend(rows)
+                fetched += len(rows)
+            integrity = self.check_integrity(all_data, step_ns)
+            missing = integrity.missing_ranges(start_ms * 1_000_000, expected_end_ns)
+            if fetched == 0:
+                # 交易所本身没有这些K线（如上线前、维护期间），不再重试
+                break
 
         # 数据下载完成后转为 DataFrame
         if all_data:
+            self.add_log(f"完整性检查：{integrity.summary()}")
+            if missing:
+                error_msg = f"数据仍有 {len(missing)} 段缺失未能补齐，缺口已记录在完整性索引中"
+                self.add_log(error_msg)
+                self.show_error(error_msg)
             self.add_log(f"共下载 {len(all_data)} 条K线数据，正在处理...")
             df = pd.DataFrame(all_data, columns=[
                 'open_time', 'open_price', 'high_price', 'low_price', 'close_price', 'volume',
                 'close_time', 'quote_volume', 'trades', 'taker_buy_volume',
                 'taker_buy_quote_volume', 'ignore'
             ])
+            # 去掉分页边界和补下载产生的重复K线，并按时间排序
+            df['open_time'] = df['open_time'].astype('int64')
+            df = df.drop_duplicates('open_time', keep='last').sort_values('open_time').reset_index(drop=True)
+            integrity = KlineIntegrity.build(df['open_time'].to_numpy() * 1_000_000, step_ns)
             # 转换时间戳
             df['open_time'] = pd.to_datetime(df['open_time'], unit='ms')
             df['open_time'] = df['open_time'].dt.tz_localize('UTC').dt.tz_convert('Asia/Shanghai')
@@ -251,13 +297,19 @@ class KlineDownloaderApp:
                 df[col] = df[col].astype(float)
             # 调用保存函数
             self.add_log("数据处理完成，准备保存...")
-            self.master.after(0, self.save_file, df, save_format, symbol, start_dt, end_dt)
+            self.master.after(0, self.save_file, df, save_format, symbol, start_dt, end_dt, integrity)
         else:
-            self.add_log("未获取到任何数据！")
-            self.show_error("未获取到任何数据！")
+            error_msg = "未获取到任何数据！"
+            self.add_log(error_msg)
+            self.show_error(error_msg)
         # 下载完毕后，重新启用下载按钮
         self.master.after(0, lambda: self.download_button.config(state="normal"))
 
+    def check_integrity(self, rows, step_ns):
+        """按已下载K线的 open_time（毫秒）构建完整性索引"""
+        open_ms = np.fromiter((int(k[0]) for k in rows), dtype=np.int64, count=len(rows))
+        return KlineIntegrity.build(open_ms * 1_000_000, step_ns)
+
     def get_interval_delta(self, interval):
         """
         根据周期字符串返回对应的 timedelta 对象，支持 'm', 'h', 'd' 单位
@@ -300,9 +352,9 @@ class KlineDownloaderApp:
         self.progress["value"] = value
         self.master.update_idletasks()
 
-    def save_file(self, df, save_format, symbol, start_dt, end_dt):
+    def save_file(self, df, save_format, symbol, start_dt, end_dt, integrity=None):
         """
-        直接保存文件到当前目录，按指定格式自动命名
+        直接保存文件到当前目录，按指定格式自动命名；完整性索引保存在数据文件旁
         """
         # 格式化日期时间字符串
         start_datetime = start_dt.strftime("%Y-%m-%d_%H_%M_%S")
@@ -335,6 +387,10 @@ class KlineDownloaderApp:
                 self.show_error(error_msg)
                 return
         
+        if integrity is not None:
+            integrity.save(integrity_path(file_path))
+            self.add_log(f"完整性索引已保存到: {integrity_path(file_path)}")
+
         # 显示完成消息
         messagebox.showinfo("完成", f"数据下载并保存成功！\n文件路径: {file_path}")
 
@@ -0,0 +1,199 @@
+"""
+K线数据完整性索引
+
+下载器在请求出错时会提前结束循环，留下缺失的K线；分页边界处也可能出现重复K线；回测引擎却默认K线按1分钟连续排列。
+KlineIntegrity 对 open_time 做一次向量化的相邻差分，把问题记录为紧凑的区间列表：
+- gaps:         缺口，(缺失起始纳秒, 缺失结束纳秒) 左闭右开，按排序去重后的时间轴计算；
+- duplicates:   相邻K线时间戳相同的下标区间 [起, 止)（原始顺序，如分页边界重复下载的K线）；
+- out_of_order: 时间戳倒退的下标区间 [起, 止)（原始顺序，不相邻的重复K线也表现为倒退）。
+
+索引保存为数据文件（或紧凑数据集目录）旁的 <文件名>.integrity.json，是唯一的一份：
+- 下载器保存数据时写入，描述排序去重后的K线，即各加载入口看到的时间轴；
+- features.load_features 与 compact_dataset.CompactKlines 通过 load_integrity 读取，不存在或与数据不符（按时间戳内容哈希判断）时
+  重新构建并覆盖；
+- 回测特征（features.BacktestFeatures.integrity）据此在有缺口时按时间而不是K线根数取波动率窗口；
+- 下载器据此只重新下载缺失的时间段（missing_ranges）。
+"""
+
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+INTEGRITY_VERSION = 2
+
+
+def hash_times(time_ns):
+    """时间戳内容哈希，用于判断索引是否仍对应数据（长度与首尾相同、缺口位置不同也能区分）"""
+    return hashlib.sha256(np.ascontiguousarray(time_ns, dtype=np.int64).tobytes()).hexdigest()[:16]
+
+
+def infer_step(time_ns):
+    """K线周期（纳秒）：相邻正差分的众数，数据不足两根时返回 0"""
+    deltas = np.diff(np.asarray(time_ns, dtype=np.int64))
+    deltas = deltas[deltas > 0]
+    if len(deltas) == 0:
+        return 0
+    values, counts = np.unique(deltas, return_counts=True)
+    return int(values[np.argmax(counts)])
+
+
+def _runs(mask):
+    """相邻差分的布尔标记 -> 连续为 True 的差分区间对应的K线下标区间 [起, 止)，形状 (k, 2)"""
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    # 差分区间 [a, b) 涉及K线 a..b，即K线下标区间 [a, b+1)
+    return np.column_stack([starts, ends + 1]).astype(np.int64)
+
+
+class KlineIntegrity:
+    """
+    单个数据集的完整性索引。
+
+    - build(time_ns, step_ns): 从时间戳构建（step_ns 默认自动推断）
+    - is_clean / is_sorted: 无任何问题 / 无重复且无倒序（可直接按时间二分查找）
+    - missing_ranges(start_ns, end_ns): 需要补下载的时间段，可包含期望区间首尾缺失的部分
+    - save(path) / load(path): 读写 JSON
+    """
+
+    def __init__(self, n, step_ns, first_ns, last_ns, gaps, duplicates, out_of_order, time_hash=None):
+        self.n = n
+        self.time_hash = time_hash
+        self.step_ns = step_ns
+        self.first_ns = first_ns
+        self.last_ns = last_ns
+        self.gaps = np.asarray(gaps, dtype=np.int64).reshape(-1, 2)
+        self.duplicates = np.asarray(duplicates, dtype=np.int64).reshape(-1, 2)
+        self.out_of_order = np.asarray(out_of_order, dtype=np.int64).reshape(-1, 2)
+
+    @classmethod
+    def build(cls, time_ns, step_ns=None):
+        time_ns = np.asarray(time_ns, dtype=np.int64)
+        n = len(time_ns)
+        if step_ns is None:
+            step_ns = infer_step(time_ns)
+        deltas = np.diff(time_ns)
+        duplicates = _runs(deltas == 0)
+        out_of_order = _runs(deltas < 0)
+        if len(out_of_order):
+            # 顺序错乱时在排序去重后的时间轴上找缺口
+            unique_ns = np.unique(time_ns)
+            deltas = np.diff(unique_ns)
+            anchors = unique_ns[:-1]
+        else:
+            anchors = time_ns[:-1]
+        gap_at = np.flatnonzero(deltas > step_ns) if step_ns > 0 else np.empty(0, dtype=np.int64)
+        gaps = np.column_stack([anchors[gap_at] + step_ns, anchors[gap_at] + deltas[gap_at]])
+        first_ns = int(time_ns.min()) if n else 0
+        last_ns = int(time_ns.max()) if n else 0
+        return cls(n, int(step_ns), first_ns, last_ns, gaps, duplicates, out_of_order, hash_times(time_ns))
+
+    @property
+    def is_sorted(self):
+        return not len(self.duplicates) and not len(self.out_of_order)
+
+    @property
+    def is_clean(self):
+        return self.is_sorted and not len(self.gaps)
+
+    @property
+    def missing_bars(self):
+        """缺口内缺失的K线根数（按周期计）"""
+        if not len(self.gaps) or self.step_ns <= 0:
+            return 0
+        return int(((self.gaps[:, 1] - self.gaps[:, 0] + self.step_ns - 1) // self.step_ns).sum())
+
+    def missing_ranges(self, start_ns=None, end_ns=None):
+        """
+        需要补下载的时间段列表 [(起始纳秒, 结束纳秒), ...]，左闭右开。
+        指定期望区间 [start_ns, end_ns) 时，首根K线之前、末根K线之后的缺失部分也计入，区间外的缺口被裁掉。
+        """
+        ranges = [tuple(int(v) for v in gap) for gap in self.gaps]
+        if start_ns is not None and ((self.n == 0 and end_ns is not None) or start_ns + self.step_ns <= self.first_ns):
+            ranges.insert(0, (int(start_ns), self.first_ns if self.n else int(end_ns)))
+        if end_ns is not None and self.n and self.last_ns + self.step_ns < end_ns:
+            ranges.append((self.last_ns + self.step_ns, int(end_ns)))
+        if start_ns is not None:
+            ranges = [(max(lo, start_ns), hi) for lo, hi in ranges if hi > start_ns]
+        if end_ns is not None:
+            ranges = [(lo, min(hi, end_ns)) for lo, hi in ranges if lo < end_ns]
+        return ranges
+
+    def matches(self, time_ns):
+        """索引是否对应这组时间戳（根数相同且时间戳内容哈希一致）"""
+        return self.n == len(time_ns) and self.time_hash is not None and self.time_hash == hash_times(time_ns)
+
+    def summary(self):
+        return (f"{self.n} 根K线，周期 {self.step_ns / 1e9:g} 秒 | 缺口 {len(self.gaps)} 处（缺 {self.missing_bars} 根）| "
+                f"重复 {len(self.duplicates)} 段 | 倒序 {len(self.out_of_order)} 段")
+
+    def to_dict(self):
+        return {'version': INTEGRITY_VERSION, 'n': self.n, 'step_ns': self.step_ns, 'first_ns': self.first_ns,
+                'last_ns': self.last_ns, 'gaps': self.gaps.tolist(), 'duplicates': self.duplicates.tolist(),
+                'out_of_order': self.out_of_order.tolist(), 'time_hash': self.time_hash}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['n'], data['step_ns'], data['first_ns'], data['last_ns'],
+                   data['gaps'], data['duplicates'], data['out_of_order'], data.get('time_hash'))
+
+    def save(self, path):
+        tmp_path = path + f'.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != INTEGRITY_VERSION:
+            raise ValueError(f"不支持的完整性索引版本: {data.get('version')}")
+        return cls.from_dict(data)
+
+
+def integrity_path(data_path):
+    return os.path.normpath(data_path) + '.integrity.json'
+
+
+def load_integrity(data_path, time_ns, step_ns=None):
+    """读取数据文件旁保存的索引；不存在或与数据不符时重新构建并保存"""
+    path = integrity_path(data_path)
+    if os.path.exists(path):
+        try:
+            integrity = KlineIntegrity.load(path)
+            if integrity.matches(time_ns) and (step_ns is None or integrity.step_ns == step_ns):
+                return integrity
+        except (ValueError, KeyError, json.JSONDecodeError):
+            pass
+    integrity = KlineIntegrity.build(time_ns, step_ns)
+    integrity.save(path)
+    return integrity
+
+
+def repair_klines(df, time_column='open_time'):
+    """
+    按时间稳定排序并去掉重复K线（保留最后一条，即后下载的数据），返回新的 DataFrame。
+    time_column 不在列中时按索引处理（示例数据的 DatetimeIndex）。
+    """
+    if time_column in df.columns:
+        df = df.sort_values(time_column, kind='stable')
+        df = df[~df[time_column].duplicated(keep='last')]
+        return df.reset_index(drop=True)
+    df = df.sort_index(kind='stable')
+    return df[~df.index.duplicated(keep='last')]
+
+
+if __name__ == "__main__":
+    from features import normalize_klines
+
+    pkl_file = "BNBUSDT_BINANCE_2025-01-01_00_00_00_2025-05-19_23_59_59.pkl"
+    _, _, dt_index, _ = normalize_klines(pd.read_pickle(pkl_file))
+    integrity = load_integrity(pkl_file, dt_index.asi8)
+    print(integrity.summary())
+    for lo, hi in integrity.missing_ranges()[:10]:
+        print(f"缺失: {pd.Timestamp(lo, tz='UTC')} ~ {pd.Timestamp(hi, tz='UTC')}")
@@ -0,0 +1,161 @@
+"""
+多档网格（梯子）回测
+
+backtest_ 同一时间最多持有一笔仓位，只围绕一个基准价触发买卖；实际部署的网格会在基准价上下同时挂很多档委托。
+本模块按几何间距在基准价上下各挂 levels 档委托，第 k 档价格为 base_price*(1+grid_pct)^k（k 为 -levels..levels）：
+- 基准价下方（k=-1..-levels）挂等额买单；
+- 基准价上方（k=1..levels）挂卖单，所需底仓在第一根K线按收盘价一次性买入，
+  第 k 档卖单的数量与第 k-1 档买单成交时相同（每档金额 / 第 k-1 档价格）；
+- 第 k 档买单成交后，在第 k+1 档挂出对应数量的卖单；第 k 档卖单成交后，在第 k-1 档重新挂买单；
+- 待成交的买单放在以价格为键的大顶堆、卖单放在小顶堆中，每根K线只比较两个堆顶（离当前价最近的一档），
+  成交一档为一次 O(log N) 的出堆/入堆，单根K线的开销不随档位数增加；
+- 按限价单语义，收盘价穿过某档即按该档价格成交，一根K线跳空穿过多档时逐档成交；
+  基准价偏离第一根K线收盘价时，挂单时就已可成交的档位（高于市价的买单、低于市价的卖单）按市价成交，
+  即买单按 min(档位价, 收盘价)、卖单按 max(档位价, 收盘价)，不会以差于市价的价格成交。
+
+网格间距默认取 GRID_PARAMS['initial']，基准价默认取 INITIAL_BASE_PRICE（为0时用第一根K线收盘价），档位在回测期间固定。
+"""
+
+import heapq
+import logging
+
+import numpy as np
+import pandas as pd
+
+from backtest import calculate_stats, resolve_params, setup_logging
+from config import INITIAL_PRINCIPAL
+from features import compute_features
+
+
+def make_ladder(base_price, grid_pct, levels):
+    """返回 2*levels+1 个档位价格，下标 j 对应第 k=j-levels 档，价格为 base_price*(1+grid_pct)^k，第0档即基准价"""
+    return base_price * (1 + grid_pct) ** np.arange(-levels, levels + 1, dtype=np.float64)
+
+
+def ladder_backtest(df, initial_balance=INITIAL_PRINCIPAL, params=None, levels=20, grid_pct=None, base_price=None,
+                    order_amount=None, start=0, end=None, features=None, show_progress=True):
+    """
+    多档网格回测。
+
+    参数：
+    - df / features: K线数据或已计算好的特征（二选一），start/end 为下标窗口 [start, end)
+    - levels: 基准价上下各自的档数
+    - grid_pct: 相邻两档的价格间距（小数），默认 GRID_PARAMS['initial']/100
+    - base_price: 基准价，默认 INITIAL_BASE_PRICE 或窗口第一根K线收盘价
+    - order_amount: 每档金额，默认 initial_balance/(2*levels)；下方买单全部成交所需资金与上方卖单的底仓合计不超过初始资金
+
+    返回 (results_df, trades_df, stats)，格式与 backtest_ 相同；trades_df 额外含卖出成交的档位 level（有正负），
+    stats 额外含期末挂单档数 open_buy_levels / open_sell_levels，以及底仓数量与成本 seed_units / seed_cost。
+    """
+    if features is None:
+        features = compute_features(df)
+    params = resolve_params(params)
+    if end is None:
+        end = len(features)
+    if levels <= 0:
+        raise ValueError("档位数必须为正数")
+    if grid_pct is None:
+        grid_pct = params['GRID_PARAMS']['initial'] / 100.0
+    if base_price is None:
+        base_price = params['INITIAL_BASE_PRICE'] if params['INITIAL_BASE_PRICE'] > 0 else features.prices[start]
+    if order_amount is None:
+        order_amount = initial_balance / (2 * levels)
+    if order_amount < params['MIN_TRADE_AMOUNT']:
+        raise ValueError(f"每档金额 {order_amount} 低于最小交易金额 {params['MIN_TRADE_AMOUNT']}")
+
+    times = features.times
+    prices = features.prices
+    ladder = make_ladder(base_price, grid_pct, levels)
+
+    def level_price(k):
+        return ladder[k + levels]
+
+    # 上方卖单的底仓：第 k 档卖单数量为每档金额 / 第 k-1 档价格，按窗口第一根K线收盘价买入
+    seed_price = prices[start]
+    seed = [(k, order_amount / level_price(k - 1)) for k in range(1, levels + 1)]
+    seed_units = sum(units for _, units in seed)
+    seed_cost = seed_units * seed_price
+    if order_amount * levels + seed_cost > initial_balance * (1 + 1e-12):
+        raise ValueError(f"每档金额 {order_amount} x {levels} 档买单加上底仓成本 {seed_cost:.2f} 超过初始资金 {initial_balance}")
+
+    # 买单堆：(-价格, 档位)，堆顶为价格最高、离当前价最近的买单
+    buy_heap = [(-level_price(k), k) for k in range(-levels, 0)]
+    heapq.heapify(buy_heap)
+    # 卖单堆：(价格, 档位, 数量, 买入价, 买入K线下标)，堆顶为价格最低的卖单
+    sell_heap = [(level_price(k), k, units, seed_price, start) for k, units in seed]
+    heapq.heapify(sell_heap)
+
+    cash = initial_balance - seed_cost
+    units_held = seed_units
+    equity = np.empty(end - start, dtype=np.float64)
+    trades = []
+
+    bar_range = range(start, end)
+    if show_progress:
+        from tqdm import tqdm
+        bar_range = tqdm(bar_range, desc="梯子回测进度")
+    for i in bar_range:
+        price = prices[i]
+        # 第一根K线上的委托是按当前市价新挂出的，已穿过的档位按市价成交；之后挂单均已在簿，按档位价成交
+        at_open = i == start
+
+        # 价格跌破最近的买单档位：逐档成交，并在上一档挂出卖单
+        while buy_heap and price <= -buy_heap[0][0]:
+            neg_level_price, k = heapq.heappop(buy_heap)
+            fill_price = min(-neg_level_price, price) if at_open else -neg_level_price
+            units = order_amount / fill_price
+            cash -= order_amount
+            units_held += units
+            heapq.heappush(sell_heap, (level_price(k + 1), k + 1, units, fill_price, i))
+
+        # 价格升破最近的卖单档位：逐档成交，并在下一档重新挂买单
+        while sell_heap and price >= sell_heap[0][0]:
+            level, k, units, entry_price, entry_i = heapq.heappop(sell_heap)
+            fill_price = max(level, price) if at_open else level
+            cash += units * fill_price
+            units_held -= units
+            trades.append((entry_i, i, entry_price, fill_price, units * (fill_price - entry_price), k))
+            heapq.heappush(buy_heap, (-level_price(k - 1), k - 1))
+
+        equity[i - start] = cash + units_held * price
+
+    portfolio_value = equity[-1] if len(equity) else initial_balance
+    logging.info(f"梯子回测结束 | {levels} 档 | 完成 {len(trades)} 笔网格交易 | 期末挂卖单 {len(sell_heap)} 档")
+
+    results_df = pd.DataFrame({'datetime': times[start:end], 'balance': equity})
+    trades_df = pd.DataFrame(trades, columns=['entry_i', 'exit_i', 'entry_price', 'exit_price', 'profit', 'level'])
+    trades_df.insert(0, 'exit_datetime', times[trades_df['exit_i'].to_numpy(dtype=np.int64)])
+    trades_df.insert(0, 'entry_datetime', times[trades_df['entry_i'].to_numpy(dtype=np.int64)])
+    trades_df = trades_df.drop(columns=['entry_i', 'exit_i'])
+
+    stats = calculate_stats(equity, features.time_ns[start:end], trades_df['profit'].to_numpy(), initial_balance)
+    stats['final_balance'] = portfolio_value
+    stats['profit'] = portfolio_value - initial_balance
+    stats['open_buy_levels'] = len(buy_heap)
+    stats['open_sell_levels'] = len(sell_heap)
+    stats['seed_units'] = seed_units
+    stats['seed_cost'] = seed_cost
+
+    results_df['returns'] = results_df['balance'].pct_change().fillna(0)
+
+    return results_df, trades_df, stats
+
+
+if __name__ == "__main__":
+    import time
+
+    setup_logging()
+    pkl_file = "BNBUSDT_BINANCE_2025-01-01_00_00_00_2025-05-19_23_59_59.pkl"
+    features = compute_features(pd.read_pickle(pkl_file))
+    # 档位数从几十到几百，单根K线耗时基本不变
+    for n_levels in (10, 100, 500):
+        t0 = time.perf_counter()
+        _, trades_df, stats = ladder_backtest(None, levels=n_levels, grid_pct=0.005, features=features, show_progress=False)
+        elapsed = time.perf_counter() - t0
+        print(f"\n{n_levels} 档（间距0.5%）:")
+        print(f"总交易次数: {stats['total_trades']}")
+        print(f"年化收益率: {stats['annual_return']:.2%}")
+        print(f"最大回撤: {stats['max_drawdown']:.2%}")
+        print(f"夏普比率: {stats['sharpe_ratio']:.2f}")
+        print(f"最终余额: {stats['final_balance']:.2f}")
+        print(f"耗时: {elapsed:.2f} 秒（{elapsed / len(features) * 1e6:.2f} us/K线）")
@@ -0,0 +1,239 @@
+"""
+蒙特卡洛稳健性测试
+
+单条历史路径无法反映网格与 S1 参数的尾部风险。本模块从历史1分钟对数收益率中做块自助抽样（block bootstrap），
+生成成千上万条模拟价格路径，批量回测后得到 max_drawdown、annual_return、sharpe_ratio 等指标的分布：
+- 路径按块惰性生成：每次只生成 (K线数 x chunk_paths) 的收益率、价格、波动率矩阵，由工作进程各自生成、回测、丢弃；
+  chunk_paths 默认按内存预算计算，抽样、累加和波动率都写入预分配的矩阵，不产生同样大小的临时数组；
+- batch_backtest 是 backtest_ 的批量版本：每列是一条独立资金的路径，每根K线调用与 backtest_ 相同的 grid_core.step，
+  对所有路径做向量化更新；
+- 净值不保存：回测过程中按K线流式累计每条路径的最大回撤、收益率一阶/二阶矩，最后只返回每条路径的指标；
+- 各块通过进程池分发到所有 CPU 核心，报告吞吐量（路径·K线/秒）。
+
+模拟路径沿用历史数据的时间轴（定时重置、日线 S1 参考的切分与历史一致），起始价为历史首根K线收盘价。
+"""
+
+import logging
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from backtest import resolve_params, setup_logging
+from config import INITIAL_PRINCIPAL
+from features import compute_features, load_features, rolling_volatility, NS_PER_DAY
+from grid_core import GridState, step
+from worker_pool import process_pool, worker_shared
+
+# 汇总分布时输出的分位数
+SUMMARY_QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+# 每块路径常驻内存的 (K线 x 路径) float64 矩阵：对数收益率、价格、滚动波动率
+PATH_MATRICES = 3
+
+def bootstrap_log_returns(log_returns, n_returns, n_paths, block_bars, rng, out=None):
+    """
+    块自助抽样：从历史对数收益率中随机抽取长度为 block_bars 的连续区块首尾拼接，
+    保留区块内的波动聚集和自相关。返回 (n_returns x n_paths) 数组（传入 out 时写入 out）。
+    逐块写入结果，下标临时数组只有一个区块大小。
+    """
+    block_bars = max(1, min(block_bars, len(log_returns)))
+    n_blocks = -(-n_returns // block_bars)
+    starts = rng.integers(0, len(log_returns) - block_bars + 1, size=(n_blocks, n_paths))
+    if out is None:
+        out = np.empty((n_returns, n_paths))
+    offsets = np.arange(block_bars)[:, None]
+    for b in range(n_blocks):
+        rows = out[b * block_bars:(b + 1) * block_bars]
+        rows[:] = log_returns[starts[b] + offsets[:len(rows)]]
+    return out
+
+
+def generate_paths(log_returns, start_price, n_bars, n_paths, block_bars, rng):
+    """生成一块模拟路径，返回 (价格矩阵, 对数收益率矩阵)，价格矩阵形状为 (n_bars x n_paths)"""
+    returns = bootstrap_log_returns(log_returns, n_bars - 1, n_paths, block_bars, rng)
+    prices = np.empty((n_bars, n_paths))
+    prices[0] = start_price
+    # 累加、取指数都在价格矩阵上原地进行，不产生同样大小的临时数组
+    np.cumsum(returns, axis=0, out=prices[1:])
+    np.exp(prices[1:], out=prices[1:])
+    prices[1:] *= start_price
+    return prices, returns
+
+
+def path_volatility(log_returns, bars_for_vol):
+    """
+    各路径的滚动年化波动率（与 features.rolling_volatility 相同），返回 (K线数 x 路径数) 矩阵。
+    逐列计算后写入预分配的矩阵：对整个矩阵调用 rolling_volatility 会产生约7个同样大小的临时数组，
+    逐列计算时临时数组只有一列大小。
+    """
+    n_returns, n_paths = log_returns.shape
+    out = np.empty((n_returns + 1, n_paths))
+    for j in range(n_paths):
+        out[:, j] = rolling_volatility(log_returns[:, j], bars_for_vol)
+    return out
+
+
+def iter_path_chunks(log_returns, start_price, n_bars, n_paths, chunk_paths, block_bars, seed=None):
+    """惰性逐块生成模拟路径，每块最多 chunk_paths 条；与 run_monte_carlo 使用相同的种子划分"""
+    for k, chunk_seed in enumerate(np.random.SeedSequence(seed).spawn(-(-n_paths // chunk_paths))):
+        size = min(chunk_paths, n_paths - k * chunk_paths)
+        yield generate_paths(log_returns, start_price, n_bars, size, block_bars, np.random.default_rng(chunk_seed))
+
+
+def batch_backtest(prices, log_returns, time_ns, day_ids, reset_points, initial_balance=INITIAL_PRINCIPAL, params=None):
+    """
+    对 (K线数 x 路径数) 的价格矩阵批量回测，每条路径独立资金，逐K线决策与 backtest_ 相同（grid_core.step）。
+
+    - log_returns: prices 沿第0维的对数收益率（用于滚动波动率）
+    - time_ns / day_ids / reset_points: 所有路径共用的时间戳、日编号和定时重置基准价的K线下标
+
+    不保存净值曲线，返回 {指标名: 每条路径的数组}：
+    total_trades、win_rate、final_balance、annual_return、max_drawdown、sharpe_ratio。
+    """
+    params = resolve_params(params)
+    n_bars, n_paths = prices.shape
+    volatility = path_volatility(log_returns, int(params['VOLATILITY_WINDOW'] * 60))
+
+    # 按路径排列的策略状态，每根K线由 grid_core.step 对所有路径做向量化更新
+    base_price = params['INITIAL_BASE_PRICE'] if params['INITIAL_BASE_PRICE'] > 0 else prices[0]
+    state = GridState(initial_balance, base_price, time_ns[0], params, n_lanes=n_paths)
+    # 流式统计量
+    first_equity = None
+    prev_equity = None
+    peak_equity = None
+    max_drawdown = np.zeros(n_paths)
+    sum_returns = np.zeros(n_paths)
+    sum_sq_returns = np.zeros(n_paths)
+
+    reset_set = set(np.asarray(reset_points).tolist())
+    for i in range(n_bars):
+        # 所有路径时间轴相同，跨日与定时重置基准价对所有路径同时发生
+        new_day = i == 0 or day_ids[i] != day_ids[i - 1]
+        portfolio_value, _ = step(state, i, time_ns[i], prices[i], volatility[i], new_day, i in reset_set)
+
+        # 本根K线的组合净值（交易前），流式累计回撤与收益率矩
+        if first_equity is None:
+            first_equity = portfolio_value
+            peak_equity = portfolio_value
+        else:
+            returns = portfolio_value / prev_equity - 1
+            sum_returns += returns
+            sum_sq_returns += returns * returns
+            peak_equity = np.maximum(peak_equity, portfolio_value)
+            np.minimum(max_drawdown, portfolio_value / peak_equity - 1, out=max_drawdown)
+        prev_equity = portfolio_value
+
+    final_equity = prev_equity
+    total_days = int((time_ns[-1] - time_ns[0]) // NS_PER_DAY)
+    total_years = total_days / 365.0 if total_days > 0 else 1
+    # 与 calculate_stats 一致：收益率序列首项为0，样本数为K线数
+    mean = sum_returns / n_bars
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.sqrt(np.maximum(sum_sq_returns - n_bars * mean * mean, 0.0) / (n_bars - 1)) if n_bars > 1 else np.zeros(n_paths)
+        sharpe_ratio = np.where(std > 0, mean / std * np.sqrt(365 * 24 * 60), 0.0)
+        win_rate = np.where(state.n_trades > 0, state.n_wins / state.n_trades, 0.0)
+    return {
+        'total_trades': state.n_trades.astype(np.int64),
+        'win_rate': win_rate,
+        'final_balance': final_equity,
+        'annual_return': (final_equity / first_equity) ** (1 / total_years) - 1,
+        'max_drawdown': max_drawdown,
+        'sharpe_ratio': sharpe_ratio,
+    }
+
+
+def _run_chunk(task):
+    """在工作进程中生成一块路径并批量回测，只返回每条路径的指标"""
+    chunk_seed, size = task
+    s = worker_shared()
+    prices, returns = generate_paths(s['log_returns'], s['start_price'], s['n_bars'], size, s['block_bars'],
+                                     np.random.default_rng(chunk_seed))
+    return batch_backtest(prices, returns, s['time_ns'], s['day_ids'], s['reset_points'], s['initial_balance'], s['params'])
+
+
+def summarize(paths, quantiles=SUMMARY_QUANTILES):
+    """各指标的均值与分位数，行为指标、列为统计量"""
+    metrics = ['max_drawdown', 'annual_return', 'sharpe_ratio', 'final_balance', 'total_trades', 'win_rate']
+    summary = paths[metrics].quantile(list(quantiles)).T
+    summary.columns = [f'p{round(q * 100)}' for q in quantiles]
+    summary.insert(0, 'mean', paths[metrics].mean())
+    return summary
+
+
+def chunk_paths_for_budget(n_bars, memory_budget_mb, max_workers):
+    """按内存预算确定每块路径数：所有工作进程同时各持有一块，每块约 n_bars x 路径数 x 8 字节 x PATH_MATRICES"""
+    per_worker = memory_budget_mb * 2 ** 20 / max_workers
+    return max(1, int(per_worker // (n_bars * 8 * PATH_MATRICES)))
+
+
+def run_monte_carlo(df, n_paths=1000, block_bars=1440, chunk_paths=None, n_bars=None, params=None,
+                    initial_balance=INITIAL_PRINCIPAL, seed=None, max_workers=None, features=None, memory_budget_mb=1024):
+    """
+    生成 n_paths 条块自助抽样路径并批量回测。
+
+    参数：
+    - df / features: 历史K线数据或已计算好的特征（二选一）
+    - block_bars: 抽样区块长度（K线根数），默认1天
+    - chunk_paths: 每块路径数，决定单个工作进程的内存占用（约 n_bars x chunk_paths x 8 字节 x 3：
+      对数收益率、价格、滚动波动率三个矩阵）；默认按 memory_budget_mb 计算，且不超过 n_paths / 进程数，
+      使每个进程都分到路径。相同 seed 和 chunk_paths 得到相同路径
+    - memory_budget_mb: 所有工作进程合计的路径矩阵内存预算（MB），仅在未指定 chunk_paths 时使用
+    - n_bars: 每条路径长度，默认与历史数据相同（最长不超过历史数据）
+    - params: 覆盖 config 默认值的策略参数（见 backtest.resolve_params）
+    - seed: 随机种子，相同种子得到相同路径
+
+    返回 dict：paths（每条路径一行的指标 DataFrame）、summary（指标分布汇总）、
+    elapsed（秒）、path_bars_per_second（吞吐量）。
+    """
+    if features is None:
+        features = compute_features(df)
+    n_bars = len(features) if n_bars is None else min(n_bars, len(features))
+    resolved = resolve_params(params)
+    state = {
+        'log_returns': features.log_returns,
+        'start_price': features.prices[0],
+        'n_bars': n_bars,
+        'block_bars': block_bars,
+        'time_ns': features.time_ns[:n_bars],
+        'day_ids': features.day_ids[:n_bars],
+        'reset_points': features.get_reset_points(resolved['RESET_INTERVAL_SECONDS'], 0, n_bars),
+        'initial_balance': initial_balance,
+        'params': params,   # 传原始覆盖项，由工作进程各自解析（FLIP_THRESHOLD 函数无法跨进程传递）
+    }
+    max_workers = max_workers or os.cpu_count()
+    if chunk_paths is None:
+        chunk_paths = min(chunk_paths_for_budget(n_bars, memory_budget_mb, max_workers), -(-n_paths // max_workers))
+    n_chunks = -(-n_paths // chunk_paths)
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    tasks = [(chunk_seed, min(chunk_paths, n_paths - k * chunk_paths)) for k, chunk_seed in enumerate(seeds)]
+
+    logging.info(f"蒙特卡洛：{n_paths} 条路径 x {n_bars} 根K线，{n_chunks} 块（每块 {chunk_paths} 条，"
+                 f"约 {n_bars * chunk_paths * 8 * PATH_MATRICES / 2 ** 20:.0f} MB），{max_workers} 个进程")
+    t0 = time.perf_counter()
+    with process_pool(state, max_workers) as pool:
+        chunks = list(pool.map(_run_chunk, tasks))
+    elapsed = time.perf_counter() - t0
+
+    paths = pd.DataFrame({name: np.concatenate([c[name] for c in chunks]) for name in chunks[0]})
+    path_bars_per_second = n_paths * n_bars / elapsed if elapsed > 0 else math.inf
+    logging.info(f"蒙特卡洛完成：耗时 {elapsed:.1f} 秒，{path_bars_per_second:,.0f} 路径·K线/秒")
+    return {
+        'paths': paths,
+        'summary': summarize(paths),
+        'elapsed': elapsed,
+        'path_bars_per_second': path_bars_per_second,
+    }
+
+
+if __name__ == "__main__":
+    setup_logging()
+    pkl_file = "BNBUSDT_BINANCE_2025-01-01_00_00_00_2025-05-19_23_59_59.pkl"
+    features = load_features(pkl_file)
+    mc = run_monte_carlo(None, n_paths=2000, block_bars=1440, seed=42, features=features)
+
+    pd.set_option('display.width', 200)
+    print("\n蒙特卡洛指标分布:")
+    print(mc['summary'].to_string(float_format=lambda x: f"{x:.4f}"))
+    print(f"\n吞吐量: {mc['path_bars_per_second']:,.0f} 路径·K线/秒（耗时 {mc['elapsed']:.1f} 秒）")
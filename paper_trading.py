@@ -0,0 +1,232 @@
+"""
+异步模拟盘（paper trading）
+
+在实时K线/成交行情流上逐根驱动 grid_strategy.GridStrategy，下单意图交给 SimulatedExchange 撮合：
+- 行情：Binance 格式的 kline（只处理已收盘K线 "x": true）或 trade/aggTrade（聚合成1分钟K线后驱动策略）；
+- 风控：按 RISK_CHECK_INTERVAL 秒周期性执行 strategy.risk_check()；
+- 超时：收到的行情事件时间落后本地时钟超过 RECV_WINDOW 毫秒时丢弃（仅实盘行情启用）；
+- 延迟：记录每条触发决策的消息从收到到决策完成的耗时，报告 p50/p99（目标亚毫秒）。
+
+实时行情通过 websocket-client 连接；本地回放把历史K线转换为同格式的 kline 消息在进程内直接驱动，
+便于在没有交易所连接时测试整条链路。
+
+命令行：
+    python paper_trading.py --replay BNBUSDT_xxx.pkl            # 本地回放（进程内）
+    python paper_trading.py --url wss://fstream.binance.com/ws/bnbusdt@kline_1m
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+import numpy as np
+import websocket
+
+from config import INITIAL_PRINCIPAL, RISK_CHECK_INTERVAL, RECV_WINDOW, API_TIMEOUT
+from features import NS_PER_SECOND, load_features
+from grid_strategy import DEFAULT_TZ, GridStrategy
+
+NS_PER_MS = 1_000_000
+NS_PER_MINUTE = 60 * NS_PER_SECOND
+
+
+# ---------------------------------------------------------------- 行情源
+
+async def websocket_messages(url, open_timeout=API_TIMEOUT / 1000):
+    """
+    连接 ws:// 或 wss:// 地址，逐条产出文本消息，服务端关闭时结束（ping/pong 由 websocket-client 自动处理）。
+    websocket-client 是同步库，连接和接收放到线程中执行，不阻塞事件循环上的风控检查。
+    """
+    ws = await asyncio.to_thread(websocket.create_connection, url, timeout=open_timeout)
+    ws.settimeout(None)  # open_timeout 只用于建立连接，行情可能长时间没有推送
+    try:
+        while True:
+            try:
+                message = await asyncio.to_thread(ws.recv)
+            except websocket.WebSocketConnectionClosedException:
+                break
+            if message == '':  # 服务端关闭连接
+                break
+            yield message
+    finally:
+        ws.close()
+
+
+async def replay_messages(messages, yield_every=256):
+    """把本地消息序列包装为异步消息流，每 yield_every 条让出一次事件循环（风控检查得以运行）"""
+    for count, message in enumerate(messages, 1):
+        yield message
+        if count % yield_every == 0:
+            await asyncio.sleep(0)
+
+
+def kline_messages(features, symbol='BNBUSDT', start=0, end=None):
+    """把历史K线转换为 Binance kline 推送格式（已收盘），用于本地回放"""
+    end = len(features) if end is None else end
+    for t_ns, price in zip(features.time_ns[start:end].tolist(), features.prices[start:end].tolist()):
+        open_ms = t_ns // NS_PER_MS
+        yield json.dumps({'e': 'kline', 'E': open_ms + 60_000, 's': symbol,
+                          'k': {'t': open_ms, 'T': open_ms + 59_999, 'c': repr(price), 'x': True}})
+
+
+# ---------------------------------------------------------------- 模拟交易所
+
+class SimulatedExchange:
+    """
+    模拟撮合：按下单价格立即成交，扣除手续费，余额不足时拒单。
+    作为 GridStrategy 的 execute 回调使用，返回 (到账数量, 成交价, 成交金额)：
+    买入时成交金额为支付的 USDT，手续费从到账的币中扣除；卖出时成交金额为扣除手续费后收到的 USDT。
+    成交记录保存在 orders 中。
+    """
+
+    def __init__(self, quote_balance=INITIAL_PRINCIPAL, fee_rate=0.0):
+        self.quote_balance = quote_balance
+        self.base_balance = 0.0
+        self.fee_rate = fee_rate
+        self.orders = []
+
+    def execute(self, side, units, price, reason):
+        if side == 'buy':
+            quote = units * price
+            if quote > self.quote_balance + 1e-9:
+                self.orders.append({'side': side, 'units': units, 'price': price, 'reason': reason, 'status': 'rejected'})
+                return None
+            self.quote_balance -= quote
+            filled = units * (1 - self.fee_rate)
+            self.base_balance += filled
+        else:
+            filled = min(units, self.base_balance)
+            quote = filled * price * (1 - self.fee_rate)
+            self.base_balance -= filled
+            self.quote_balance += quote
+        self.orders.append({'side': side, 'units': filled, 'price': price, 'quote': quote, 'reason': reason,
+                            'status': 'filled', 'time_ns': time.time_ns()})
+        return filled, price, quote
+
+
+# ---------------------------------------------------------------- 模拟盘主循环
+
+class PaperTrader:
+    def __init__(self, strategy=None, exchange=None, risk_check_interval=RISK_CHECK_INTERVAL,
+                 recv_window_ms=None, initial_balance=INITIAL_PRINCIPAL, params=None, tz=DEFAULT_TZ):
+        """
+        - risk_check_interval: 风控检查周期（秒）
+        - recv_window_ms: 丢弃事件时间落后本地时钟超过该毫秒数的行情，None 表示不检查（本地回放时）；
+          连接真实行情时传 config.RECV_WINDOW
+        - tz: 策略划分自然日的时区（见 GridStrategy），回放历史数据时取数据自带的时区
+        """
+        self.exchange = exchange or SimulatedExchange(initial_balance)
+        self.strategy = strategy or GridStrategy(initial_balance, params=params, execute=self.exchange.execute, tz=tz)
+        self.risk_check_interval = risk_check_interval
+        self.recv_window_ms = recv_window_ms
+        self.latencies_ns = []
+        self.stale_messages = 0
+        self.risk_alerts = []
+        self._bar_minute = None   # 成交流聚合中的当前分钟
+        self._bar_close = None
+
+    def _decide(self, t_ns, price, received_ns):
+        self.strategy.on_bar(t_ns, price)
+        self.latencies_ns.append(time.perf_counter_ns() - received_ns)
+
+    def handle_message(self, raw, received_ns=None):
+        """处理一条行情消息，产生决策时记录延迟"""
+        received_ns = received_ns or time.perf_counter_ns()
+        msg = json.loads(raw)
+        if 'data' in msg:  # 组合流格式 {"stream": ..., "data": {...}}
+            msg = msg['data']
+        if self.recv_window_ms is not None and 'E' in msg and time.time() * 1000 - msg['E'] > self.recv_window_ms:
+            self.stale_messages += 1
+            return
+        event = msg.get('e')
+        if event == 'kline':
+            k = msg['k']
+            if k.get('x'):
+                self._decide(int(k['t']) * NS_PER_MS, float(k['c']), received_ns)
+        elif event in ('trade', 'aggTrade'):
+            # 成交聚合为1分钟K线：新分钟的第一笔成交到达时，上一分钟收盘并驱动策略
+            t_ns = int(msg['T']) * NS_PER_MS
+            minute = t_ns // NS_PER_MINUTE
+            if self._bar_minute is not None and minute > self._bar_minute:
+                self._decide(self._bar_minute * NS_PER_MINUTE, self._bar_close, received_ns)
+            if self._bar_minute is None or minute >= self._bar_minute:
+                self._bar_minute = minute
+                self._bar_close = float(msg['p'])
+
+    def flush(self):
+        """行情流结束时，用成交流聚合中尚未收盘的最后一分钟驱动一次策略"""
+        if self._bar_minute is not None:
+            self._decide(self._bar_minute * NS_PER_MINUTE, self._bar_close, time.perf_counter_ns())
+            self._bar_minute = None
+            self._bar_close = None
+
+    async def _risk_loop(self):
+        while True:
+            await asyncio.sleep(self.risk_check_interval)
+            alerts = self.strategy.risk_check()
+            if alerts:
+                self.risk_alerts.append((time.time(), alerts))
+                logging.warning(f"风控告警: {alerts} | 净值 {self.strategy.portfolio_value:.2f}")
+
+    async def run(self, messages):
+        """消费异步消息流直至结束，同时按周期执行风控检查"""
+        risk_task = asyncio.create_task(self._risk_loop())
+        try:
+            async for raw in messages:
+                self.handle_message(raw, time.perf_counter_ns())
+            self.flush()
+        finally:
+            risk_task.cancel()
+        return self.report()
+
+    def report(self):
+        latencies = np.asarray(self.latencies_ns, dtype=np.float64) / 1000.0
+        return {
+            'decisions': len(latencies),
+            'latency_p50_us': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'latency_p99_us': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'latency_max_us': float(latencies.max()) if len(latencies) else None,
+            'stale_messages': self.stale_messages,
+            'fills': sum(1 for o in self.exchange.orders if o['status'] == 'filled'),
+            'rejected': sum(1 for o in self.exchange.orders if o['status'] == 'rejected'),
+            'trades': len(self.strategy.trades),
+            'portfolio_value': self.strategy.portfolio_value,
+            'risk_alerts': len(self.risk_alerts),
+        }
+
+
+async def replay(features, initial_balance=INITIAL_PRINCIPAL, params=None, risk_check_interval=RISK_CHECK_INTERVAL,
+                 start=0, end=None):
+    """在进程内把历史K线按 kline 推送格式回放给模拟盘，返回报告；策略按数据自带的时区切分自然日"""
+    tz = getattr(features.times, 'tz', None)
+    trader = PaperTrader(initial_balance=initial_balance, params=params, risk_check_interval=risk_check_interval,
+                         tz=str(tz) if tz is not None else None)
+    return await trader.run(replay_messages(kline_messages(features, start=start, end=end)))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser(description="异步模拟盘")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--replay', help="回放本地K线数据文件（pkl）")
+    source.add_argument('--url', help="行情 websocket 地址，如 wss://fstream.binance.com/ws/bnbusdt@kline_1m")
+    args = parser.parse_args()
+
+    if args.replay:
+        report = asyncio.run(replay(load_features(args.replay)))
+    else:
+        trader = PaperTrader(recv_window_ms=RECV_WINDOW)
+        report = asyncio.run(trader.run(websocket_messages(args.url)))
+
+    print("\n模拟盘报告:")
+    print(f"决策次数: {report['decisions']}")
+    if report['decisions']:
+        print(f"决策延迟 p50: {report['latency_p50_us']:.1f} us，p99: {report['latency_p99_us']:.1f} us")
+    print(f"成交笔数: {report['fills']}（拒单 {report['rejected']}）")
+    print(f"账户净值: {report['portfolio_value']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+基于逐次减半（successive halving）的参数搜索
+
+穷举 波动率→网格表、FLIP_THRESHOLD、RISK_FACTOR、S1 目标仓位 等参数组合的代价随维度指数增长。
+逐次减半的做法：
+1. 先在很短的数据前缀上评估全部候选参数；
+2. 每一轮只保留排名前 1/eta 的参数，并把评估区间扩大 eta 倍；
+3. 直到剩余参数在完整区间上评估完毕。
+
+每次回测都启用 config.RISK_PARAMS 风控（backtest_ 的 stop_on_risk）：运行中回撤跌破 MAX_DRAWDOWN
+或日内亏损跌破 DAILY_LOSS_LIMIT 的参数立即终止并淘汰，不再消耗后续K线的计算时间。
+"""
+
+import logging
+import math
+import random
+
+from backtest import resolve_params, setup_logging
+from config import INITIAL_PRINCIPAL
+from features import compute_features, load_features
+from walk_forward import expand_param_grid
+from worker_pool import process_pool, run_window
+
+
+def _score(stats, metric):
+    """触发风控的参数直接淘汰；指标缺失或为 NaN 时排在最后"""
+    if stats.get('risk_stop'):
+        return float('-inf')
+    value = stats.get(metric, float('nan'))
+    return value if value is not None and not math.isnan(value) else float('-inf')
+
+
+def make_rung_spans(total_bars, min_bars, eta=3):
+    """生成每一轮的评估区间长度：min_bars, min_bars*eta, ...，最后一轮为完整区间（要求 min_bars >= 1、eta >= 2）"""
+    if min_bars < 1 or eta < 2:
+        raise ValueError(f"min_bars 必须 >= 1 且 eta 必须 >= 2（当前 min_bars={min_bars}, eta={eta}）")
+    spans = []
+    span = min_bars
+    while span < total_bars:
+        spans.append(span)
+        span *= eta
+    spans.append(total_bars)
+    return spans
+
+
+def successive_halving(df, param_grid, min_bars=3 * 1440, eta=3, metric='sharpe_ratio', n_samples=None,
+                       seed=None, start=0, end=None, initial_balance=INITIAL_PRINCIPAL, max_workers=None,
+                       features=None):
+    """
+    逐次减半搜索最优参数。
+
+    参数：
+    - df / features: K线数据或已计算好的特征（二选一）
+    - param_grid: {参数名: [候选值]}，或已展开的参数字典列表
+    - min_bars: 第一轮评估使用的K线数；eta: 每轮淘汰比例与区间放大倍数
+    - n_samples: 若指定，则从参数网格中随机抽取该数量的候选参数
+    - start / end: 搜索使用的数据下标范围
+
+    返回 dict：
+    - best_params / best_stats: 最终胜出的参数及其完整区间统计
+    - rungs: 每轮的区间长度、候选数、触发风控的数量
+    - leaderboard: 最后一轮的 (参数, 统计) 按指标降序排列
+    - bars_evaluated / cost_ratio: 实际回测的K线总数，及其相对完整网格穷举的比例
+    """
+    if min_bars < 1:
+        raise ValueError(f"min_bars 必须 >= 1（当前为 {min_bars}）")
+    if eta < 2:
+        raise ValueError(f"eta 必须 >= 2（当前为 {eta}）")
+    if initial_balance <= 0:
+        # 开启风控时按净值/历史最高净值计算回撤，初始资金为0会在工作进程中除零
+        raise ValueError(f"initial_balance 必须为正数（当前为 {initial_balance}），请检查 .env 中的 INITIAL_PRINCIPAL")
+    if features is None:
+        features = compute_features(df)
+    if end is None:
+        end = len(features)
+    candidates = expand_param_grid(param_grid) if isinstance(param_grid, dict) else list(param_grid)
+    if n_samples is not None and n_samples < len(candidates):
+        candidates = random.Random(seed).sample(candidates, n_samples)
+    full_grid_bars = len(candidates) * (end - start)
+
+    rungs = []
+    bars_evaluated = 0
+    survivors = candidates
+    with process_pool(features, max_workers) as pool:
+        spans = make_rung_spans(end - start, min_bars, eta)
+        for rung_no, span in enumerate(spans):
+            tasks = [(start, start + span, params, initial_balance, True, False) for params in survivors]
+            outputs = list(pool.map(run_window, tasks))
+            bars_evaluated += sum(bars for _, bars, _ in outputs)
+            ranked = sorted(zip(survivors, (stats for stats, _, _ in outputs)),
+                            key=lambda item: _score(item[1], metric), reverse=True)
+            alive = [item for item in ranked if not item[1].get('risk_stop')]
+            rungs.append({'bars': span, 'candidates': len(survivors), 'risk_stopped': len(ranked) - len(alive)})
+            logging.info(f"第 {rung_no + 1} 轮 | 区间 {span} 根K线 | 候选 {len(survivors)} | 触发风控 {len(ranked) - len(alive)}")
+            if rung_no == len(spans) - 1 or not alive:
+                break
+            survivors = [params for params, _ in alive[:max(1, len(survivors) // eta)]]
+
+    if not alive:
+        raise RuntimeError("所有候选参数均触发了风控限制，请放宽 MAX_DRAWDOWN / DAILY_LOSS_LIMIT 或调整参数网格")
+    best_params, best_stats = alive[0]
+    return {
+        'best_params': best_params,
+        'best_stats': best_stats,
+        'rungs': rungs,
+        'leaderboard': alive,
+        'bars_evaluated': bars_evaluated,
+        'cost_ratio': bars_evaluated / full_grid_bars if full_grid_bars else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    setup_logging()
+    pkl_file = "BNBUSDT_BINANCE_2025-01-01_00_00_00_2025-05-19_23_59_59.pkl"
+    # 特征缓存在数据文件旁，重复运行时直接内存映射
+    defaults = resolve_params()
+    features = load_features(pkl_file, volatility_bars=[int(defaults['VOLATILITY_WINDOW'] * 60)],
+                             reset_intervals=[defaults['RESET_INTERVAL_SECONDS']])
+    param_grid = {
+        'FLIP_THRESHOLD': [0.1, 0.15, 0.2, 0.25, 0.3],
+        'RISK_FACTOR': [0.05, 0.1, 0.15, 0.2],
+        'S1_SELL_TARGET_PCT': [0.4, 0.5, 0.6],
+        'S1_BUY_TARGET_PCT': [0.6, 0.7, 0.8],
+    }
+    result = successive_halving(None, param_grid, features=features)
+
+    print("\n逐次减半搜索结果:")
+    print(f"最优参数: {result['best_params']}")
+    print(f"夏普比率: {result['best_stats']['sharpe_ratio']:.2f}")
+    print(f"最大回撤: {result['best_stats']['max_drawdown']:.2%}")
+    print(f"年化收益率: {result['best_stats']['annual_return']:.2%}")
+    print(f"计算量占完整网格比例: {result['cost_ratio']:.1%}")
@@ -0,0 +1,243 @@
+"""
+多代币共享资金的组合网格回测
+
+实盘中十几个交易对的网格共用同一个 USDT 资金池。本模块：
+1. 把各代币的K线按时间合并为一条统一时间轴，生成 (K线 x 代币) 的对齐价格矩阵
+   （某代币尚未上市或缺K线时沿用上一根价格，且上市前不参与交易）；
+2. 每个代币维护一套与 backtest_ 相同的网格状态机（买入/卖出监控、翻转阈值、定时重置基准价、卖出后动态调整网格），
+   状态全部存放在按代币排列的 numpy 数组中，每根K线对所有代币做向量化更新，不做逐代币的 Python 循环；
+3. 所有代币共用一个现金余额，并按组合整体仓位比例执行 MIN/MAX_POSITION_RATIO 检查：
+   - 买入：同一根K线上的买单按代币顺序累计，总仓位不超过 MAX_POSITION_RATIO，且不超过可用现金；
+   - 卖出：组合仓位比例达到 MIN_POSITION_RATIO 后，网格卖出只卖出高于该下限的部分（底仓保护），
+     按代币顺序累计，超出部分缩减为部分卖出，剩余仓位保留为底仓、等下一次卖出信号；
+     建仓初期比例尚未达到下限时不做限制。
+
+S1 日线仓位调整的目标仓位是针对单一账户单一代币定义的，组合模式中不启用。
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from backtest import resolve_params, calculate_stats, read_pkl_data, setup_logging
+from config import INITIAL_PRINCIPAL
+from features import BacktestFeatures, compute_features, rolling_volatility, NS_PER_SECOND
+from grid_core import grid_adjust_seconds, trade_amounts, volatility_grid
+
+
+def align_symbols(data):
+    """
+    将 {代币: DataFrame 或 BacktestFeatures} 合并到统一时间轴。
+
+    返回 (symbols, times, time_ns, prices, first_idx)：
+    - times / time_ns: 合并后的时间标签与 int64 纳秒时间戳
+    - prices: (K线数 x 代币数) float64 价格矩阵，缺失K线用上一根价格填充，上市前用首根价格填充
+    - first_idx: 每个代币首根K线在统一时间轴上的下标
+    """
+    symbols = list(data)
+    feats = [d if isinstance(d, BacktestFeatures) else compute_features(d) for d in data.values()]
+    time_ns = np.unique(np.concatenate([f.time_ns for f in feats]))
+    n_bars = len(time_ns)
+
+    prices = np.empty((n_bars, len(symbols)), dtype=np.float64)
+    first_idx = np.empty(len(symbols), dtype=np.int64)
+    for k, f in enumerate(feats):
+        # src[j] 为统一时间轴第 j 根K线对应的本代币K线下标（向前填充）
+        src = np.full(n_bars, -1, dtype=np.int64)
+        src[np.searchsorted(time_ns, f.time_ns)] = np.arange(len(f.time_ns))
+        np.maximum.accumulate(src, out=src)
+        first_idx[k] = np.searchsorted(time_ns, f.time_ns[0])
+        prices[:, k] = f.prices[np.maximum(src, 0)]
+
+    tz = getattr(feats[0].times, 'tz', None)
+    times = pd.DatetimeIndex(time_ns)
+    if tz is not None:
+        times = times.tz_localize('UTC').tz_convert(tz)
+    return symbols, times, time_ns, prices, first_idx
+
+
+def portfolio_backtest(data, initial_balance=INITIAL_PRINCIPAL, params=None, show_progress=True):
+    """
+    多代币共享资金回测。
+
+    参数：
+    - data: {代币: DataFrame 或 BacktestFeatures}
+    - params: 覆盖 config 默认值的策略参数（见 backtest.resolve_params），对所有代币生效
+
+    返回 (results_df, trades_df, stats)，results_df 含组合净值 balance 与现金 cash，
+    trades_df 每行一笔网格卖出（含 symbol 列），stats 在整体指标之外附带 per_symbol 明细。
+    """
+    params = resolve_params(params)
+    symbols, times, time_ns, prices, first_idx = align_symbols(data)
+    n_bars, n_symbols = prices.shape
+    grid_params = params['GRID_PARAMS']
+    flip_threshold = params['FLIP_THRESHOLD']
+    max_ratio = params['MAX_POSITION_RATIO']
+    min_ratio = params['MIN_POSITION_RATIO']
+    reset_interval_ns = params['RESET_INTERVAL_SECONDS'] * NS_PER_SECOND
+
+    # 各代币的滚动波动率矩阵一次性算好
+    volatility = rolling_volatility(np.diff(np.log(prices), axis=0), int(params['VOLATILITY_WINDOW'] * 60))
+
+    # 按代币排列的状态数组
+    long = np.zeros(n_symbols, dtype=bool)
+    units = np.zeros(n_symbols)
+    buy_price = np.zeros(n_symbols)
+    buy_i = np.zeros(n_symbols, dtype=np.int64)
+    base_price = prices[first_idx, np.arange(n_symbols)].copy()
+    if params['INITIAL_BASE_PRICE'] > 0 and n_symbols == 1:
+        base_price[:] = params['INITIAL_BASE_PRICE']
+    grid_value = np.full(n_symbols, float(grid_params['initial']))
+    buy_monitoring = np.zeros(n_symbols, dtype=bool)
+    buy_min_price = np.zeros(n_symbols)
+    sell_monitoring = np.zeros(n_symbols, dtype=bool)
+    sell_max_price = np.zeros(n_symbols)
+    last_reset_ns = time_ns[first_idx].copy()
+    last_grid_adjust_ns = time_ns[first_idx].copy()
+    # 各代币历史成交统计（用于凯利仓位）
+    n_trades = np.zeros(n_symbols)
+    n_wins = np.zeros(n_symbols)
+    sum_win = np.zeros(n_symbols)
+    n_losses = np.zeros(n_symbols)
+    sum_loss = np.zeros(n_symbols)
+
+    cash = float(initial_balance)
+    equity = np.empty(n_bars)
+    cash_curve = np.empty(n_bars)
+    trades = []
+
+    bar_range = range(n_bars)
+    if show_progress:
+        from tqdm import tqdm
+        bar_range = tqdm(bar_range, desc="组合回测进度")
+    for i in bar_range:
+        price = prices[i]
+        t = time_ns[i]
+        active = first_idx <= i
+
+        # 每隔固定时间间隔重置基准价
+        reset = active & (t - last_reset_ns >= reset_interval_ns)
+        if reset.any():
+            base_price[reset] = price[reset]
+            last_reset_ns[reset] = t
+
+        position_values = units * price
+        position_value = position_values.sum()
+        portfolio_value = cash + position_value
+        equity[i] = portfolio_value
+        cash_curve[i] = cash
+        grid_pct = grid_value / 100.0
+        threshold = base_price * grid_pct * flip_threshold(grid_value)
+
+        # 持仓代币：监控卖出信号
+        held = active & long
+        start_sell = held & ~sell_monitoring & (price >= base_price * (1 + grid_pct))
+        sell_max_price[start_sell] = price[start_sell]
+        sell_monitoring |= start_sell
+        if sell_monitoring.any():
+            np.maximum(sell_max_price, price, out=sell_max_price, where=sell_monitoring)
+            sell = sell_monitoring & (price <= sell_max_price - threshold)
+            sell_units = np.where(sell, units, 0.0)
+            # 底仓保护：组合仓位比例已达到 MIN_POSITION_RATIO 时，按代币顺序累计的卖出只卖到下限为止
+            if sell.any() and portfolio_value > 0 and position_value >= min_ratio * portfolio_value:
+                sell_idx = np.flatnonzero(sell)
+                headroom = position_value - min_ratio * portfolio_value
+                sold_before = np.concatenate([[0.0], np.cumsum(position_values[sell_idx])[:-1]])
+                sell_units[sell_idx] *= np.clip((headroom - sold_before) / position_values[sell_idx], 0.0, 1.0)
+                sell &= sell_units > 0
+            if sell.any():
+                sold = sell_units[sell]
+                profit = sold * (price[sell] - buy_price[sell])
+                cash += (sold * price[sell]).sum()
+                for k, entry_i, entry_price, exit_price, p in zip(np.flatnonzero(sell), buy_i[sell], buy_price[sell], price[sell], profit):
+                    trades.append((k, entry_i, i, entry_price, exit_price, p))
+                n_trades[sell] += 1
+                n_wins[sell] += profit > 0
+                sum_win[sell] += np.where(profit > 0, profit, 0.0)
+                n_losses[sell] += profit < 0
+                sum_loss[sell] += np.where(profit < 0, -profit, 0.0)
+                base_price[sell] = price[sell]
+                units[sell] -= sold
+                long[sell] = units[sell] > 0  # 部分卖出时剩余仓位继续持有
+                sell_monitoring[sell] = False
+
+                # 动态网格调整
+                vol = volatility[i]
+                adjust = sell & ~np.isnan(vol)
+                if adjust.any():
+                    adjust &= (t - last_grid_adjust_ns) / NS_PER_SECOND >= grid_adjust_seconds(vol, params)
+                    if adjust.any():
+                        grid_value[adjust] = volatility_grid(vol, params)[adjust]
+                        last_grid_adjust_ns[adjust] = t
+
+        # 空仓代币（本K线开始时即为空仓）：监控买入信号
+        flat = active & ~long & ~held
+        start_buy = flat & ~buy_monitoring & (price <= base_price * (1 - grid_pct))
+        buy_min_price[start_buy] = price[start_buy]
+        buy_monitoring |= start_buy
+        if buy_monitoring.any():
+            np.minimum(buy_min_price, price, out=buy_min_price, where=buy_monitoring)
+            buy = buy_monitoring & (price >= buy_min_price + threshold)
+            if buy.any():
+                vol = np.nan_to_num(volatility[i][buy], nan=0.0)
+                amounts = trade_amounts(portfolio_value, vol, n_trades[buy], n_wins[buy], sum_win[buy],
+                                         n_losses[buy], sum_loss[buy], params)
+                # 共享资金：按代币顺序累计，不超过可用现金和组合最大仓位
+                position_value = (units * price).sum()
+                capacity = min(cash, max_ratio * portfolio_value - position_value)
+                accepted = np.cumsum(amounts) <= capacity
+                if accepted.any():
+                    filled = np.flatnonzero(buy)[accepted]
+                    units[filled] = amounts[accepted] / price[filled]
+                    buy_price[filled] = price[filled]
+                    buy_i[filled] = i
+                    long[filled] = True
+                    buy_monitoring[filled] = False
+                    cash -= amounts[accepted].sum()
+
+    final_value = cash + (units * prices[-1]).sum()
+    results_df = pd.DataFrame({'datetime': times, 'balance': equity, 'cash': cash_curve})
+    trades_arr = np.array(trades, dtype=np.float64).reshape(-1, 6)
+    sym_idx = trades_arr[:, 0].astype(np.int64)
+    trades_df = pd.DataFrame({
+        'symbol': np.array(symbols, dtype=object)[sym_idx],
+        'entry_datetime': times[trades_arr[:, 1].astype(np.int64)],
+        'exit_datetime': times[trades_arr[:, 2].astype(np.int64)],
+        'entry_price': trades_arr[:, 3],
+        'exit_price': trades_arr[:, 4],
+        'profit': trades_arr[:, 5],
+    })
+
+    stats = calculate_stats(equity, time_ns, trades_df['profit'].to_numpy(), initial_balance)
+    stats['final_balance'] = final_value
+    stats['profit'] = final_value - initial_balance
+    stats['per_symbol'] = {
+        symbol: {
+            'total_trades': int(n_trades[k]),
+            'winning_trades': int(n_wins[k]),
+            'profit': float(trades_arr[sym_idx == k, 5].sum()),
+        }
+        for k, symbol in enumerate(symbols)
+    }
+    logging.info(f"组合回测完成：{n_symbols} 个代币，{n_bars} 根K线，{len(trades_df)} 笔成交")
+    return results_df, trades_df, stats
+
+
+if __name__ == "__main__":
+    setup_logging()
+    pkl_files = {
+        'BNBUSDT': "BNBUSDT_BINANCE_2025-01-01_00_00_00_2025-05-19_23_59_59.pkl",
+    }
+    data = {symbol: read_pkl_data(path) for symbol, path in pkl_files.items()}
+    results_df, trades_df, stats = portfolio_backtest(data)
+
+    print("\n组合策略统计:")
+    print(f"总交易次数: {stats['total_trades']}")
+    print(f"胜率: {stats['win_rate']:.2%}")
+    print(f"年化收益率: {stats['annual_return']:.2%}")
+    print(f"最大回撤: {stats['max_drawdown']:.2%}")
+    print(f"夏普比率: {stats['sharpe_ratio']:.2f}")
+    print(f"最终余额: {stats['final_balance']:.2f}")
+    for symbol, s in stats['per_symbol'].items():
+        print(f"  {symbol}: 交易 {s['total_trades']} 次，收益 {s['profit']:.2f}")
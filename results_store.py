@@ -0,0 +1,271 @@
+"""
+参数扫描结果库
+
+每次回测一行记录（参数、stats、数据集 id 与下标区间、初始资金、数据时区、引擎版本、耗时），存放在 SQLite 中：
+- 关键指标（sharpe_ratio、max_drawdown、annual_return 等）是独立的列并建有索引，
+  例如"夏普最高的 50 组参数且最大回撤 > -10%"只需沿 sharpe_ratio 索引扫描即可返回；
+- 参数展开为 (run_id, 参数名, 数值/文本) 的行并按 (参数名, 值) 建索引，支持按参数过滤；
+- 净值曲线和成交明细按列保存为 runs/<run_id>/<列名>.npy 旁路文件，加载时用 np.load(mmap_mode='r') 内存映射，
+  不拷贝数据；compress=True 时改为保存压缩的 .npz（体积更小，但加载需要解压）。
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from backtest import ENGINE_VERSION, params_to_json
+
+# 单独成列并建索引的指标
+INDEXED_METRICS = ('sharpe_ratio', 'max_drawdown', 'annual_return', 'win_rate', 'total_trades', 'final_balance', 'profit_loss_ratio')
+
+
+# 后加入 runs 表的列，打开旧结果库时自动补上
+_RUN_COLUMNS = (('start_bar', 'INTEGER'), ('end_bar', 'INTEGER'), ('initial_balance', 'REAL'), ('tz', 'TEXT'))
+
+
+def make_run_id(dataset_id, params, engine_version=ENGINE_VERSION, start=None, end=None, initial_balance=None):
+    """
+    同一数据集切片（下标区间 [start, end)）、初始资金、参数和引擎版本得到同一个 run_id，重复写入时覆盖而不是新增
+    """
+    payload = json.dumps({'dataset': dataset_id, 'start': _to_int(start), 'end': _to_int(end),
+                          'initial_balance': _to_float(initial_balance), 'params': params_to_json(params),
+                          'engine': engine_version}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def _to_int(value):
+    return None if value is None else int(value)
+
+
+def _to_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if np.isnan(value) else value
+
+
+def _time_column(values):
+    """时间列转为 int64 纳秒（带时区的按UTC）"""
+    return pd.DatetimeIndex(pd.to_datetime(values)).asi8
+
+
+def _time_zone(values):
+    """时间列自带的时区名，不带时区时返回 None"""
+    tz = pd.DatetimeIndex(pd.to_datetime(values)).tz
+    return str(tz) if tz is not None else None
+
+
+class ResultsStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'runs'), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(root, 'results.db'))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        metric_columns = ",\n".join(f"{m} REAL" for m in INDEXED_METRICS)
+        metric_indexes = "\n".join(f"CREATE INDEX IF NOT EXISTS idx_runs_{m} ON runs ({m});" for m in INDEXED_METRICS)
+        self._conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                dataset_id TEXT,
+                engine_version TEXT,
+                params TEXT NOT NULL,
+                stats TEXT NOT NULL,
+                elapsed REAL,
+                created_at REAL NOT NULL,
+                side_files TEXT,
+                start_bar INTEGER,
+                end_bar INTEGER,
+                initial_balance REAL,
+                tz TEXT,
+                {metric_columns}
+            );
+            {metric_indexes}
+            CREATE INDEX IF NOT EXISTS idx_runs_dataset ON runs (dataset_id, engine_version);
+            CREATE TABLE IF NOT EXISTS run_params (
+                run_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                num_value REAL,
+                text_value TEXT,
+                PRIMARY KEY (run_id, name)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_params_num ON run_params (name, num_value);
+            CREATE INDEX IF NOT EXISTS idx_params_text ON run_params (name, text_value);
+        """)
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(runs)")}
+        for name, sql_type in _RUN_COLUMNS:
+            if name not in existing:
+                self._conn.execute(f"ALTER TABLE runs ADD COLUMN {name} {sql_type}")
+
+    def commit(self):
+        """提交 add_run(commit=False) 累积的写入"""
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def _run_dir(self, run_id):
+        return os.path.join(self.root, 'runs', run_id)
+
+    def _write_side_files(self, run_id, results_df, trades_df, compress):
+        columns = {}
+        if results_df is not None and len(results_df):
+            columns['equity_time'] = _time_column(results_df['datetime'])
+            columns['equity_balance'] = results_df['balance'].to_numpy(dtype=np.float64)
+        if trades_df is not None and len(trades_df):
+            columns['trade_entry_time'] = _time_column(trades_df['entry_datetime'])
+            columns['trade_exit_time'] = _time_column(trades_df['exit_datetime'])
+            for col in ('entry_price', 'exit_price', 'profit'):
+                columns[f'trade_{col}'] = trades_df[col].to_numpy(dtype=np.float64)
+            if 's1' in trades_df:
+                columns['trade_s1'] = trades_df['s1'].eq(True).to_numpy()
+        # 覆盖同一 run_id 时先删掉上一次写入的列文件，避免新旧列（或 npy/npz 两种格式）混在一起
+        run_dir = self._run_dir(run_id)
+        shutil.rmtree(run_dir, ignore_errors=True)
+        if not columns:
+            return None
+        os.makedirs(run_dir, exist_ok=True)
+        if compress:
+            np.savez_compressed(os.path.join(run_dir, 'columns.npz'), **columns)
+            return 'npz'
+        for name, arr in columns.items():
+            np.save(os.path.join(run_dir, f'{name}.npy'), np.ascontiguousarray(arr))
+        return 'npy'
+
+    def add_run(self, params, stats, dataset_id=None, results_df=None, trades_df=None, elapsed=None,
+                engine_version=ENGINE_VERSION, run_id=None, compress=False, commit=True, start=None, end=None,
+                initial_balance=None, tz=None):
+        """
+        写入一次回测结果，返回 run_id。
+        start / end 为回测的数据下标区间，initial_balance 为初始资金，三者都参与 run_id：
+        同一数据集上不同区间或不同资金的回测各自保存，不会互相覆盖。
+        tz 为数据的时区（净值时间戳按UTC保存，分时段分析按该时区划分自然日），默认取 results_df 时间列自带的时区。
+        params 中的 FLIP_THRESHOLD 函数按 backtest.params_to_json 换算为数值倍数。
+        """
+        params = params_to_json(params)
+        run_id = run_id or make_run_id(dataset_id, params, engine_version, start, end, initial_balance)
+        side_files = self._write_side_files(run_id, results_df, trades_df, compress)
+        if tz is None and results_df is not None and len(results_df):
+            tz = _time_zone(results_df['datetime'])
+        metrics = [_to_float(stats.get(m)) for m in INDEXED_METRICS]
+        stats_json = json.dumps({k: v for k, v in stats.items()}, default=_json_default)
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO runs (run_id, dataset_id, engine_version, params, stats, elapsed, created_at, side_files, "
+            f"start_bar, end_bar, initial_balance, tz, {', '.join(INDEXED_METRICS)}) "
+            f"VALUES ({', '.join('?' * (12 + len(INDEXED_METRICS)))})",
+            [run_id, dataset_id, engine_version, json.dumps(params, sort_keys=True), stats_json,
+             elapsed, time.time(), side_files, _to_int(start), _to_int(end), _to_float(initial_balance), tz] + metrics)
+        self._conn.execute("DELETE FROM run_params WHERE run_id = ?", (run_id,))
+        self._conn.executemany(
+            "INSERT INTO run_params (run_id, name, num_value, text_value) VALUES (?, ?, ?, ?)",
+            [(run_id, name, _to_float(value) if not isinstance(value, (dict, list, str)) else None,
+              json.dumps(value, sort_keys=True)) for name, value in params.items()])
+        if commit:
+            self._conn.commit()
+        return run_id
+
+    def add_sweep_results(self, results):
+        """
+        批量写入 distributed_sweep 的结果 {task_id: {'params', 'dataset_id', 'start', 'end', 'initial_balance',
+        'tz', 'stats', 'elapsed'}}，返回写入条数
+        """
+        for result in results.values():
+            self.add_run(result['params'], result['stats'], result.get('dataset_id'), elapsed=result.get('elapsed'),
+                         commit=False, start=result.get('start'), end=result.get('end'),
+                         initial_balance=result.get('initial_balance'), tz=result.get('tz'))
+        self._conn.commit()
+        return len(results)
+
+    def query(self, order_by='sharpe_ratio', descending=True, limit=50, filters=None, param_filters=None,
+              dataset_id=None, engine_version=None):
+        """
+        按索引指标查询。
+
+        - filters: 指标条件列表，如 [('max_drawdown', '>', -0.1), ('total_trades', '>=', 10)]
+        - param_filters: 参数条件列表，如 [('RISK_FACTOR', '=', 0.1)]
+        返回 DataFrame：run_id、dataset_id、各指标列以及解析后的 params 字典。
+        """
+        ops = {'=', '!=', '<', '<=', '>', '>='}
+        if order_by not in INDEXED_METRICS:
+            raise ValueError(f"只能按已索引指标排序: {INDEXED_METRICS}")
+        where, args = [f"{order_by} IS NOT NULL"], []
+        for metric, op, value in filters or []:
+            if metric not in INDEXED_METRICS or op not in ops:
+                raise ValueError(f"不支持的过滤条件: {metric} {op}")
+            where.append(f"{metric} {op} ?")
+            args.append(value)
+        for name, op, value in param_filters or []:
+            if op not in ops:
+                raise ValueError(f"不支持的过滤条件: {name} {op}")
+            column = 'num_value' if isinstance(value, (int, float)) else 'text_value'
+            if column == 'text_value':
+                value = json.dumps(value, sort_keys=True, default=str)
+            where.append(f"run_id IN (SELECT run_id FROM run_params WHERE name = ? AND {column} {op} ?)")
+            args.extend([name, value])
+        if dataset_id is not None:
+            where.append("dataset_id = ?")
+            args.append(dataset_id)
+        if engine_version is not None:
+            where.append("engine_version = ?")
+            args.append(engine_version)
+        sql = (f"SELECT run_id, dataset_id, start_bar, end_bar, initial_balance, engine_version, elapsed, "
+               f"{', '.join(INDEXED_METRICS)}, params FROM runs "
+               f"WHERE {' AND '.join(where)} ORDER BY {order_by} {'DESC' if descending else 'ASC'} LIMIT ?")
+        rows = self._conn.execute(sql, args + [limit]).fetchall()
+        columns = (['run_id', 'dataset_id', 'start_bar', 'end_bar', 'initial_balance', 'engine_version', 'elapsed']
+                   + list(INDEXED_METRICS) + ['params'])
+        df = pd.DataFrame(rows, columns=columns)
+        df['params'] = [json.loads(p) for p in df['params']]
+        return df
+
+    def top_runs(self, metric='sharpe_ratio', n=50, min_max_drawdown=None):
+        """常用查询：指标最高的 n 组结果，可选最大回撤下限（如 -0.1 表示回撤不超过10%）"""
+        filters = [('max_drawdown', '>', min_max_drawdown)] if min_max_drawdown is not None else None
+        return self.query(order_by=metric, limit=n, filters=filters)
+
+    def get_run(self, run_id):
+        """读取单条记录的参数与完整 stats"""
+        row = self._conn.execute("SELECT dataset_id, engine_version, params, stats, elapsed, side_files, start_bar, end_bar, "
+                                 "initial_balance, tz FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None:
+            raise KeyError(run_id)
+        return {'run_id': run_id, 'dataset_id': row[0], 'engine_version': row[1], 'params': json.loads(row[2]),
+                'stats': json.loads(row[3]), 'elapsed': row[4], 'side_files': row[5], 'start': row[6], 'end': row[7],
+                'initial_balance': row[8], 'tz': row[9]}
+
+    def load_columns(self, run_id):
+        """加载净值/成交旁路列：npy 格式为内存映射（零拷贝，只读），npz 格式解压后返回"""
+        run_dir = self._run_dir(run_id)
+        npz_path = os.path.join(run_dir, 'columns.npz')
+        if os.path.exists(npz_path):
+            with np.load(npz_path) as data:
+                return {name: data[name] for name in data.files}
+        if not os.path.isdir(run_dir):
+            return {}
+        return {name[:-4]: np.load(os.path.join(run_dir, name), mmap_mode='r')
+                for name in os.listdir(run_dir) if name.endswith('.npy')}
+
+    def load_equity(self, run_id):
+        """返回 (int64 纳秒时间戳, 净值) 两个数组"""
+        columns = self.load_columns(run_id)
+        return columns.get('equity_time'), columns.get('equity_balance')
+
+    def load_ledger(self, run_id):
+        """返回成交明细各列 {列名: 数组}（不含 trade_ 前缀）"""
+        columns = self.load_columns(run_id)
+        return {name[len('trade_'):]: arr for name, arr in columns.items() if name.startswith('trade_')}
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
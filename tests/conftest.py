@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from features import compute_features
+
+
+def make_klines(n_bars=20 * 1440, seed=0, tz='Asia/Shanghai'):
+    """与下载器输出同格式的合成1分钟K线（带时区的 open_time 列 + OHLCV），价格为几何随机游走"""
+    rng = np.random.default_rng(seed)
+    prices = 600 * np.exp(np.cumsum(rng.normal(0, 0.0015, n_bars)))
+    times = pd.date_range('2025-01-01', periods=n_bars, freq='1min', tz='UTC')
+    if tz is not None:
+        times = times.tz_convert(tz)
+    return pd.DataFrame({'open_time': times, 'open_price': prices, 'high_price': prices * 1.001,
+                         'low_price': prices * 0.999, 'close_price': prices, 'volume': 1.0})
+
+
+@pytest.fixture(scope='session')
+def klines():
+    return make_klines()
+
+
+@pytest.fixture(scope='session')
+def features(klines):
+    return compute_features(klines)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from backtest import backtest_, resolve_params
+from conftest import make_klines
+from features import compute_features
+from monte_carlo import batch_backtest
+
+# 基线版本 backtest_（逐K线手写循环）在合成数据上的结果，initial_balance=1000，默认参数
+BASELINE = {
+    0: {'total_trades': 11, 'final_balance': 1120.119833356835, 'sharpe_ratio': 4.9430136848050505,
+        'max_drawdown': -0.10126198046354556},
+    1: {'total_trades': 12, 'final_balance': 1138.6745529323853, 'sharpe_ratio': 4.640896802276695,
+        'max_drawdown': -0.11710024398410315},
+}
+
+
+@pytest.mark.parametrize('seed', sorted(BASELINE))
+def test_matches_baseline(seed):
+    features = compute_features(make_klines(seed=seed))
+    _, trades_df, stats = backtest_(None, 1000, features=features, show_progress=False)
+    expected = BASELINE[seed]
+    assert stats['total_trades'] == expected['total_trades'] == len(trades_df)
+    for key in ('final_balance', 'sharpe_ratio', 'max_drawdown'):
+        assert stats[key] == pytest.approx(expected[key], rel=1e-9)
+    assert stats['risk_stop'] is None
+
+
+def test_stop_on_risk_truncates_equity(features):
+    results_df, _, stats = backtest_(None, 1000, params={'MAX_DRAWDOWN': -0.02}, features=features,
+                                     show_progress=False, stop_on_risk=True)
+    assert stats['risk_stop'] == 'max_drawdown'
+    assert len(results_df) < len(features)
+    assert stats['final_balance'] == results_df['balance'].iloc[-1]
+
+
+def test_batch_backtest_matches_backtest(features):
+    """批量回测与 backtest_ 调用同一个 grid_core.step，历史路径上结果一致"""
+    params = {'FLIP_THRESHOLD': 0.5, 'S1_BUY_TARGET_PCT': 0.9}
+    _, _, stats = backtest_(None, 1000, params=params, features=features, show_progress=False)
+    reset_points = features.get_reset_points(resolve_params(params)['RESET_INTERVAL_SECONDS'])
+    prices = np.column_stack([features.prices, features.prices])
+    log_returns = np.column_stack([features.log_returns, features.log_returns])
+    paths = batch_backtest(prices, log_returns, features.time_ns, features.day_ids, reset_points, 1000, params)
+    assert list(paths['total_trades']) == [stats['total_trades']] * 2
+    for key in ('final_balance', 'sharpe_ratio', 'max_drawdown', 'annual_return'):
+        assert paths[key] == pytest.approx([stats[key]] * 2, rel=1e-9)
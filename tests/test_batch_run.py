@@ -0,0 +1,50 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from batch_run import run_batch
+from conftest import make_klines
+
+
+@pytest.fixture
+def manifest_path(tmp_path):
+    make_klines(n_bars=3 * 1440).to_pickle(str(tmp_path / 'klines.pkl'))
+    path = tmp_path / 'manifest.json'
+    path.write_text(json.dumps({'output': str(tmp_path / 'results'), 'initial_balance': 1000,
+                                'datasets': ['klines.pkl'], 'params': [{}, {'RISK_FACTOR': 0.05}]}))
+    return str(path)
+
+
+@pytest.mark.parametrize('previous', [None, '0'])
+def test_worker_env_does_not_leak_to_caller(manifest_path, monkeypatch, previous):
+    if previous is None:
+        monkeypatch.delenv('GRID_SKIP_DOTENV', raising=False)
+    else:
+        monkeypatch.setenv('GRID_SKIP_DOTENV', previous)
+    summary = run_batch(manifest_path, workers=2)
+    assert len(summary) == 2 and summary['run_id'].nunique() == 2
+    assert os.environ.get('GRID_SKIP_DOTENV') == previous
+
+
+def _run_python(code, **env):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True,
+                            env={**os.environ, **env}, check=True)
+    return result.stdout.strip()
+
+
+def test_importing_backtest_skips_plotting_and_progress_modules():
+    code = "import sys, backtest; print(sorted(m for m in ('matplotlib', 'tqdm') if m in sys.modules))"
+    assert _run_python(code) == '[]'
+
+
+@pytest.mark.parametrize('value, skipped', [('1', True), ('true', True), ('0', False), ('false', False), ('', False)])
+def test_skip_dotenv_flag(value, skipped):
+    pytest.importorskip('dotenv')
+    # 用替身记录 config 导入时是否调用了 load_dotenv
+    code = ("import dotenv; calls = []; dotenv.load_dotenv = lambda *a, **k: calls.append(1); "
+            "import config; print(bool(calls))")
+    assert _run_python(code, GRID_SKIP_DOTENV=value) == str(not skipped)
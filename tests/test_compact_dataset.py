@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from compact_dataset import CompactKlines, decode_times, encode_times
+from conftest import make_klines
+from features import compute_features
+
+
+def _messy_klines():
+    """打乱顺序并带重复时间戳（重复行价格不同）的K线"""
+    df = make_klines(n_bars=3000)
+    dup = df.iloc[[10, 500, 501]].copy()
+    dup['close_price'] *= 1.01
+    df = pd.concat([df, dup], ignore_index=True)
+    return df.sample(frac=1.0, random_state=0).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('price_mode', ['auto', 'float64'])
+def test_round_trip_matches_compute_features(tmp_path, price_mode):
+    df = _messy_klines()
+    expected = compute_features(df)
+    CompactKlines.from_dataframe(df, price_mode=price_mode).save(str(tmp_path / 'compact'))
+    compact = CompactKlines.open(str(tmp_path / 'compact'))
+    features = compact.to_features()
+
+    assert len(features) == len(expected) == 3000
+    np.testing.assert_array_equal(features.time_ns, expected.time_ns)
+    np.testing.assert_array_equal(features.prices, expected.prices)
+    np.testing.assert_array_equal(features.day_ids, expected.day_ids)
+    assert features.times.equals(pd.DatetimeIndex(expected.times))
+    assert features.integrity.is_sorted
+    assert features.integrity.to_dict() == expected.integrity.to_dict()
+
+
+def test_decode_times_empty():
+    meta, deltas = encode_times(np.empty(0, dtype=np.int64))
+    assert len(decode_times(meta, deltas, 0)) == 0
+    assert len(decode_times({'start_ns': 0, 'unit_ns': 1}, np.empty(0, dtype=np.int32), 0)) == 0
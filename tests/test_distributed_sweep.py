@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+
+import pytest
+
+import distributed_sweep
+from distributed_sweep import SQLiteQueue, make_tasks, run_task, run_worker, wait_for_results
+
+
+@pytest.fixture
+def data_path(tmp_path, klines):
+    path = str(tmp_path / 'klines.pkl')
+    klines.iloc[:5 * 1440].to_pickle(path)
+    return path
+
+
+def test_make_tasks_rejects_params_that_are_not_json(data_path):
+    with pytest.raises(ValueError, match='FLIP_THRESHOLD'):
+        make_tasks(data_path, [{'FLIP_THRESHOLD': lambda grid_size: grid_size / 500}])
+
+
+def test_task_ids_depend_on_slice_and_params(data_path):
+    a = make_tasks(data_path, {'FLIP_THRESHOLD': [0.1, 0.2]}, start=0, end=1440)
+    b = make_tasks(data_path, {'FLIP_THRESHOLD': [0.1, 0.2]}, start=0, end=2880)
+    assert len({t['task_id'] for t in a + b}) == 4
+    assert a == make_tasks(data_path, {'FLIP_THRESHOLD': [0.1, 0.2]}, start=0, end=1440)
+
+
+def test_task_ids_depend_on_initial_balance(tmp_path, data_path):
+    small = make_tasks(data_path, {'FLIP_THRESHOLD': [0.1, 0.2]}, initial_balance=1000)
+    large = make_tasks(data_path, {'FLIP_THRESHOLD': [0.1, 0.2]}, initial_balance=5000)
+    assert not {t['task_id'] for t in small} & {t['task_id'] for t in large}
+    queue = SQLiteQueue(str(tmp_path / 'queue.db'))
+    assert queue.publish(small) == 2
+    assert queue.publish(large) == 2
+    assert make_tasks(data_path, {'FLIP_THRESHOLD': [0.1]}, initial_balance=1000)[0]['task_id'] == small[0]['task_id']
+
+
+def test_wait_ignores_failures_of_other_sweeps(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / 'q.db'), max_attempts=1)
+    queue.publish([{'task_id': 'other'}])
+    task = queue.claim('w')
+    queue.fail(task['task_id'], 'boom')
+    queue.publish([{'task_id': 'mine'}])
+    assert queue.counts() == {'failed': 1, 'pending': 1}
+    assert queue.counts(['mine']) == {'pending': 1}
+    with pytest.raises(TimeoutError):
+        wait_for_results(queue, ['mine'], poll_interval=0.01, timeout=0.05)
+
+
+def test_each_task_caches_its_own_windows(data_path):
+    tasks = make_tasks(data_path, [{'VOLATILITY_WINDOW': 1}, {'VOLATILITY_WINDOW': 2, 'RESET_INTERVAL_SECONDS': 3600}],
+                       initial_balance=1000)
+    cache = {}
+    for task in tasks:
+        run_task(task, cache)
+    cached = os.listdir(os.path.join(data_path + '.features', cache[data_path].data_hash))
+    assert {'volatility_60.npy', 'volatility_120.npy', 'reset_86400.npy', 'reset_3600.npy'} <= set(cached)
+
+
+def test_publish_collect_cli(tmp_path, data_path, monkeypatch, capsys):
+    queue_path = str(tmp_path / 'sweep.db')
+    grid = json.dumps({'FLIP_THRESHOLD': [0.1, 0.2]})
+    common = ['--queue', queue_path, '--data', data_path, '--grid', grid, '--initial-balance', '1000']
+    monkeypatch.setattr(sys, 'argv', ['distributed_sweep.py', 'publish'] + common)
+    distributed_sweep.main()
+    assert run_worker(SQLiteQueue(queue_path), idle_timeout=0, poll_interval=0.01) == 2
+
+    output = str(tmp_path / 'sweep.csv')
+    monkeypatch.setattr(sys, 'argv', ['distributed_sweep.py', 'collect'] + common + ['--output', output, '--timeout', '5'])
+    distributed_sweep.main()
+    with open(output, encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 3 and 'FLIP_THRESHOLD' in lines[0] and 'sharpe_ratio' in lines[0]
@@ -0,0 +1,101 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+
+from compact_dataset import CompactKlines
+from features import compute_features, dataset_hash, load_features
+from kline_integrity import KlineIntegrity, integrity_path, load_integrity
+
+
+def _load(path):
+    features = load_features(path, volatility_bars=[1440], reset_intervals=[86400])
+    return features.data_hash, float(np.sum(features.prices)), int(np.nansum(features.get_volatility(1440) > 0))
+
+
+@pytest.fixture
+def data_path(tmp_path, klines):
+    path = str(tmp_path / 'klines.pkl')
+    klines.to_pickle(path)
+    return path
+
+
+def test_cache_matches_direct_computation(data_path, klines):
+    features = load_features(data_path, volatility_bars=[1440])
+    direct = compute_features(klines)
+    assert features.data_hash == dataset_hash(direct)
+    np.testing.assert_array_equal(features.prices, direct.prices)
+    np.testing.assert_array_equal(features.day_ids, direct.day_ids)
+    np.testing.assert_array_equal(features.get_volatility(1440), direct.get_volatility(1440))
+    assert features.times.equals(direct.times)
+
+
+def test_concurrent_processes_share_one_cache(data_path):
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        outputs = list(pool.map(_load, [data_path] * 8))
+    assert len(set(outputs)) == 1
+    cache_root = data_path + '.features'
+    # 只留下完整的哈希目录和 source.json，没有遗留的临时目录
+    assert sorted(os.listdir(cache_root)) == sorted([outputs[0][0], 'source.json'])
+
+
+def test_concurrent_threads_share_one_cache(data_path):
+    outputs, errors = [], []
+
+    def worker():
+        try:
+            outputs.append(_load(data_path))
+        except Exception as e:  # noqa: BLE001 - 线程内的异常交给主线程断言
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert len(set(outputs)) == 1
+
+
+def test_old_hash_directories_are_kept_unless_cleanup(data_path, klines):
+    first = load_features(data_path).data_hash
+    klines.iloc[:-10].to_pickle(data_path)
+    second = load_features(data_path).data_hash
+    cache_root = data_path + '.features'
+    assert {first, second} <= set(os.listdir(cache_root))
+    load_features(data_path, cleanup=True)
+    assert first not in os.listdir(cache_root)
+
+
+def test_loaders_share_the_integrity_file_beside_the_data(data_path, klines, tmp_path):
+    # 下载器写入的索引（这里用非默认周期标记）被 load_features 直接使用，缓存目录中不再另存一份
+    written = KlineIntegrity.build(compute_features(klines).time_ns, step_ns=120 * 10 ** 9)
+    written.save(integrity_path(data_path))
+    features = load_features(data_path)
+    assert features.integrity.step_ns == written.step_ns
+    assert not os.path.exists(os.path.join(data_path + '.features', features.data_hash, 'integrity.json'))
+
+    # 与数据不符（这里是乱序原始数据的索引）时重新构建并覆盖
+    shuffled = klines.sample(frac=1.0, random_state=0).reset_index(drop=True)
+    KlineIntegrity.build(shuffled['open_time'].array.asi8).save(integrity_path(data_path))
+    assert load_features(data_path).integrity.is_sorted
+    assert KlineIntegrity.load(integrity_path(data_path)).to_dict() == compute_features(klines).integrity.to_dict()
+
+    # 紧凑数据集同样使用目录旁的索引文件
+    directory = str(tmp_path / 'klines.compact')
+    CompactKlines.from_dataframe(klines).save(directory)
+    written.save(integrity_path(directory))
+    assert CompactKlines.open(directory).to_features().integrity.step_ns == written.step_ns
+
+
+def test_stale_index_with_same_length_and_endpoints_is_rebuilt(tmp_path):
+    # 长度、首尾时间相同，但缺口位置不同
+    step = 60 * 10 ** 9
+    before = np.array([0, 1, 2, 4, 5, 6, 7, 9], dtype=np.int64) * step
+    after = np.array([0, 2, 3, 4, 5, 7, 8, 9], dtype=np.int64) * step
+    path = str(tmp_path / 'klines.pkl')
+    assert load_integrity(path, before).gaps.tolist() == [[3 * step, 4 * step], [8 * step, 9 * step]]
+    assert not KlineIntegrity.load(integrity_path(path)).matches(after)
+    assert load_integrity(path, after).gaps.tolist() == [[1 * step, 2 * step], [6 * step, 7 * step]]
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from backtest import calculate_dynamic_interval, calculate_trade_amount, resolve_params
+from grid_core import grid_adjust_seconds, trade_amounts, volatility_grid
+
+
+@pytest.mark.filterwarnings('ignore:divide by zero:RuntimeWarning')  # 全部亏损时标量版凯利公式除以0
+@pytest.mark.parametrize('profits', [[], [3.0], [-2.0], [3.0, -1.5, 0.5, -4.0, 2.5]])
+@pytest.mark.parametrize('volatility', [0.0, 0.02, 0.3])
+def test_trade_amounts_match_scalar_sizing(profits, volatility):
+    params = resolve_params({'BASE_AMOUNT': 1e9})
+    trades = [{'profit': p} for p in profits]
+    wins = [p for p in profits if p > 0]
+    losses = [-p for p in profits if p < 0]
+    expected = calculate_trade_amount(10000.0, 'buy', 600.0, trades, volatility, params)
+    amount = trade_amounts(np.array([10000.0]), np.array([volatility]), np.array([len(profits)]),
+                           np.array([len(wins)]), np.array([sum(wins)]), np.array([len(losses)]),
+                           np.array([sum(losses)]), params)
+    assert amount[0] == pytest.approx(expected, rel=1e-12)
+
+
+def test_grid_rules_match_scalar_rules():
+    params = resolve_params()
+    grid_params = params['GRID_PARAMS']
+    vols = np.linspace(0, 1.2, 121)
+    assert np.allclose(grid_adjust_seconds(vols, params), [calculate_dynamic_interval(v, params) for v in vols])
+    grids = volatility_grid(vols, params)
+    assert grids.min() >= grid_params['min'] and grids.max() <= grid_params['max']
+    assert float(volatility_grid(0.0, params)) == grids[0]
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from features import compute_features
+from ladder_backtest import ladder_backtest, make_ladder
+
+
+def _features(prices):
+    times = pd.date_range('2025-01-01', periods=len(prices), freq='1min', tz='Asia/Shanghai')
+    return compute_features(pd.DataFrame({'open_time': times, 'close_price': np.asarray(prices, dtype=np.float64)}))
+
+
+def test_make_ladder_is_symmetric():
+    ladder = make_ladder(100.0, 0.01, 3)
+    assert len(ladder) == 7 and ladder[3] == 100.0
+    assert ladder[4:] == pytest.approx(100.0 * 1.01 ** np.arange(1, 4))
+    assert ladder[:3] == pytest.approx(100.0 * 1.01 ** np.arange(-3, 0))
+
+
+def test_both_sides_are_seeded():
+    features = _features([100.0, 100.0])
+    _, trades_df, stats = ladder_backtest(None, 1000, levels=5, grid_pct=0.01, features=features, show_progress=False)
+    assert stats['open_buy_levels'] == 5 and stats['open_sell_levels'] == 5
+    assert stats['seed_cost'] <= 500 and stats['final_balance'] == pytest.approx(1000)
+    assert trades_df.empty
+
+
+def test_rising_market_sells_seeded_levels():
+    # 只上涨不回落：下方买单不会成交，收益全部来自上方卖单
+    levels, grid_pct = 4, 0.01
+    features = _features(100.0 * (1 + grid_pct) ** np.arange(levels + 2))
+    _, trades_df, stats = ladder_backtest(None, 1000, levels=levels, grid_pct=grid_pct, features=features,
+                                          show_progress=False)
+    assert list(trades_df['level']) == [1, 2, 3, 4]
+    assert (trades_df['profit'] > 0).all()
+    assert stats['open_sell_levels'] == 0 and stats['open_buy_levels'] == 2 * levels
+    assert stats['final_balance'] == pytest.approx(1000 + trades_df['profit'].sum())
+
+
+def test_round_trip_below_base():
+    # 跌两档后回到基准价：第 -1、-2 档买入，分别在第 0、-1 档卖出
+    features = _features([100.0, 98.0, 100.0])
+    _, trades_df, stats = ladder_backtest(None, 1000, levels=3, grid_pct=0.01, features=features, show_progress=False)
+    assert sorted(trades_df['level']) == [-1, 0]
+    assert stats['open_buy_levels'] == 3 and stats['open_sell_levels'] == 3
+
+
+@pytest.mark.parametrize('base_price', [650.0, 560.0])
+def test_off_market_base_fills_at_market(base_price):
+    # 基准价偏离市价、价格不动：挂单时已穿过的档位按市价成交，不应产生亏损
+    features = _features(np.full(100, 600.0))
+    _, trades_df, stats = ladder_backtest(None, 1000, levels=5, base_price=base_price, order_amount=80,
+                                          features=features, show_progress=False)
+    assert stats['open_buy_levels'] + stats['open_sell_levels'] == 10
+    assert (trades_df['exit_price'] == 600.0).all() and (trades_df['profit'] == 0).all()
+    assert stats['final_balance'] == pytest.approx(1000)
+
+
+def test_rejects_order_amount_above_capital():
+    with pytest.raises(ValueError, match='底仓'):
+        ladder_backtest(None, 1000, levels=5, grid_pct=0.01, order_amount=150, features=_features([100.0, 100.0]),
+                        show_progress=False)
@@ -0,0 +1,36 @@
+import numpy as np
+
+from features import rolling_volatility
+from monte_carlo import chunk_paths_for_budget, generate_paths, path_volatility, run_monte_carlo
+
+
+def test_generated_paths_follow_returns():
+    log_returns = np.random.default_rng(5).normal(0, 0.001, 5000)
+    prices, returns = generate_paths(log_returns, 600.0, 3000, 7, 700, np.random.default_rng(9))
+    assert prices.shape == (3000, 7) and returns.shape == (2999, 7)
+    assert np.allclose(prices[1:], 600.0 * np.exp(np.cumsum(returns, axis=0)), rtol=1e-12)
+    # 每个区块都是历史收益率中的一段连续序列
+    block = returns[:700, 0]
+    start = int(np.flatnonzero(log_returns == block[0])[0])
+    assert np.array_equal(block, log_returns[start:start + 700])
+
+
+def test_path_volatility_matches_matrix_version():
+    returns = np.random.default_rng(1).normal(0, 0.001, (2000, 5))
+    assert np.array_equal(path_volatility(returns, 120), rolling_volatility(returns, 120), equal_nan=True)
+
+
+def test_chunk_paths_for_budget():
+    # 1440 根K线 x 3 个矩阵 x 8 字节 = 每条路径 33.75 KB
+    assert chunk_paths_for_budget(1440, 64, 2) == 32 * 2 ** 20 // (1440 * 24)
+    assert chunk_paths_for_budget(10 ** 9, 1, 4) == 1
+
+
+def test_budget_sized_run_is_reproducible(features):
+    kwargs = dict(n_paths=12, n_bars=3 * 1440, seed=7, features=features, initial_balance=1000, max_workers=2,
+                  memory_budget_mb=1)
+    first = run_monte_carlo(None, **kwargs)
+    second = run_monte_carlo(None, **kwargs)
+    assert len(first['paths']) == 12
+    assert first['paths'].equals(second['paths'])
+    assert (first['paths']['final_balance'] > 0).all()
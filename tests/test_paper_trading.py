@@ -0,0 +1,128 @@
+import asyncio
+import base64
+import hashlib
+import json
+import socket
+import struct
+import threading
+
+import pytest
+
+from backtest import backtest_
+from conftest import make_klines
+from features import compute_features
+from paper_trading import PaperTrader, SimulatedExchange, kline_messages, replay_messages, websocket_messages
+
+# 合成数据上风控不应触发：模拟盘只暂停开仓，而 backtest_ 默认不做风控
+PARAMS = {'MAX_DRAWDOWN': -0.99, 'DAILY_LOSS_LIMIT': -0.99}
+
+
+_WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def _frame(payload, opcode=0x1):
+    """服务端发往客户端的单帧（不加掩码）"""
+    n = len(payload)
+    if n < 126:
+        header = struct.pack('!BB', 0x80 | opcode, n)
+    elif n < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, n)
+    return header + payload
+
+
+def _serve_messages(server, messages):
+    """接受一个连接，完成握手后依次推送 messages，再发送关闭帧并等待客户端回应"""
+    conn, _ = server.accept()
+    with conn:
+        request = b''
+        while b'\r\n\r\n' not in request:
+            request += conn.recv(4096)
+        key = next(line.split(':', 1)[1].strip() for line in request.decode('latin-1').split('\r\n')
+                   if line.lower().startswith('sec-websocket-key:'))
+        accept = base64.b64encode(hashlib.sha1((key + _WS_GUID).encode()).digest()).decode()
+        conn.sendall((f"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        conn.sendall(b''.join(_frame(m.encode('utf-8')) for m in messages))
+        conn.sendall(_frame(struct.pack('!H', 1000), opcode=0x8))
+        conn.settimeout(5)
+        try:
+            conn.recv(64)
+        except OSError:
+            pass
+
+
+@pytest.fixture
+def local_feed():
+    """本地 websocket 行情服务：local_feed(messages) 返回 ws:// 地址，第一个连接收到全部消息后被关闭"""
+    servers = []
+
+    def start(messages):
+        server = socket.create_server(('127.0.0.1', 0))
+        thread = threading.Thread(target=_serve_messages, args=(server, list(messages)), daemon=True)
+        thread.start()
+        servers.append((server, thread))
+        return f"ws://127.0.0.1:{server.getsockname()[1]}/ws"
+
+    yield start
+    for server, thread in servers:
+        thread.join(timeout=5)
+        server.close()
+
+
+def _replay(features, trader):
+    return asyncio.run(trader.run(replay_messages(kline_messages(features))))
+
+
+@pytest.mark.parametrize('tz', ['Asia/Shanghai', 'America/New_York', None])
+def test_replay_matches_backtest(tz):
+    klines = make_klines(seed=1, tz=tz)
+    if tz is None:
+        klines = klines.set_index('open_time')
+    features = compute_features(klines)
+    _, trades_df, stats = backtest_(None, 1000, params=PARAMS, features=features, show_progress=False)
+
+    trader = PaperTrader(initial_balance=1000, params=PARAMS, tz=tz)
+    report = _replay(features, trader)
+    trades = trader.strategy.trades
+    assert report['decisions'] == len(features)
+    assert len(trades) == stats['total_trades']
+    assert [features.times[t['exit_i']] for t in trades] == list(trades_df['exit_datetime'])
+    assert [t['profit'] for t in trades] == pytest.approx(list(trades_df['profit']), rel=1e-9)
+    assert report['portfolio_value'] == pytest.approx(stats['final_balance'], rel=1e-9)
+
+
+def test_strategy_cash_tracks_exchange_with_fees(features):
+    exchange = SimulatedExchange(1000, fee_rate=0.001)
+    trader = PaperTrader(exchange=exchange, initial_balance=1000, params=PARAMS)
+    report = _replay(features, trader)
+    strategy = trader.strategy
+    assert report['fills'] > 0
+    assert strategy.current_balance == pytest.approx(exchange.quote_balance, rel=1e-12)
+    assert strategy.grid.units == pytest.approx(exchange.base_balance, rel=1e-12, abs=1e-12)
+
+
+def test_flush_drives_last_aggregated_minute():
+    trader = PaperTrader(initial_balance=1000)
+    for ms, price in [(0, 600.0), (30_000, 601.0), (60_000, 602.0), (90_000, 603.0)]:
+        trader.handle_message(json.dumps({'e': 'trade', 'T': ms, 'p': str(price)}))
+    assert trader.strategy.i == 0 and trader.strategy.last_price == 601.0
+    trader.flush()
+    assert trader.strategy.i == 1 and trader.strategy.last_price == 603.0
+    trader.flush()
+    assert trader.strategy.i == 1
+
+
+def test_websocket_feed_end_to_end(local_feed):
+    features = compute_features(make_klines(n_bars=5 * 1440, seed=1))
+    expected = PaperTrader(initial_balance=1000, params=PARAMS)
+    expected_report = _replay(features, expected)
+
+    trader = PaperTrader(initial_balance=1000, params=PARAMS)
+    report = asyncio.run(trader.run(websocket_messages(local_feed(kline_messages(features)))))
+    assert report['decisions'] == len(features) == len(trader.latencies_ns)
+    assert report['trades'] == expected_report['trades'] > 0
+    assert [t['profit'] for t in trader.strategy.trades] == [t['profit'] for t in expected.strategy.trades]
+    assert report['portfolio_value'] == expected_report['portfolio_value']
+    assert 0 < report['latency_p50_us'] <= report['latency_p99_us'] <= report['latency_max_us']
@@ -0,0 +1,37 @@
+import pytest
+
+from param_search import make_rung_spans, successive_halving
+
+
+def test_rung_spans_grow_by_eta_and_end_at_full_range():
+    assert make_rung_spans(100, 5, eta=3) == [5, 15, 45, 100]
+    assert make_rung_spans(10, 20, eta=2) == [10]
+
+
+@pytest.mark.parametrize('min_bars, eta', [(0, 3), (-5, 3), (10, 1), (10, 0)])
+def test_rung_spans_reject_arguments_that_never_grow(min_bars, eta):
+    with pytest.raises(ValueError):
+        make_rung_spans(100, min_bars, eta)
+
+
+@pytest.mark.parametrize('min_bars, eta', [(0, 3), (1440, 1)])
+def test_successive_halving_validates_before_running(features, min_bars, eta):
+    with pytest.raises(ValueError):
+        successive_halving(None, {'FLIP_THRESHOLD': [0.2]}, min_bars=min_bars, eta=eta,
+                           initial_balance=1000, features=features)
+
+
+@pytest.mark.parametrize('initial_balance', [0, -100])
+def test_successive_halving_rejects_non_positive_initial_balance(features, initial_balance):
+    with pytest.raises(ValueError, match='initial_balance'):
+        successive_halving(None, {'FLIP_THRESHOLD': [0.2]}, initial_balance=initial_balance, features=features)
+
+
+def test_successive_halving_keeps_top_candidates(features):
+    grid = [{'FLIP_THRESHOLD': x, 'MAX_DRAWDOWN': -0.5, 'DAILY_LOSS_LIMIT': -0.5} for x in (0.1, 0.2, 0.3)]
+    result = successive_halving(None, grid, min_bars=2 * 1440, eta=3, initial_balance=1000, max_workers=2,
+                                features=features)
+    assert [r['bars'] for r in result['rungs']] == [2 * 1440, 6 * 1440, 18 * 1440, 20 * 1440]
+    assert [r['candidates'] for r in result['rungs']] == [3, 1, 1, 1]
+    assert result['best_params'] in grid
+    assert 0 < result['cost_ratio'] < 1
@@ -0,0 +1,14 @@
+from conftest import make_klines
+from portfolio_backtest import portfolio_backtest
+
+
+def test_positions_exit_down_to_the_min_position_floor():
+    data = {'A': make_klines(seed=0), 'B': make_klines(seed=1)}
+    results_df, trades_df, stats = portfolio_backtest(data, 300, show_progress=False)
+    assert all(s['total_trades'] > 0 for s in stats['per_symbol'].values())
+    # 卖出只卖到 MIN_POSITION_RATIO（默认10%）为止，剩余仓位保留为底仓
+    position_value = results_df['balance'] - results_df['cash']
+    assert (position_value.iloc[-1] / results_df['balance'].iloc[-1]) < 0.2
+
+    _, unrestricted, _ = portfolio_backtest(data, 300, params={'MIN_POSITION_RATIO': 0}, show_progress=False)
+    assert len(unrestricted) > 0
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from analytics import PeriodAnalytics
+from backtest import backtest_, resolve_params
+from conftest import make_klines
+from results_store import ResultsStore, make_run_id
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ResultsStore(str(tmp_path / 'results'))
+    yield store
+    store.close()
+
+
+def _stats(sharpe):
+    return {'sharpe_ratio': sharpe, 'max_drawdown': -0.05, 'total_trades': 3}
+
+
+def test_run_id_depends_on_slice_and_balance():
+    ids = {make_run_id('data', {'RISK_FACTOR': 0.1}, start=s, end=e, initial_balance=b)
+           for s, e, b in [(0, 100, 1000), (100, 200, 1000), (0, 200, 1000), (0, 100, 2000)]}
+    assert len(ids) == 4
+    assert make_run_id('data', {}, start=np.int64(0), end=100) == make_run_id('data', {}, start=0, end=100)
+
+
+def test_slices_of_one_dataset_do_not_collide(store):
+    params = {'RISK_FACTOR': 0.1}
+    first = store.add_run(params, _stats(1.0), 'data', start=0, end=1440, initial_balance=1000)
+    second = store.add_run(params, _stats(2.0), 'data', start=1440, end=2880, initial_balance=1000)
+    assert first != second
+    runs = store.query(limit=10)
+    assert sorted(zip(runs['start_bar'], runs['end_bar'])) == [(0, 1440), (1440, 2880)]
+    assert store.get_run(second)['start'] == 1440
+    # 同一切片重复写入时覆盖
+    assert store.add_run(params, _stats(3.0), 'data', start=0, end=1440, initial_balance=1000) == first
+    assert len(store.query(limit=10)) == 2
+    assert store.get_run(first)['stats']['sharpe_ratio'] == 3.0
+
+
+def test_replacing_a_run_removes_stale_side_files(store, features):
+    results_df, trades_df, stats = backtest_(None, 1000, start=0, end=3 * 1440, features=features, show_progress=False)
+    run_id = store.add_run({}, stats, 'data', results_df, trades_df, start=0, end=3 * 1440, initial_balance=1000)
+    assert 'equity_balance' in store.load_columns(run_id)
+    store.add_run({}, stats, 'data', start=0, end=3 * 1440, initial_balance=1000)
+    assert store.load_columns(run_id) == {}
+    store.add_run({}, stats, 'data', results_df, trades_df, start=0, end=3 * 1440, initial_balance=1000, compress=True)
+    assert os.listdir(os.path.join(store.root, 'runs', run_id)) == ['columns.npz']
+
+
+def test_effective_params_are_stored_as_json(store):
+    run_id = store.add_run(resolve_params({'FLIP_THRESHOLD': 0.3}), _stats(1.0), 'data')
+    params = store.get_run(run_id)['params']
+    assert params['FLIP_THRESHOLD'] == 0.3 and 'GRID_PARAMS' in params
+    assert resolve_params(params)['FLIP_THRESHOLD'](2.0) == pytest.approx(2.0 * 0.3 / 100)
+    with pytest.raises(ValueError):
+        store.add_run({'FLIP_THRESHOLD': lambda g: g * g}, _stats(1.0), 'data')
+
+
+def test_sweep_results_keep_their_slices(store):
+    results = {f't{k}': {'params': {'RISK_FACTOR': 0.1}, 'dataset_id': 'data', 'start': s, 'end': s + 100,
+                         'initial_balance': 1000, 'stats': _stats(1.0), 'elapsed': 0.1}
+               for k, s in enumerate((0, 100, 200))}
+    assert store.add_sweep_results(results) == 3
+    assert len(store.query(limit=10)) == 3
+
+
+@pytest.mark.parametrize('tz', ['America/New_York', None])
+def test_analytics_from_store_uses_data_tz(store, tz):
+    df = make_klines(n_bars=5 * 1440, tz=tz or 'UTC')
+    if tz is None:
+        df['open_time'] = df['open_time'].dt.tz_localize(None)
+    results_df, trades_df, stats = backtest_(df, 1000, show_progress=False)
+    run_id = store.add_run({}, stats, 'data', results_df, trades_df, initial_balance=1000)
+    assert store.get_run(run_id)['tz'] == tz
+    from_store = PeriodAnalytics.from_store(store, run_id)
+    from_results = PeriodAnalytics.from_results(results_df, trades_df)
+    assert from_store.tz == from_results.tz == tz
+    pd.testing.assert_frame_equal(from_store.daily(), from_results.daily())
@@ -0,0 +1,32 @@
+import pytest
+
+from walk_forward import make_folds, run_walk_forward
+
+
+def test_make_folds_tiles_test_windows():
+    folds = make_folds(100, train_bars=40, test_bars=20)
+    assert folds == [(0, 40, 40, 60), (20, 60, 60, 80), (40, 80, 80, 100)]
+
+
+def test_make_folds_rejects_overlapping_test_windows(features):
+    with pytest.raises(ValueError, match='step_bars'):
+        make_folds(100, train_bars=40, test_bars=20, step_bars=10)
+    with pytest.raises(ValueError, match='step_bars'):
+        run_walk_forward(None, {'FLIP_THRESHOLD': [0.2]}, train_bars=5 * 1440, test_bars=3 * 1440, step_bars=1440,
+                         initial_balance=1000, features=features)
+
+
+@pytest.mark.parametrize('initial_balance', [0, -100])
+def test_rejects_non_positive_initial_balance(features, initial_balance):
+    with pytest.raises(ValueError, match='initial_balance'):
+        run_walk_forward(None, {'FLIP_THRESHOLD': [0.2]}, train_bars=5 * 1440, test_bars=3 * 1440,
+                         initial_balance=initial_balance, features=features)
+
+
+def test_oos_equity_is_continuous(features):
+    wf = run_walk_forward(None, {'FLIP_THRESHOLD': [0.1, 0.2]}, train_bars=5 * 1440, test_bars=3 * 1440,
+                          initial_balance=1000, max_workers=2, features=features)
+    assert len(wf['folds']) == 5
+    assert len(wf['oos_results']) == 5 * 3 * 1440
+    assert wf['oos_results']['balance'].iloc[0] == pytest.approx(1000)
+    assert wf['oos_stats']['total_trades'] == sum(f['test_stats']['total_trades'] for f in wf['folds'])
@@ -0,0 +1,153 @@
+"""
+Walk-forward 参数优化
+
+把时间序列按下标切分为连续的 训练/测试 折：
+- 在每个训练折上对参数网格逐一回测，按目标指标（默认夏普比率）选出最优参数；
+- 用该参数在紧随其后的测试折上回测，得到样本外结果；
+- 最后把各测试折的样本外净值按资金连续的方式拼接成一条曲线。
+
+所有折只按下标切片同一份预计算特征（价格、时间戳、对数收益率、日编号），不复制 DataFrame；
+训练/测试任务通过进程池并行执行，特征在每个工作进程初始化时传入一次，跨折复用。
+"""
+
+import itertools
+import logging
+import math
+
+import numpy as np
+import pandas as pd
+
+from backtest import calculate_stats, resolve_params, setup_logging
+from config import INITIAL_PRINCIPAL
+from features import compute_features, load_features
+from worker_pool import process_pool, run_window
+
+
+def make_folds(n_bars, train_bars, test_bars, step_bars=None, start=0):
+    """
+    按下标生成 (train_start, train_end, test_start, test_end) 列表，区间均为左闭右开；
+    step_bars 默认等于 test_bars，即各测试折首尾相接、互不重叠；step_bars 小于 test_bars 时测试折互相重叠，
+    拼接出的样本外净值会有重复、倒退的时间戳，因此不允许
+    """
+    if train_bars <= 0 or test_bars <= 0:
+        raise ValueError("训练折和测试折长度必须为正数")
+    step_bars = step_bars or test_bars
+    if step_bars < test_bars:
+        raise ValueError(f"step_bars（{step_bars}）不能小于 test_bars（{test_bars}），否则测试折会重叠")
+    folds = []
+    train_start = start
+    while train_start + train_bars + test_bars <= n_bars:
+        train_end = train_start + train_bars
+        folds.append((train_start, train_end, train_end, train_end + test_bars))
+        train_start += step_bars
+    return folds
+
+
+def expand_param_grid(param_grid):
+    """
+    将 {参数名: [候选值, ...]} 展开为参数字典列表，参数名与 config.py 一致（见 backtest.resolve_params）
+    """
+    keys = list(param_grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(param_grid[k] for k in keys))]
+
+
+def _score(stats, metric):
+    value = stats.get(metric, float('nan'))
+    return value if value is not None and not math.isnan(value) else float('-inf')
+
+
+def run_walk_forward(df, param_grid, train_bars, test_bars, step_bars=None, metric='sharpe_ratio',
+                     initial_balance=INITIAL_PRINCIPAL, max_workers=None, features=None):
+    """
+    执行 walk-forward 优化。
+
+    参数：
+    - df / features: K线数据或已计算好的特征（二选一，传入 features 时 df 可为 None）
+    - param_grid: {参数名: [候选值]}，或已展开的参数字典列表
+    - train_bars / test_bars / step_bars: 训练折、测试折长度和步长（K线根数）
+    - metric: 选优使用的 stats 指标
+
+    返回 dict：
+    - folds: 每折的下标范围、最优参数、训练与测试统计
+    - oos_results: 拼接后的样本外净值 DataFrame（datetime, balance）
+    - oos_stats: 样本外净值的整体统计
+    """
+    if initial_balance <= 0:
+        # 样本外拼接按 initial_balance 等比例缩放各折净值
+        raise ValueError(f"initial_balance 必须为正数（当前为 {initial_balance}），请检查 .env 中的 INITIAL_PRINCIPAL")
+    if features is None:
+        features = compute_features(df)
+    candidates = expand_param_grid(param_grid) if isinstance(param_grid, dict) else list(param_grid)
+    folds = make_folds(len(features), train_bars, test_bars, step_bars)
+    if not folds:
+        raise ValueError("数据长度不足以切分出一个训练折加测试折")
+
+    logging.info(f"Walk-forward：{len(folds)} 折 x {len(candidates)} 组参数")
+    with process_pool(features, max_workers) as pool:
+        # 所有折的训练任务一次性提交，充分利用全部进程
+        train_tasks = [(tr_s, tr_e, params, initial_balance, False, False)
+                       for tr_s, tr_e, _, _ in folds for params in candidates]
+        train_stats = [stats for stats, _, _ in pool.map(run_window, train_tasks)]
+
+        fold_results = []
+        test_tasks = []
+        for fold_no, (tr_s, tr_e, te_s, te_e) in enumerate(folds):
+            fold_stats = train_stats[fold_no * len(candidates):(fold_no + 1) * len(candidates)]
+            best = max(range(len(candidates)), key=lambda k: _score(fold_stats[k], metric))
+            fold_results.append({
+                'train_range': (tr_s, tr_e),
+                'test_range': (te_s, te_e),
+                'best_params': candidates[best],
+                'train_stats': fold_stats[best],
+            })
+            test_tasks.append((te_s, te_e, candidates[best], initial_balance, False, True))
+        test_outputs = list(pool.map(run_window, test_tasks))
+
+    # 拼接样本外净值：每个测试折都从 initial_balance 起步，按上一折期末资金等比例缩放
+    segments = []
+    capital = initial_balance
+    for fold, (stats, _, equity) in zip(fold_results, test_outputs):
+        fold['test_stats'] = stats
+        segments.append(equity * (capital / initial_balance))
+        capital = segments[-1][-1]
+        logging.info(f"折 {fold['test_range']} | 参数 {fold['best_params']} | 样本外{metric}: {stats.get(metric, float('nan')):.2f}")
+
+    oos_equity = np.concatenate(segments)
+    oos_index = np.concatenate([np.arange(te_s, te_e) for te_s, te_e in (f['test_range'] for f in fold_results)])
+    oos_results = pd.DataFrame({'datetime': features.times[oos_index], 'balance': oos_equity})
+    oos_stats = calculate_stats(oos_equity, features.time_ns[oos_index], [], initial_balance)
+    oos_stats['total_trades'] = sum(f['test_stats']['total_trades'] for f in fold_results)
+    oos_stats['winning_trades'] = sum(f['test_stats']['winning_trades'] for f in fold_results)
+    oos_stats['win_rate'] = oos_stats['winning_trades'] / oos_stats['total_trades'] if oos_stats['total_trades'] else 0.0
+    oos_stats.pop('profit_loss_ratio')
+
+    return {
+        'folds': fold_results,
+        'oos_results': oos_results,
+        'oos_stats': oos_stats,
+    }
+
+
+if __name__ == "__main__":
+    setup_logging()
+    pkl_file = "BNBUSDT_BINANCE_2025-01-01_00_00_00_2025-05-19_23_59_59.pkl"
+    # 特征缓存在数据文件旁，重复运行时直接内存映射
+    defaults = resolve_params()
+    features = load_features(pkl_file, volatility_bars=[int(defaults['VOLATILITY_WINDOW'] * 60)],
+                             reset_intervals=[defaults['RESET_INTERVAL_SECONDS']])
+    param_grid = {
+        'FLIP_THRESHOLD': [0.1, 0.2, 0.3],
+        'RISK_FACTOR': [0.05, 0.1, 0.2],
+        'S1_SELL_TARGET_PCT': [0.4, 0.5, 0.6],
+    }
+    # 训练30天，测试7天（1分钟K线）
+    wf = run_walk_forward(None, param_grid, train_bars=30 * 1440, test_bars=7 * 1440,
+                          features=features)
+
+    print("\nWalk-forward 样本外统计:")
+    print(f"总交易次数: {wf['oos_stats']['total_trades']}")
+    print(f"胜率: {wf['oos_stats']['win_rate']:.2%}")
+    print(f"年化收益率: {wf['oos_stats']['annual_return']:.2%}")
+    print(f"最大回撤: {wf['oos_stats']['max_drawdown']:.2%}")
+    print(f"夏普比率: {wf['oos_stats']['sharpe_ratio']:.2f}")
+    print(f"最终余额: {wf['oos_stats']['final_balance']:.2f}")
@@ -0,0 +1,65 @@
+"""
+进程池工作进程的公共部分
+
+walk_forward、param_search、monte_carlo、batch_run 都把一份只读数据（通常是回测特征）在工作进程启动时传入一次，
+任务函数在进程内通过 worker_shared() 读取，避免每个任务重复序列化；
+distributed_sweep 的 worker 与进程池任务共用 backtest_window 按下标窗口回测。
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from backtest import backtest_
+
+# 工作进程中复用的共享数据（由进程池 initializer 设置）
+_shared = None
+
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+
+def worker_shared():
+    """工作进程内由 process_pool 传入的共享数据"""
+    return _shared
+
+
+@contextmanager
+def scoped_env(env):
+    """在 with 块内设置环境变量，退出时恢复原值（原本不存在的变量会被删除）"""
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update({key: str(value) for key, value in env.items()})
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+@contextmanager
+def process_pool(shared=None, max_workers=None, env=None):
+    """
+    创建进程池：shared 在每个工作进程启动时传入一次；
+    env 只在进程池存续期间设置（工作进程按需启动时继承），退出后恢复调用方原有的环境变量
+    """
+    with scoped_env(env or {}):
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(shared,)) as pool:
+            yield pool
+
+
+def backtest_window(features, start, end, params, initial_balance, stop_on_risk=False, keep_equity=False):
+    """按下标窗口回测一次，返回 (统计信息, 实际回测的K线数, 净值数组或 None)"""
+    results_df, _, stats = backtest_(None, initial_balance, params=params, start=start, end=end, features=features,
+                                     show_progress=False, stop_on_risk=stop_on_risk)
+    equity = results_df['balance'].to_numpy() if keep_equity else None
+    return stats, len(results_df), equity
+
+
+def run_window(task):
+    """进程池任务：(start, end, params, initial_balance, stop_on_risk, keep_equity)，特征取自共享数据"""
+    return backtest_window(_shared, *task)